@@ -1,29 +1,45 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
-from sqlalchemy.orm import Session
-from sqlalchemy import func, text
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, text
 from app.schemas import (
-    QuestionRequest, AnswerResponse, 
-    HealthResponse, DocumentUploadResponse
+    QuestionRequest, AnswerResponse, BatchQuestionRequest, BatchAnswerResponse,
+    HealthResponse, DocumentUploadResponse, IngestionJobStatus
 )
-from app.services.rag_service import RAGService
-from app.services.vector_service import VectorService
-from app.services.cache_service import CacheService
+from app.services.rag_service import RAGService, inflight
+from app.services.vector_service import DocumentRejected
+from app.services.ingestion_jobs import (
+    JOB_QUEUED, create_job, job_status, new_job_id, spool_upload, worker_pool
+)
+from app.services.cache_service import CacheService, get_cache
+from app.services.semantic_cache_service import SemanticCacheService
+from app.services.history_writer import history_writer
+from app.services.query_metrics import query_metrics
+from app.services.memory_index import memory_index
+from app.services.upstream import upstream_stats
 from app.database import get_db
-from app.models import Document, QueryHistory
+from app.config import get_settings
+from app.models import Document, IngestionJob
+from pathlib import Path
 from datetime import datetime
+import json
+import time
 from app.utils.logger import logger
 
+settings = get_settings()
+
 router = APIRouter(prefix="/api")
 
 
 @router.post("/ask", response_model=AnswerResponse)
 async def ask_question(
     request: QuestionRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    cache: CacheService = Depends(get_cache)
 ):
     """Main endpoint for questions - uses RAG pipeline"""
     try:
-        rag = RAGService(db)
+        rag = RAGService(db, cache)
         answer = await rag.answer_question(request.question)
         return answer
     except Exception as e:
@@ -31,12 +47,68 @@ async def ask_question(
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/documents", response_model=DocumentUploadResponse)
+@router.post("/ask/batch", response_model=BatchAnswerResponse)
+async def ask_questions_batch(
+    request: BatchQuestionRequest,
+    db: AsyncSession = Depends(get_db),
+    cache: CacheService = Depends(get_cache)
+):
+    """Several questions at once: shared cache lookup, embedding call and search query; answers in request order"""
+    if len(request.questions) > settings.batch_max_questions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.batch_max_questions} questions per batch"
+        )
+    
+    start_time = time.time()
+    try:
+        rag = RAGService(db, cache)
+        answers = await rag.answer_many(request.questions)
+        return BatchAnswerResponse(
+            answers=answers,
+            cached=sum(answer.cached for answer in answers),
+            response_time=time.time() - start_time
+        )
+    except Exception as e:
+        logger.error(f"Error in /ask/batch: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _sse(event: str, data: dict) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/ask/stream")
+async def ask_question_stream(
+    request: QuestionRequest,
+    db: AsyncSession = Depends(get_db),
+    cache: CacheService = Depends(get_cache)
+):
+    """Streaming version of /ask: server-sent events 'sources', 'token'..., 'done'"""
+    rag = RAGService(db, cache)
+    
+    async def event_stream():
+        try:
+            async for event, data in rag.stream_answer(request.question):
+                yield _sse(event, data)
+        except Exception as e:
+            logger.error(f"Error in /ask/stream: {e}", exc_info=True)
+            yield _sse("error", {"detail": str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/documents", response_model=DocumentUploadResponse, status_code=202)
 async def upload_document(
     file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Upload a new document to the knowledge base"""
+    """Upload a new document: validated and queued for background ingestion"""
     
     if not file.filename.endswith(('.txt', '.md')):
         raise HTTPException(
@@ -44,53 +116,54 @@ async def upload_document(
             detail="Only .txt and .md files are supported"
         )
     
+    job_id = new_job_id()
+    path = None
     try:
-        content = await file.read()
-        
-        if len(content) > 10 * 1024 * 1024:
-            raise HTTPException(
-                status_code=413,
-                detail="File too large. Maximum size is 10MB"
-            )
-        
-        try:
-            text_content = content.decode('utf-8')
-        except UnicodeDecodeError:
-            raise HTTPException(
-                status_code=400,
-                detail="File must be valid UTF-8 encoded text"
-            )
-        
-        if len(text_content.strip()) < 50:
-            raise HTTPException(
-                status_code=400,
-                detail="Document content too short (minimum 50 characters)"
-            )
+        # Файл проверяется и сохраняется на диск потоком; эмбеддинги считает воркер
+        path = await spool_upload(file, job_id, Path(file.filename).suffix)
+        await create_job(db, job_id, file.filename, path)
+        worker_pool.notify()
         
-        vector_service = VectorService(db)
-        chunks_count = await vector_service.add_document(file.filename, text_content)
-        
-        logger.info(f"Successfully uploaded {file.filename}: {chunks_count} chunks")
+        logger.info(f"Queued ingestion job {job_id} for {file.filename}")
         
         return DocumentUploadResponse(
+            job_id=job_id,
             filename=file.filename,
-            chunks_created=chunks_count,
-            status="success"
+            status=JOB_QUEUED
         )
     
     except HTTPException:
         raise
+    except DocumentRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
+        if path is not None:
+            path.unlink(missing_ok=True)
         logger.error(f"Error uploading document: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/documents/jobs/{job_id}", response_model=IngestionJobStatus)
+async def get_ingestion_job(
+    job_id: str,
+    db: AsyncSession = Depends(get_db)
+):
+    """Progress, throughput and error of an ingestion job"""
+    job = await db.get(IngestionJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+
 @router.get("/health", response_model=HealthResponse)
-async def health_check(db: Session = Depends(get_db)):
+async def health_check(
+    db: AsyncSession = Depends(get_db),
+    cache: CacheService = Depends(get_cache)
+):
     """Health check endpoint - verifies all services are operational"""
     
     try:
-        db.execute(text("SELECT 1"))
+        await db.execute(text("SELECT 1"))
         db_status = "ok"
     except Exception as e:
         logger.error(f"Database health check failed: {e}")
@@ -98,7 +171,6 @@ async def health_check(db: Session = Depends(get_db)):
     
     redis_status = "ok"
     try:
-        cache = CacheService()
         redis_ok = await cache.health_check()
         redis_status = "ok" if redis_ok else "error"
     except Exception as e:
@@ -106,7 +178,7 @@ async def health_check(db: Session = Depends(get_db)):
         redis_status = "error"
     
     try:
-        docs_count = db.query(func.count(Document.id)).scalar()
+        docs_count = await db.scalar(select(func.count(Document.id)))
     except Exception as e:
         logger.error(f"Failed to count documents: {e}")
         docs_count = 0
@@ -123,36 +195,52 @@ async def health_check(db: Session = Depends(get_db)):
 
 
 @router.get("/metrics")
-def get_metrics(db: Session = Depends(get_db)):
+async def get_metrics(
+    db: AsyncSession = Depends(get_db),
+    cache: CacheService = Depends(get_cache)
+):
     """Get service usage metrics and statistics"""
     
     try:
-        total_queries = db.query(func.count(QueryHistory.id)).scalar()
-        
-        if total_queries == 0:
-            return {
-                "total_queries": 0,
-                "avg_response_time_seconds": 0,
-                "avg_tokens_per_query": 0,
-                "total_tokens_used": 0,
-                "estimated_cost_usd": 0
-            }
+        # Инкрементальные rollups в Redis: фиксированное число hash, без сканирования query_history
+        rollups = await query_metrics.summary()
+        semantic_cache = await SemanticCacheService(db, cache.client).stats()
         
-        stats = db.query(
-            func.avg(QueryHistory.response_time).label('avg_time'),
-            func.avg(QueryHistory.tokens_used).label('avg_tokens'),
-            func.sum(QueryHistory.tokens_used).label('total_tokens')
-        ).first()
-        
-        total_tokens = int(stats.total_tokens or 0)
+        total_tokens = rollups["tokens"]
         estimated_cost = (total_tokens / 1000) * 0.002
+        generated = rollups["generated"]
+        
+        # Экономия токенов контекста от склейки соседних чанков и бюджета
+        total_context = rollups["context_tokens"]
+        total_saved = rollups["context_tokens_saved"]
+        saved_percent = 100 * total_saved / (total_context + total_saved) if total_saved else 0
         
         return {
-            "total_queries": total_queries,
-            "avg_response_time_seconds": round(float(stats.avg_time or 0), 3),
-            "avg_tokens_per_query": round(float(stats.avg_tokens or 0), 1),
+            "total_queries": rollups["queries"],
+            "avg_response_time_seconds": round(rollups["avg_response_time_ms"] / 1000, 3),
+            "response_time_ms": {
+                "p50": rollups["p50_ms"],
+                "p95": rollups["p95_ms"],
+                "p99": rollups["p99_ms"]
+            },
+            "cache_hit_rate": rollups["cache_hit_rate"],
+            "avg_tokens_per_query": rollups["avg_tokens_per_generated"],
             "total_tokens_used": total_tokens,
-            "estimated_cost_usd": round(estimated_cost, 4)
+            "estimated_cost_usd": round(estimated_cost, 4),
+            "context_tokens": {
+                "avg_per_query": round(total_context / generated, 1) if generated else 0,
+                "total_saved": total_saved,
+                "avg_saved_per_query": round(total_saved / generated, 1) if generated else 0,
+                "saved_percent": round(saved_percent, 1)
+            },
+            "last_hour": rollups["last_hour"],
+            "last_24h": rollups["last_24h"],
+            "semantic_cache": semantic_cache,
+            "singleflight": inflight.stats(),
+            "history_writer": history_writer.stats(),
+            "query_metrics": query_metrics.stats(),
+            "memory_index": memory_index.stats(),
+            "upstream": upstream_stats()
         }
     
     except Exception as e:
@@ -0,0 +1 @@
+"""Benchmarks for retrieval and serving performance"""
@@ -0,0 +1,159 @@
+"""
+ANN index benchmark: recall@k and latency of the pgvector index against an exact scan.
+
+    python -m app.benchmarks.ann_index --queries 200 --k 5 --ef-search 20 40 80 --probes 1 5 10
+
+Queries are stored chunk embeddings with a little gaussian noise added, so the
+benchmark needs no OpenAI calls and runs against whatever corpus is loaded.
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import func, select, text
+
+from app.config import get_settings
+from app.database import close_db, get_db_context
+from app.models import Document
+from app.services.vector_service import to_vector_literal
+from app.utils.metrics import latency_summary
+
+settings = get_settings()
+
+NEAREST_SQL = text("""
+    SELECT id
+    FROM documents
+    ORDER BY embedding <=> cast(:embedding as vector)
+    LIMIT :limit
+""")
+
+
+async def sample_queries(db, count: int, noise: float, seed: int) -> List[np.ndarray]:
+    """Random stored embeddings, perturbed so they are not exact matches of a row"""
+    await db.execute(text("SELECT setseed(:seed)"), {"seed": (seed % 1000) / 1000})
+    result = await db.execute(
+        select(Document.embedding).order_by(func.random()).limit(count)
+    )
+    rng = np.random.default_rng(seed)
+    queries = []
+    for (embedding,) in result:
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector + rng.normal(0, noise / np.sqrt(len(vector)), len(vector)).astype(np.float32)
+        queries.append(vector / np.linalg.norm(vector))
+    await db.rollback()
+    return queries
+
+
+async def timed_search(db, query: np.ndarray, k: int, gucs: Dict[str, str]) -> tuple:
+    """Run one top-k query inside its own transaction with the given planner settings"""
+    for name, value in gucs.items():
+        await db.execute(text("SELECT set_config(:name, :value, true)"), {"name": name, "value": value})
+    
+    start = time.perf_counter()
+    result = await db.execute(NEAREST_SQL, {"embedding": to_vector_literal(query), "limit": k})
+    ids = [row.id for row in result]
+    elapsed = time.perf_counter() - start
+    
+    await db.rollback()
+    return ids, elapsed
+
+
+async def run_benchmark(
+    queries_count: int,
+    k: int,
+    ef_search: List[int],
+    probes: List[int],
+    noise: float,
+    seed: int
+) -> Dict:
+    exact_gucs = {"enable_indexscan": "off", "enable_bitmapscan": "off"}
+    
+    if settings.vector_index_type == "hnsw":
+        configs = [("hnsw.ef_search", str(value)) for value in ef_search]
+    elif settings.vector_index_type == "ivfflat":
+        configs = [("ivfflat.probes", str(value)) for value in probes]
+    else:
+        configs = []
+    
+    async with get_db_context() as db:
+        rows = await db.scalar(select(func.count(Document.id)))
+        queries = await sample_queries(db, queries_count, noise, seed)
+        
+        if not queries:
+            raise SystemExit("No documents loaded, nothing to benchmark")
+        
+        exact_ids = []
+        exact_times = []
+        for query in queries:
+            ids, elapsed = await timed_search(db, query, k, exact_gucs)
+            exact_ids.append(set(ids))
+            exact_times.append(elapsed)
+        
+        report = {
+            "rows": rows,
+            "queries": len(queries),
+            "k": k,
+            "index_type": settings.vector_index_type,
+            "exact": latency_summary(exact_times),
+            "ann": []
+        }
+        
+        for name, value in configs:
+            times = []
+            recalls = []
+            for query, expected in zip(queries, exact_ids):
+                ids, elapsed = await timed_search(db, query, k, {name: value})
+                times.append(elapsed)
+                recalls.append(len(expected & set(ids)) / max(len(expected), 1))
+            
+            report["ann"].append({
+                name: int(value),
+                f"recall@{k}": round(sum(recalls) / len(recalls), 4),
+                **latency_summary(times)
+            })
+    
+    return report
+
+
+def print_report(report: Dict):
+    k = report["k"]
+    print(f"\nRows: {report['rows']} | queries: {report['queries']} | "
+          f"k: {k} | index: {report['index_type']}")
+    print("-" * 70)
+    exact = report["exact"]
+    print(f"{'exact scan':<24} recall@{k}: 1.0000  p50: {exact['p50_ms']:>8.2f}ms  "
+          f"p95: {exact['p95_ms']:>8.2f}ms")
+    for row in report["ann"]:
+        param, value = next(iter(row.items()))
+        print(f"{param + '=' + str(value):<24} recall@{k}: {row[f'recall@{k}']:.4f}  "
+              f"p50: {row['p50_ms']:>8.2f}ms  p95: {row['p95_ms']:>8.2f}ms")
+    print()
+
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=settings.top_k)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[20, 40, 80, 160])
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    
+    try:
+        report = await run_benchmark(args.queries, args.k, args.ef_search, args.probes, args.noise, args.seed)
+    finally:
+        await close_db()
+    
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
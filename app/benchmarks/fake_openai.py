@@ -0,0 +1,199 @@
+"""
+Local stand-in for the OpenAI embeddings and chat completions API, for load tests and
+offline runs of the service. Responses are deterministic; latency is configurable.
+
+    python -m app.benchmarks.fake_openai --port 9000 --embedding-latency 0.05 --chat-latency 0.4
+    OPENAI_BASE_URL=http://localhost:9000/v1 uvicorn app.main:app
+
+Embeddings hash word stems into the vector (the hashing trick), so texts sharing words
+are close and retrieval still behaves sensibly. A completion answers with the context
+sentence that shares the most words with the question.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.utils.text import SENTENCE_RE, word_stems
+
+DEFAULT_DIMENSIONS = 1536
+QUESTION_MARKER = "Вопрос пользователя:"
+
+
+@dataclass
+class FakeOpenAIConfig:
+    embedding_latency: float = 0.05  # seconds per embeddings request
+    chat_latency: float = 0.4        # seconds until the first completion token
+    token_latency: float = 0.01      # seconds per streamed chunk after the first
+    jitter: float = 0.2              # +/- fraction applied to every delay
+
+
+def count_tokens(text: str) -> int:
+    return max(len(text) // 4, 1) if text else 0
+
+
+def fake_embedding(text: str, dimensions: int = DEFAULT_DIMENSIONS) -> np.ndarray:
+    """Unit vector with +/-1 at hashed positions of the text's word stems"""
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for stem in word_stems(text):
+        digest = hashlib.blake2b(stem.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dimensions] += 1.0 if (value >> 63) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+
+def fake_answer(messages: List[dict]) -> str:
+    """Context sentence with the largest word overlap with the question"""
+    prompt = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    context, _, question = prompt.rpartition(QUESTION_MARKER)
+    if not context:
+        context, question = prompt, prompt
+    
+    wanted = set(word_stems(question))
+    best, best_score = "", 0
+    for sentence in SENTENCE_RE.split(context):
+        sentence = sentence.strip()
+        score = len(wanted & set(word_stems(sentence)))
+        if score > best_score:
+            best, best_score = sentence, score
+    return best or "К сожалению, в контексте нет ответа на этот вопрос."
+
+
+def create_app(config: FakeOpenAIConfig, seed: int = 0) -> FastAPI:
+    app = FastAPI(title="Fake OpenAI")
+    rng = random.Random(seed)
+    
+    async def delay(seconds: float):
+        if seconds > 0:
+            await asyncio.sleep(seconds * (1 + rng.uniform(-config.jitter, config.jitter)))
+    
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or DEFAULT_DIMENSIONS
+        as_base64 = body.get("encoding_format") == "base64"
+        
+        await delay(config.embedding_latency)
+        
+        data = []
+        for index, text in enumerate(texts):
+            vector = fake_embedding(str(text), dimensions)
+            embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode() if as_base64 else vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        
+        tokens = sum(count_tokens(str(text)) for text in texts)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+    
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        model = body.get("model", "gpt-3.5-turbo")
+        answer = fake_answer(messages)
+        
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+        completion_tokens = count_tokens(answer)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        pieces = re.findall(r"\S+\s*", answer) or [answer]
+        
+        if not body.get("stream"):
+            await delay(config.chat_latency + config.token_latency * (len(pieces) - 1))
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+        
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        
+        def chunk(delta: dict, finish_reason: Optional[str] = None, chunk_usage: Optional[dict] = None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [] if chunk_usage else [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+                "usage": chunk_usage
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        
+        async def events():
+            await delay(config.chat_latency)
+            yield chunk({"role": "assistant", "content": ""})
+            for i, piece in enumerate(pieces):
+                if i:
+                    await delay(config.token_latency)
+                yield chunk({"content": piece})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk({}, chunk_usage=usage)
+            yield "data: [DONE]\n\n"
+        
+        return StreamingResponse(events(), media_type="text/event-stream")
+    
+    return app
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Tuple[argparse.Namespace, FakeOpenAIConfig]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--embedding-latency", type=float, default=FakeOpenAIConfig.embedding_latency)
+    parser.add_argument("--chat-latency", type=float, default=FakeOpenAIConfig.chat_latency)
+    parser.add_argument("--token-latency", type=float, default=FakeOpenAIConfig.token_latency)
+    parser.add_argument("--jitter", type=float, default=FakeOpenAIConfig.jitter)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency jitter")
+    args = parser.parse_args(argv)
+    return args, FakeOpenAIConfig(
+        embedding_latency=args.embedding_latency,
+        chat_latency=args.chat_latency,
+        token_latency=args.token_latency,
+        jitter=args.jitter
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    import uvicorn
+    
+    args, config = parse_args(argv)
+    uvicorn.run(create_app(config, args.seed), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
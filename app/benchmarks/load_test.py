@@ -0,0 +1,241 @@
+"""
+Load test of a running API: requests/sec and p50/p95/p99 per scenario at fixed concurrency.
+
+    python -m app.benchmarks.fake_openai --port 9000 &
+    OPENAI_BASE_URL=http://localhost:9000/v1 uvicorn app.main:app --port 8000 &
+    python -m app.benchmarks.load_test --requests 500 --concurrency 16 --output load.json
+
+Scenarios:
+    health      GET /api/health
+    ask_hit     POST /api/ask with questions asked once before measuring (exact cache hits)
+    ask_miss    POST /api/ask with a unique suffix per request (full RAG pipeline)
+    ask_mixed   ask_hit / ask_miss mix, --hit-ratio of requests are hits
+    documents   POST /api/documents with generated loadtest-*.txt files (opt-in: they are ingested)
+
+The reported cache_hit_ratio is what the API answered (`cached`), so semantic cache hits
+among ask_miss requests show up there. Pass --baseline with an earlier report to print
+the change in requests/sec and latency.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from app.utils.metrics import latency_summary
+
+SCENARIOS = ("health", "ask_hit", "ask_miss", "ask_mixed", "documents")
+DEFAULT_SCENARIOS = ("health", "ask_hit", "ask_miss", "ask_mixed")
+
+QUESTIONS = [
+    "Как создать задачу?",
+    "Где хранятся данные?",
+    "Какие интеграции поддерживаются?",
+    "Как получить список задач через API?",
+    "Какие есть тарифные планы?",
+    "Что делать если не приходят уведомления?",
+    "Какой максимальный размер файла?",
+    "Как пригласить участника в проект?",
+]
+
+DOCUMENT_TEMPLATE = (
+    "Нагрузочный тест {run_id}, документ {index}. SmartTask позволяет создавать задачи, "
+    "назначать исполнителей и отслеживать сроки. Уведомления приходят по email и в Slack. "
+)
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    concurrency: int
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    cached: int = 0
+    answered: int = 0
+    seconds: float = 0.0
+    
+    def to_dict(self) -> Dict:
+        requests = len(self.latencies) + self.errors
+        report = {
+            "requests": requests,
+            "errors": self.errors,
+            "concurrency": self.concurrency,
+            "seconds": round(self.seconds, 3),
+            "requests_per_second": round(requests / self.seconds, 1) if self.seconds else 0.0,
+            **latency_summary(self.latencies),
+        }
+        if self.answered:
+            report["cache_hit_ratio"] = round(self.cached / self.answered, 4)
+        return report
+
+
+async def run_scenario(
+    name: str,
+    send: Callable[[int], Awaitable[httpx.Response]],
+    requests: int,
+    concurrency: int
+) -> ScenarioResult:
+    """Issue `requests` calls of send(i) from `concurrency` workers; only successful calls are timed"""
+    result = ScenarioResult(name, concurrency)
+    counter = iter(range(requests))
+    
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                response = await send(i)
+                elapsed = time.perf_counter() - start
+                if response.status_code >= 400:
+                    result.errors += 1
+                    continue
+            except httpx.HTTPError:
+                result.errors += 1
+                continue
+            result.latencies.append(elapsed)
+            if name.startswith("ask"):
+                result.answered += 1
+                result.cached += bool(response.json().get("cached"))
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def unique_question(i: int, rng: random.Random, run_id: str) -> str:
+    # Несколько уникальных слов, чтобы вопрос не совпал и по семантическому кэшу
+    return f"{rng.choice(QUESTIONS)} Вариант {run_id} {i} {uuid.uuid4().hex[:8]}"
+
+
+async def run_load_test(
+    base_url: str,
+    scenarios: List[str],
+    requests: int,
+    concurrency: int,
+    hit_ratio: float,
+    seed: int,
+    timeout: float,
+    transport: Optional[httpx.AsyncBaseTransport] = None
+) -> Dict:
+    rng = random.Random(seed)
+    run_id = uuid.uuid4().hex[:6]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = {}
+    
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits, transport=transport) as client:
+        async def ask(question: str) -> httpx.Response:
+            return await client.post("/api/ask", json={"question": question})
+        
+        if any(name in ("ask_hit", "ask_mixed") for name in scenarios):
+            # Прогрев: каждый вопрос один раз, дальше они отвечаются из кэша
+            for question in QUESTIONS:
+                await ask(question)
+        
+        senders = {
+            "health": lambda i: client.get("/api/health"),
+            "ask_hit": lambda i: ask(QUESTIONS[i % len(QUESTIONS)]),
+            "ask_miss": lambda i: ask(unique_question(i, rng, run_id)),
+            "ask_mixed": lambda i: ask(
+                QUESTIONS[i % len(QUESTIONS)] if rng.random() < hit_ratio else unique_question(i, rng, run_id)
+            ),
+            "documents": lambda i: client.post(
+                "/api/documents",
+                files={"file": (
+                    f"loadtest-{run_id}-{i}.txt",
+                    (DOCUMENT_TEMPLATE.format(run_id=run_id, index=i) * 20).encode("utf-8"),
+                    "text/plain"
+                )}
+            ),
+        }
+        
+        for name in scenarios:
+            result = await run_scenario(name, senders[name], requests, concurrency)
+            results[name] = result.to_dict()
+            print_scenario(name, results[name])
+    
+    return {
+        "run": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "base_url": base_url,
+            "requests": requests,
+            "concurrency": concurrency,
+            "hit_ratio": hit_ratio,
+        },
+        "scenarios": results
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(current: Dict, baseline: Dict) -> Dict:
+    """Relative change (current / baseline) of throughput and latency per shared scenario"""
+    changes = {}
+    for name, row in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        changes[name] = {
+            metric: round(row[metric] / before[metric], 3) if before.get(metric) else None
+            for metric in ("requests_per_second", "p50_ms", "p95_ms", "p99_ms")
+        }
+    return changes
+
+
+def print_scenario(name: str, row: Dict):
+    hit = f"  cached: {row['cache_hit_ratio']:.0%}" if "cache_hit_ratio" in row else ""
+    print(f"{name:<10} {row['requests']:>6} req  {row['errors']:>4} err  "
+          f"{row['requests_per_second']:>8.1f} req/s  p50: {row['p50_ms']:>8.1f}ms  "
+          f"p95: {row['p95_ms']:>8.1f}ms  p99: {row['p99_ms']:>8.1f}ms{hit}")
+
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(DEFAULT_SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--hit-ratio", type=float, default=0.8, help="Share of cache hits in ask_mixed")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+    
+    report = await run_load_test(
+        args.base_url, args.scenarios, args.requests, args.concurrency,
+        args.hit_ratio, args.seed, args.timeout
+    )
+    
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        report["compared_to"] = {
+            "git_commit": baseline.get("run", {}).get("git_commit"),
+            "ratios": compare_reports(report, baseline)
+        }
+        print(f"\nCurrent / baseline ({report['compared_to']['git_commit']}):")
+        for name, ratios in report["compared_to"]["ratios"].items():
+            print(f"  {name:<10} " + "  ".join(f"{metric}: {value}x" for metric, value in ratios.items()))
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
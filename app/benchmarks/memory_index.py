@@ -0,0 +1,130 @@
+"""
+In-process retrieval benchmark: NumPy memory index against the pgvector SQL path.
+
+    python -m app.benchmarks.memory_index --queries 200 --k 5 --output memory_index.json
+
+Both paths are scored against an exact SQL scan (recall@k) and timed per query.
+Queries are perturbed stored embeddings, so no OpenAI calls are needed.
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select, text
+
+from app.benchmarks.ann_index import sample_queries
+from app.config import get_settings
+from app.database import close_db, get_db_context
+from app.models import Document
+from app.services.memory_index import MemoryIndex
+from app.services.vector_service import VectorService
+from app.utils.metrics import latency_summary
+
+settings = get_settings()
+
+
+async def sql_search(service: VectorService, query: List[float], k: int, exact: bool = False) -> tuple:
+    if exact:
+        await service.db.execute(text("SET LOCAL enable_indexscan = off"))
+        await service.db.execute(text("SET LOCAL enable_bitmapscan = off"))
+    
+    start = time.perf_counter()
+    results = await service.search_by_embedding(query, k)
+    elapsed = time.perf_counter() - start
+    
+    await service.db.rollback()
+    return [tuple(result[:2]) for result in results], elapsed
+
+
+def recall(expected: List[set], found: List[list]) -> float:
+    scores = [len(e & set(f)) / max(len(e), 1) for e, f in zip(expected, found)]
+    return round(sum(scores) / len(scores), 4)
+
+
+async def run_benchmark(queries_count: int, k: int, noise: float, seed: int, directory: str) -> Dict:
+    async with get_db_context() as db:
+        rows = await db.scalar(select(func.count(Document.id)))
+        queries = [q.tolist() for q in await sample_queries(db, queries_count, noise, seed)]
+        
+        if not queries:
+            raise SystemExit("No documents loaded, nothing to benchmark")
+        
+        # Модульный memory_index в этом процессе не загружен, поэтому VectorService идёт в Postgres
+        service = VectorService(db)
+        
+        exact = []
+        for query in queries:
+            found, _ = await sql_search(service, query, k, exact=True)
+            exact.append(set(found))
+        
+        sql_found, sql_times = [], []
+        for query in queries:
+            found, elapsed = await sql_search(service, query, k)
+            sql_found.append(found)
+            sql_times.append(elapsed)
+        
+        index = MemoryIndex(directory)
+        load_start = time.perf_counter()
+        await index.load(db)
+        load_seconds = time.perf_counter() - load_start
+    
+    memory_found, memory_times = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results = index.search(query, k)
+        memory_times.append(time.perf_counter() - start)
+        memory_found.append([tuple(result[:2]) for result in results])
+    
+    sql_summary = latency_summary(sql_times)
+    memory_summary = latency_summary(memory_times)
+    
+    return {
+        "rows": rows,
+        "queries": len(queries),
+        "k": k,
+        "index_type": settings.vector_index_type,
+        "memory_index_load_seconds": round(load_seconds, 3),
+        "pgvector": {f"recall@{k}": recall(exact, sql_found), **sql_summary},
+        "memory": {f"recall@{k}": recall(exact, memory_found), **memory_summary},
+        "p50_speedup": round(sql_summary["p50_ms"] / memory_summary["p50_ms"], 1)
+        if memory_summary["p50_ms"] else None
+    }
+
+
+def print_report(report: Dict):
+    k = report["k"]
+    print(f"\nRows: {report['rows']} | queries: {report['queries']} | k: {k} | "
+          f"index: {report['index_type']} | memory index load: {report['memory_index_load_seconds']}s")
+    print("-" * 70)
+    for name in ("pgvector", "memory"):
+        row = report[name]
+        print(f"{name:<12} recall@{k}: {row[f'recall@{k}']:.4f}  p50: {row['p50_ms']:>8.3f}ms  "
+              f"p95: {row['p95_ms']:>8.3f}ms  p99: {row['p99_ms']:>8.3f}ms")
+    print(f"p50 speedup: {report['p50_speedup']}x\n")
+
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=settings.top_k)
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dir", default=settings.memory_index_dir, help="Snapshot directory")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    
+    try:
+        report = await run_benchmark(args.queries, args.k, args.noise, args.seed, args.dir)
+    finally:
+        await close_db()
+    
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
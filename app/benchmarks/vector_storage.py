@@ -0,0 +1,183 @@
+"""
+Compact vector storage benchmark: vector vs halfvec vs binary quantization + rerank.
+
+    python -m app.benchmarks.vector_storage --queries 200 --k 5 --candidates 20 40 80 --output storage.json
+
+For every mode the ANN index (VECTOR_INDEX_TYPE) is built on the mode's expression inside
+a transaction that is rolled back afterwards, so the live index is left untouched (the
+documents table is locked while a mode is measured). Reported per mode: bytes per indexed
+vector, index size, build time, recall@k against an exact scan and latency, both for the
+first stage alone and after reranking each candidate count at full precision.
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import func, select, text
+
+from app.benchmarks.ann_index import sample_queries
+from app.benchmarks.memory_index import recall
+from app.config import get_settings
+from app.database import (
+    VECTOR_STORAGE_OPS, close_db, get_db_context, vector_index_expression, vector_index_name, vector_index_spec
+)
+from app.models import Document
+from app.services.vector_service import nearest_chunks_sql, to_vector_literal
+from app.utils.metrics import latency_summary
+
+settings = get_settings()
+
+BENCH_INDEX = "ix_documents_embedding_storage_bench"
+
+
+async def nearest_ids(db, storage: str, query: np.ndarray, k: int, candidates: int) -> tuple:
+    sql = text(f"SELECT id FROM ({nearest_chunks_sql(storage, settings.embedding_dimensions)}) nearest")
+    start = time.perf_counter()
+    result = await db.execute(sql, {
+        "embedding": to_vector_literal(query),
+        "candidates": candidates,
+        "nearest_limit": k
+    })
+    ids = [row.id for row in result]
+    return ids, time.perf_counter() - start
+
+
+async def measure_mode(
+    db,
+    storage: str,
+    queries: List[np.ndarray],
+    exact: List[set],
+    k: int,
+    candidates: List[int]
+) -> Dict:
+    dims = settings.embedding_dimensions
+    expression, _ = VECTOR_STORAGE_OPS[storage]
+    expression = expression.format(column="embedding", dims=dims)
+    spec = vector_index_spec()
+    
+    try:
+        # Текущие ANN индексы убираем только внутри транзакции, ROLLBACK их вернёт
+        for mode in VECTOR_STORAGE_OPS:
+            await db.execute(text(f"DROP INDEX IF EXISTS {vector_index_name('documents', storage=mode)}"))
+        
+        build_seconds = 0.0
+        index_bytes = 0
+        if spec is not None:
+            method, params = spec
+            with_clause = ", ".join(f"{key} = {int(value)}" for key, value in params.items())
+            await db.execute(text("SELECT set_config('maintenance_work_mem', :mem, true)"),
+                             {"mem": settings.index_maintenance_work_mem})
+            build_start = time.perf_counter()
+            await db.execute(text(
+                f"CREATE INDEX {BENCH_INDEX} ON documents "
+                f"USING {method} ({vector_index_expression('embedding', storage, dims)}) WITH ({with_clause})"
+            ))
+            build_seconds = time.perf_counter() - build_start
+            index_bytes = await db.scalar(text(f"SELECT pg_relation_size('{BENCH_INDEX}')"))
+        
+        bytes_per_vector = await db.scalar(text(
+            f"SELECT avg(pg_column_size({expression}))::int FROM documents WHERE embedding IS NOT NULL"
+        ))
+        
+        runs = []
+        # candidates == k: только первый этап, без выигрыша от rerank
+        for count in sorted({k, *candidates}):
+            await db.execute(text("SELECT set_config('hnsw.ef_search', :value, true)"),
+                             {"value": str(max(settings.hnsw_ef_search, count))})
+            found, times = [], []
+            for query in queries:
+                ids, elapsed = await nearest_ids(db, storage, query, k, count)
+                found.append(ids)
+                times.append(elapsed)
+            runs.append({"candidates": count, f"recall@{k}": recall(exact, found), **latency_summary(times)})
+    finally:
+        await db.rollback()
+    
+    return {
+        "storage": storage,
+        "bytes_per_vector": bytes_per_vector,
+        "index_bytes": index_bytes,
+        "index_build_seconds": round(build_seconds, 3),
+        "runs": runs
+    }
+
+
+async def run_benchmark(
+    queries_count: int,
+    k: int,
+    candidates: List[int],
+    modes: List[str],
+    noise: float,
+    seed: int
+) -> Dict:
+    async with get_db_context() as db:
+        rows = await db.scalar(select(func.count(Document.id)))
+        table_bytes = await db.scalar(text("SELECT pg_table_size('documents')"))
+        queries = await sample_queries(db, queries_count, noise, seed)
+        
+        if not queries:
+            raise SystemExit("No documents loaded, nothing to benchmark")
+        
+        exact = []
+        for query in queries:
+            await db.execute(text("SET LOCAL enable_indexscan = off"))
+            await db.execute(text("SET LOCAL enable_bitmapscan = off"))
+            ids, _ = await nearest_ids(db, "vector", query, k, k)
+            exact.append(set(ids))
+            await db.rollback()
+        
+        results = [await measure_mode(db, storage, queries, exact, k, candidates) for storage in modes]
+    
+    return {
+        "rows": rows,
+        "queries": len(queries),
+        "k": k,
+        "dimensions": settings.embedding_dimensions,
+        "index_type": settings.vector_index_type,
+        "table_bytes": table_bytes,
+        "modes": results
+    }
+
+
+def print_report(report: Dict):
+    k = report["k"]
+    print(f"\nRows: {report['rows']} | queries: {report['queries']} | k: {k} | "
+          f"dimensions: {report['dimensions']} | index: {report['index_type']} | "
+          f"table: {report['table_bytes'] / 2**20:.1f} MiB")
+    print("-" * 90)
+    for mode in report["modes"]:
+        print(f"{mode['storage']:<8} {mode['bytes_per_vector']} B/vector  "
+              f"index: {mode['index_bytes'] / 2**20:.1f} MiB (built in {mode['index_build_seconds']}s)")
+        for run in mode["runs"]:
+            print(f"    candidates={run['candidates']:<5} recall@{k}: {run[f'recall@{k}']:.4f}  "
+                  f"p50: {run['p50_ms']:>8.2f}ms  p95: {run['p95_ms']:>8.2f}ms")
+    print()
+
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=settings.top_k)
+    parser.add_argument("--candidates", type=int, nargs="+", default=[settings.rerank_candidates])
+    parser.add_argument("--modes", nargs="+", choices=list(VECTOR_STORAGE_OPS), default=list(VECTOR_STORAGE_OPS))
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    
+    try:
+        report = await run_benchmark(args.queries, args.k, args.candidates, args.modes, args.noise, args.seed)
+    finally:
+        await close_db()
+    
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
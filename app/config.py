@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
 from functools import lru_cache
+from typing import Literal, Optional
 
 
 class Settings(BaseSettings):
@@ -13,7 +14,25 @@ class Settings(BaseSettings):
     # OpenAI
     openai_api_key: str = Field(..., alias="OPENAI_API_KEY")
     openai_model: str = Field("gpt-3.5-turbo", alias="OPENAI_MODEL")
+    openai_base_url: Optional[str] = Field(None, alias="OPENAI_BASE_URL")  # e.g. the local fake for load tests
     embedding_model: str = Field("text-embedding-3-small", alias="EMBEDDING_MODEL")
+    embedding_dimensions: int = Field(1536, alias="EMBEDDING_DIMENSIONS")
+    # Record/replay of OpenAI calls in an SQLite file (evaluation and regression runs)
+    llm_record_mode: Literal["off", "record", "replay"] = Field("off", alias="LLM_RECORD_MODE")
+    llm_record_path: str = Field("llm_recordings.sqlite3", alias="LLM_RECORD_PATH")
+    
+    # OpenAI tail latency: client timeout/retries, per-stage deadlines, hedging, circuit breaker
+    openai_timeout: float = Field(30.0, alias="OPENAI_TIMEOUT")
+    openai_max_retries: int = Field(1, alias="OPENAI_MAX_RETRIES")
+    embedding_deadline: float = Field(5.0, alias="EMBEDDING_DEADLINE")
+    generation_deadline: float = Field(20.0, alias="GENERATION_DEADLINE")  # для потока — до начала ответа
+    embedding_hedge_enabled: bool = Field(True, alias="EMBEDDING_HEDGE_ENABLED")
+    embedding_hedge_percentile: float = Field(95.0, alias="EMBEDDING_HEDGE_PERCENTILE")
+    embedding_hedge_min_delay: float = Field(0.05, alias="EMBEDDING_HEDGE_MIN_DELAY")
+    embedding_hedge_min_samples: int = Field(20, alias="EMBEDDING_HEDGE_MIN_SAMPLES")
+    circuit_failure_threshold: int = Field(5, alias="CIRCUIT_FAILURE_THRESHOLD")
+    circuit_reset_timeout: float = Field(30.0, alias="CIRCUIT_RESET_TIMEOUT")
+    fallback_cache_threshold: float = Field(0.85, alias="FALLBACK_CACHE_THRESHOLD")
     
     # PostgreSQL
     postgres_user: str = Field(..., alias="POSTGRES_USER")
@@ -21,11 +40,17 @@ class Settings(BaseSettings):
     postgres_db: str = Field(..., alias="POSTGRES_DB")
     postgres_host: str = Field("postgres", alias="POSTGRES_HOST")
     postgres_port: int = Field(5432, alias="POSTGRES_PORT")
+    db_pool_size: int = Field(10, alias="DB_POOL_SIZE")
+    db_max_overflow: int = Field(20, alias="DB_MAX_OVERFLOW")
+    db_pool_timeout: float = Field(30.0, alias="DB_POOL_TIMEOUT")
+    db_pool_recycle: int = Field(1800, alias="DB_POOL_RECYCLE")
     
     # Redis
     redis_host: str = Field("redis", alias="REDIS_HOST")
     redis_port: int = Field(6379, alias="REDIS_PORT")
     redis_ttl: int = Field(3600, alias="REDIS_TTL")
+    redis_max_connections: int = Field(50, alias="REDIS_MAX_CONNECTIONS")
+    redis_socket_timeout: float = Field(5.0, alias="REDIS_SOCKET_TIMEOUT")
     
     # App
     app_host: str = Field("0.0.0.0", alias="APP_HOST")
@@ -37,12 +62,93 @@ class Settings(BaseSettings):
     chunk_overlap: int = 200
     top_k: int = 3
     
+    # Semantic cache
+    semantic_cache_enabled: bool = Field(True, alias="SEMANTIC_CACHE_ENABLED")
+    semantic_cache_threshold: float = Field(0.92, alias="SEMANTIC_CACHE_THRESHOLD")
+    semantic_cache_ttl: int = Field(86400, alias="SEMANTIC_CACHE_TTL")
+    semantic_cache_purge_interval: float = Field(600.0, alias="SEMANTIC_CACHE_PURGE_INTERVAL")
+    
+    # Vector index (pgvector ANN)
+    vector_index_type: Literal["hnsw", "ivfflat", "none"] = Field("hnsw", alias="VECTOR_INDEX_TYPE")
+    hnsw_m: int = Field(16, alias="HNSW_M")
+    hnsw_ef_construction: int = Field(64, alias="HNSW_EF_CONSTRUCTION")
+    hnsw_ef_search: int = Field(40, alias="HNSW_EF_SEARCH")
+    ivfflat_lists: int = Field(100, alias="IVFFLAT_LISTS")
+    ivfflat_probes: int = Field(10, alias="IVFFLAT_PROBES")
+    index_maintenance_work_mem: str = Field("256MB", alias="INDEX_MAINTENANCE_WORK_MEM")
+    # Первый этап поиска по documents: полная точность, halfvec или бинарное квантование + rerank
+    vector_storage: Literal["vector", "halfvec", "binary"] = Field("vector", alias="VECTOR_STORAGE")
+    rerank_candidates: int = Field(40, alias="RERANK_CANDIDATES")
+    
+    # Request coalescing
+    singleflight_redis_lock: bool = Field(False, alias="SINGLEFLIGHT_REDIS_LOCK")
+    singleflight_lock_ttl: float = Field(30.0, alias="SINGLEFLIGHT_LOCK_TTL")
+    singleflight_wait_timeout: float = Field(30.0, alias="SINGLEFLIGHT_WAIT_TIMEOUT")
+    singleflight_poll_interval: float = Field(0.05, alias="SINGLEFLIGHT_POLL_INTERVAL")
+    
+    # Query history write-behind
+    history_queue_size: int = Field(10000, alias="HISTORY_QUEUE_SIZE")
+    history_batch_size: int = Field(100, alias="HISTORY_BATCH_SIZE")
+    history_flush_interval: float = Field(1.0, alias="HISTORY_FLUSH_INTERVAL")
+    
+    # Query metrics rollups in Redis
+    metrics_flush_interval: float = Field(1.0, alias="METRICS_FLUSH_INTERVAL")
+    
+    # Query embedding cache (in-process LRU + Redis)
+    embedding_cache_size: int = Field(10000, alias="EMBEDDING_CACHE_SIZE")
+    embedding_cache_ttl: int = Field(604800, alias="EMBEDDING_CACHE_TTL")
+    
+    # Retrieval: pure vector search or vector + full-text merged with reciprocal rank fusion
+    search_mode: Literal["vector", "hybrid"] = Field("hybrid", alias="SEARCH_MODE")
+    hybrid_candidates: int = Field(20, alias="HYBRID_CANDIDATES")
+    hybrid_rrf_k: int = Field(60, alias="HYBRID_RRF_K")
+    
+    # Prompt context: max tokens of retrieved text sent to the LLM (0 = no limit)
+    context_token_budget: int = Field(1500, alias="CONTEXT_TOKEN_BUDGET")
+    
+    # Batch questions (/api/ask/batch)
+    batch_max_questions: int = Field(50, alias="BATCH_MAX_QUESTIONS")
+    batch_generation_concurrency: int = Field(4, alias="BATCH_GENERATION_CONCURRENCY")
+    
+    # In-process retrieval (NumPy matrix instead of a pgvector round trip)
+    memory_index_enabled: bool = Field(False, alias="MEMORY_INDEX_ENABLED")
+    memory_index_dir: str = Field("index_cache", alias="MEMORY_INDEX_DIR")
+    memory_index_refresh_interval: float = Field(30.0, alias="MEMORY_INDEX_REFRESH_INTERVAL")
+    
+    # Ingestion
+    max_upload_size_mb: int = Field(100, alias="MAX_UPLOAD_SIZE_MB")
+    upload_dir: str = Field("uploads", alias="UPLOAD_DIR")
+    ingestion_workers: int = Field(2, alias="INGESTION_WORKERS")
+    ingestion_poll_interval: float = Field(2.0, alias="INGESTION_POLL_INTERVAL")
+    ingestion_stale_after: float = Field(300.0, alias="INGESTION_STALE_AFTER")
+    ingestion_max_attempts: int = Field(3, alias="INGESTION_MAX_ATTEMPTS")
+    startup_ingest_concurrency: int = Field(4, alias="STARTUP_INGEST_CONCURRENCY")
+    embedding_batch_size: int = Field(100, alias="EMBEDDING_BATCH_SIZE")
+    embedding_concurrency: int = Field(4, alias="EMBEDDING_CONCURRENCY")
+    embedding_max_retries: int = Field(3, alias="EMBEDDING_MAX_RETRIES")
+    embedding_retry_backoff: float = Field(1.0, alias="EMBEDDING_RETRY_BACKOFF")
+    
+    @property
+    def embedding_model_key(self) -> str:
+        """Model + output size used in cache keys, so vectors of different sizes never mix"""
+        # 1536 — размер до появления настройки: существующие ключи остаются валидными
+        if self.embedding_dimensions == 1536:
+            return self.embedding_model
+        return f"{self.embedding_model}:{self.embedding_dimensions}"
+    
     @property
     def database_url(self) -> str:
         return (
             f"postgresql://{self.postgres_user}:{self.postgres_password}"
             f"@{self.postgres_host}:{self.postgres_port}/{self.postgres_db}"
         )
+    
+    @property
+    def async_database_url(self) -> str:
+        return (
+            f"postgresql+asyncpg://{self.postgres_user}:{self.postgres_password}"
+            f"@{self.postgres_host}:{self.postgres_port}/{self.postgres_db}"
+        )
 
 
 @lru_cache()
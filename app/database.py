@@ -1,48 +1,225 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import (
+    create_async_engine, async_sessionmaker, AsyncSession, AsyncConnection
+)
 from app.config import get_settings
-from app.models import Base
-from typing import Generator
-from contextlib import contextmanager
+from app.models import Base, TEXT_SEARCH_CONFIG
+from app.utils.logger import logger
+from typing import AsyncGenerator, Optional, Tuple
+from contextlib import asynccontextmanager
 
 settings = get_settings()
 
-engine = create_engine(
-    settings.database_url,
+engine = create_async_engine(
+    settings.async_database_url,
     pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=20
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    connect_args={
+        # Параметры поиска ANN задаются на уровне соединения, без лишнего round trip на запрос
+        "server_settings": {
+            # При компактном хранении первый этап должен вернуть RERANK_CANDIDATES строк
+            "hnsw.ef_search": str(
+                settings.hnsw_ef_search if settings.vector_storage == "vector"
+                else max(settings.hnsw_ef_search, settings.rerank_candidates)
+            ),
+            "ivfflat.probes": str(settings.ivfflat_probes),
+        }
+    }
+)
+
+# Таблицы с колонкой embedding, для которых поддерживается ANN индекс
+VECTOR_TABLES = ("documents", "semantic_cache")
+
+# Все колонки vector(EMBEDDING_DIMENSIONS)
+EMBEDDING_TABLES = ("documents", "chunk_embeddings", "semantic_cache")
+
+# Режим хранения -> (индексируемое выражение, opclass); колонка всегда остаётся vector для rerank
+VECTOR_STORAGE_OPS = {
+    "vector": ("{column}", "vector_cosine_ops"),
+    "halfvec": ("({column}::halfvec({dims}))", "halfvec_cosine_ops"),
+    "binary": ("(binary_quantize({column})::bit({dims}))", "bit_hamming_ops"),
+}
+
+# Идемпотентные изменения схемы для уже существующих таблиц (create_all не добавляет колонки)
+SCHEMA_MIGRATIONS = [
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS file_hash VARCHAR(64)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS source VARCHAR(16) NOT NULL DEFAULT 'upload'",
+    "CREATE INDEX IF NOT EXISTS ix_documents_filename ON documents (filename)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS job_id VARCHAR(36)",
+    "CREATE INDEX IF NOT EXISTS ix_documents_job_id ON documents (job_id)",
+    # Полнотекстовый индекс для гибридного поиска (колонка генерируется из content)
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(content, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_documents_content_tsv ON documents USING gin (content_tsv)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS token_count INTEGER",
+    "ALTER TABLE query_history ADD COLUMN IF NOT EXISTS context_tokens INTEGER",
+    "ALTER TABLE query_history ADD COLUMN IF NOT EXISTS context_tokens_saved INTEGER",
+]
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def vector_index_spec() -> Optional[Tuple[str, dict]]:
+    """Access method and storage parameters of the ANN index configured in Settings"""
+    if settings.vector_index_type == "hnsw":
+        return "hnsw", {"m": settings.hnsw_m, "ef_construction": settings.hnsw_ef_construction}
+    if settings.vector_index_type == "ivfflat":
+        return "ivfflat", {"lists": settings.ivfflat_lists}
+    return None
+
+
+def table_vector_storage(table: str) -> str:
+    """VECTOR_STORAGE applies to documents only; the other tables are small and keep full vectors"""
+    return settings.vector_storage if table == "documents" else "vector"
+
+
+def vector_index_name(table: str = "documents", column: str = "embedding", storage: Optional[str] = None) -> str:
+    storage = storage or table_vector_storage(table)
+    suffix = "" if storage == "vector" else f"_{storage}"
+    return f"ix_{table}_{column}_ann{suffix}"
+
+
+def vector_index_expression(column: str, storage: str, dims: int) -> str:
+    expression, opclass = VECTOR_STORAGE_OPS[storage]
+    return f"{expression.format(column=column, dims=dims)} {opclass}"
 
 
-def init_db():
-    """Создаём таблицы и pgvector extension"""
-    with engine.connect() as conn:
-        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
-        conn.commit()
-    Base.metadata.create_all(bind=engine)
+async def column_dimensions(conn: AsyncConnection, table: str, column: str = "embedding") -> Optional[int]:
+    """Declared size of a vector column (None if the table does not exist yet)"""
+    result = await conn.execute(text("""
+        SELECT a.atttypmod
+        FROM pg_attribute a
+        WHERE a.attrelid = to_regclass(:table) AND a.attname = :column AND NOT a.attisdropped
+    """), {"table": table, "column": column})
+    dims = result.scalar()
+    return dims if dims and dims > 0 else None
 
-def get_db() -> Generator[Session, None, None]:
+
+async def ensure_vector_index(
+    conn: AsyncConnection,
+    table: str = "documents",
+    column: str = "embedding",
+    rebuild: bool = False
+):
+    """
+    Создаём ANN индекс (cosine ops) или пересоздаём его, если изменились параметры.
+    Индексы других режимов VECTOR_STORAGE для этой колонки удаляются.
+    """
+    storage = table_vector_storage(table)
+    index_name = vector_index_name(table, column, storage)
+    spec = vector_index_spec()
+    
+    for other in VECTOR_STORAGE_OPS:
+        if other != storage:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {vector_index_name(table, column, other)}"))
+    
+    result = await conn.execute(text("""
+        SELECT am.amname, c.reloptions
+        FROM pg_class c
+        JOIN pg_am am ON am.oid = c.relam
+        WHERE c.relname = :name AND c.relkind = 'i'
+    """), {"name": index_name})
+    current = result.first()
+    
+    if spec is None:
+        if current is not None:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            logger.info(f"Dropped vector index {index_name}")
+        return
+    
+    method, params = spec
+    expected_options = sorted(f"{key}={value}" for key, value in params.items())
+    
+    if current is not None and not rebuild:
+        if current.amname == method and sorted(current.reloptions or []) == expected_options:
+            return
+    
+    if current is not None:
+        await conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+    
+    with_clause = ", ".join(f"{key} = {int(value)}" for key, value in params.items())
+    await conn.execute(text(
+        "SELECT set_config('maintenance_work_mem', :mem, true)"
+    ), {"mem": settings.index_maintenance_work_mem})
+    await conn.execute(text(
+        f"CREATE INDEX {index_name} ON {table} "
+        f"USING {method} ({vector_index_expression(column, storage, settings.embedding_dimensions)}) "
+        f"WITH ({with_clause})"
+    ))
+    logger.info(f"Built {method} index {index_name} on {storage} ({with_clause})")
+
+
+async def init_db():
+    """Создаём таблицы, pgvector extension, применяем миграции и ANN индекс"""
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_MIGRATIONS:
+            await conn.execute(text(statement))
+        
+        # create_all не меняет тип колонки: другой размер требует явной миграции
+        dims = await column_dimensions(conn, "documents")
+        if dims is not None and dims != settings.embedding_dimensions:
+            raise RuntimeError(
+                f"documents.embedding is vector({dims}) but EMBEDDING_DIMENSIONS={settings.embedding_dimensions}; "
+                "run `python -m app.services.dimension_migration` first"
+            )
+        
+        for table in VECTOR_TABLES:
+            await ensure_vector_index(conn, table)
+
+
+async def rebuild_vector_index():
+    """Принудительно пересобираем ANN индексы (например, после массовой загрузки)"""
+    async with engine.begin() as conn:
+        for table in VECTOR_TABLES:
+            await ensure_vector_index(conn, table, rebuild=True)
+
+
+async def close_db():
+    """Закрываем пул соединений при остановке приложения"""
+    await engine.dispose()
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """
     Dependency для FastAPI endpoints
     """
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-@contextmanager
-def get_db_context() -> Generator[Session, None, None]:
+@asynccontextmanager
+async def get_db_context() -> AsyncGenerator[AsyncSession, None]:
     """
-    Контекстный менеджер для использования с 'with' statement
-    Используйте это в main.py и других местах, где нужен with
+    Асинхронный контекстный менеджер для использования с 'async with'
+    Используйте это в main.py и других местах, где нужна сессия вне endpoints
     """
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+    
+    # python -m app.database           -> создать таблицы и индекс при необходимости
+    # python -m app.database reindex   -> пересобрать ANN индекс
+    async def main():
+        try:
+            if sys.argv[1:] == ["reindex"]:
+                await rebuild_vector_index()
+            else:
+                await init_db()
+        finally:
+            await close_db()
+    
+    asyncio.run(main())
@@ -1,12 +1,22 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from app.api.endpoints import router
-from app.database import init_db, get_db_context 
-from app.services.vector_service import VectorService
+from app.database import init_db, close_db, get_db_context
+from app.redis_client import init_redis, close_redis
+from app.services.folder_sync import sync_documents_folder
+from app.services.semantic_cache_service import SemanticCacheService
+from app.services.history_writer import history_writer
+from app.services.query_metrics import query_metrics
+from app.services.ingestion_jobs import worker_pool
+from app.services.memory_index import memory_index
 from app.utils.logger import logger
+from app.utils.metrics import prometheus_exposition
+from app.utils.tokens import load_encoding
+from prometheus_client import CONTENT_TYPE_LATEST
 from app.config import get_settings
 from pathlib import Path
 
@@ -18,45 +28,76 @@ async def lifespan(app: FastAPI):
     """Startup и shutdown события"""
     logger.info("Starting SmartTask FAQ Service...")
     
-    init_db()
+    await init_db()
     logger.info("Database initialized")
     
+    await init_redis()
+    await history_writer.start()
+    await query_metrics.start()
+    await seed_query_metrics()
+    
+    await load_encoding()
+    await purge_semantic_cache()
+    purge_task = asyncio.create_task(purge_semantic_cache_periodically())
     await load_initial_documents()
+    if settings.memory_index_enabled:
+        await memory_index.start(settings.memory_index_refresh_interval)
+    # Незавершённые задачи (например, прерванные рестартом) воркеры подхватят сами
+    await worker_pool.start()
     
     yield
     
     logger.info("Shutting down...")
+    purge_task.cancel()
+    await asyncio.gather(purge_task, return_exceptions=True)
+    await worker_pool.stop()
+    await memory_index.stop()
+    await history_writer.stop()
+    await query_metrics.stop()
+    await close_redis()
+    await close_db()
+
+
+async def purge_semantic_cache():
+    """Удаляем просроченные записи семантического кэша"""
+    try:
+        async with get_db_context() as db:
+            purged = await SemanticCacheService(db).purge_expired()
+        if purged:
+            logger.info(f"Purged {purged} expired semantic cache entries")
+    except Exception as e:
+        logger.error(f"Error purging semantic cache: {e}")
+
+
+async def purge_semantic_cache_periodically():
+    """Просроченные записи удаляем и во время работы: иначе они вытесняют живые из выдачи ANN-индекса"""
+    while True:
+        await asyncio.sleep(settings.semantic_cache_purge_interval)
+        await purge_semantic_cache()
+
+
+async def seed_query_metrics():
+    """Итоги /api/metrics включают ответы, записанные в query_history до появления rollups"""
+    try:
+        async with get_db_context() as db:
+            await query_metrics.seed_from_history(db)
+    except Exception as e:
+        logger.error(f"Error seeding query metrics: {e}")
 
 
 async def load_initial_documents():
-    """Загружаем документы из папки documents/ при старте"""
+    """Синхронизируем папку documents/ при старте: эмбеддим только новые и изменённые файлы"""
     docs_path = Path("documents")
     
     if not docs_path.exists():
         logger.warning("Documents folder not found")
         return
     
-    with get_db_context() as db:
-        from app.models import Document
-        if db.query(Document).count() > 0:
-            logger.info("Documents already loaded, skipping")
-            return
-        
-        vector_service = VectorService(db)
-        
-        for file_path in docs_path.glob("*.txt"):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                chunks = await vector_service.add_document(
-                    file_path.name,
-                    content
-                )
-                logger.info(f"Loaded {file_path.name}: {chunks} chunks")
-            
-            except Exception as e:
-                logger.error(f"Error loading {file_path.name}: {e}")
+    summary = await sync_documents_folder(docs_path)
+    logger.info(
+        "Documents folder synced: "
+        + ", ".join(f"{name}={count}" for name, count in summary.items())
+    )
 
 app = FastAPI(
     title="SmartTask FAQ Service",
@@ -75,6 +116,13 @@ app.add_middleware(
 
 app.include_router(router)
 
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus scrape endpoint: per-stage latency histograms and OpenAI token counters"""
+    return Response(content=prometheus_exposition(), media_type=CONTENT_TYPE_LATEST)
+
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
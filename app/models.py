@@ -2,9 +2,15 @@ from sqlalchemy import Column, Integer, String, Text, DateTime, Float
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql import func
 from pgvector.sqlalchemy import Vector
+from app.config import get_settings
+
+settings = get_settings()
 
 Base = declarative_base()
 
+# Конфигурация полнотекстового поиска для documents.content_tsv
+TEXT_SEARCH_CONFIG = "russian"
+
 
 class QueryHistory(Base):
     __tablename__ = "query_history"
@@ -15,6 +21,8 @@ class QueryHistory(Base):
     sources = Column(Text)  # JSON string
     tokens_used = Column(Integer)
     response_time = Column(Float)
+    context_tokens = Column(Integer)  # prompt context actually sent
+    context_tokens_saved = Column(Integer)  # removed by overlap merging and the token budget
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
 
@@ -22,8 +30,54 @@ class Document(Base):
     __tablename__ = "documents"
     
     id = Column(Integer, primary_key=True, index=True)
-    filename = Column(String(255), nullable=False)
+    filename = Column(String(255), nullable=False, index=True)
     content = Column(Text, nullable=False)
     chunk_index = Column(Integer, nullable=False)
-    embedding = Column(Vector(1536))  # OpenAI embedding size
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    embedding = Column(Vector(settings.embedding_dimensions))  # EMBEDDING_DIMENSIONS
+    file_hash = Column(String(64))  # sha256 of the whole source file
+    source = Column(String(16), nullable=False, server_default="upload")  # "upload" | "folder"
+    job_id = Column(String(36), index=True)  # ingestion job that inserted the chunk
+    token_count = Column(Integer)  # tokens of content, counted once at ingestion
+    # content_tsv: generated tsvector column + GIN index, created in database.SCHEMA_MIGRATIONS
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+    
+    id = Column(String(36), primary_key=True)
+    filename = Column(String(255), nullable=False)
+    path = Column(Text, nullable=False)  # spooled upload on disk
+    status = Column(String(16), nullable=False, index=True)  # queued | running | completed | failed
+    attempts = Column(Integer, nullable=False, server_default="0")
+    chunks_total = Column(Integer)
+    chunks_done = Column(Integer, nullable=False, server_default="0")
+    chunks_reused = Column(Integer, nullable=False, server_default="0")
+    chunks_embedded = Column(Integer, nullable=False, server_default="0")
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True))
+
+
+class ChunkEmbedding(Base):
+    """Content-addressed embedding store: one vector per (model, chunk text)"""
+    __tablename__ = "chunk_embeddings"
+    
+    content_hash = Column(String(64), primary_key=True)  # sha256(model + chunk text)
+    model = Column(String(100), nullable=False)
+    embedding = Column(Vector(settings.embedding_dimensions), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class SemanticCacheEntry(Base):
+    __tablename__ = "semantic_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    question_key = Column(String(64), nullable=False, unique=True)  # normalized question hash
+    question = Column(Text, nullable=False)
+    embedding = Column(Vector(settings.embedding_dimensions))
+    answer_data = Column(Text, nullable=False)  # JSON string
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False)
\ No newline at end of file
@@ -0,0 +1,50 @@
+import redis.asyncio as redis
+from typing import Optional
+from app.config import get_settings
+from app.utils.logger import logger
+
+settings = get_settings()
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> redis.Redis:
+    """
+    Process-wide Redis client backed by a connection pool.
+    Created by the FastAPI lifespan; created lazily when used outside of it (scripts, tests).
+    Responses are raw bytes so the same pool can carry JSON and packed binary values.
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis(
+            host=settings.redis_host,
+            port=settings.redis_port,
+            max_connections=settings.redis_max_connections,
+            socket_timeout=settings.redis_socket_timeout,
+            socket_connect_timeout=settings.redis_socket_timeout,
+            health_check_interval=30
+        )
+    return _client
+
+
+async def init_redis():
+    """Create the shared client at startup and check that Redis is reachable"""
+    client = get_redis()
+    try:
+        await client.ping()
+        logger.info(f"Redis connected ({settings.redis_host}:{settings.redis_port})")
+    except Exception as e:
+        logger.error(f"Redis is not reachable at startup: {e}")
+
+
+async def close_redis():
+    """Close the shared client and its connection pool"""
+    global _client
+    if _client is not None:
+        try:
+            await _client.aclose()
+            logger.info("Redis connection pool closed")
+        except Exception as e:
+            logger.error(f"Error closing Redis connection pool: {e}")
+        finally:
+            _client = None
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List
+from typing import Annotated, List, Optional
 from datetime import datetime
 
 
@@ -7,6 +7,10 @@ class QuestionRequest(BaseModel):
     question: str = Field(..., min_length=3, max_length=500)
 
 
+class BatchQuestionRequest(BaseModel):
+    questions: List[Annotated[str, Field(min_length=3, max_length=500)]] = Field(..., min_length=1)
+
+
 class Source(BaseModel):
     filename: str
     content: str
@@ -19,6 +23,13 @@ class AnswerResponse(BaseModel):
     tokens_used: int
     response_time: float
     cached: bool = False
+    degraded: bool = False  # ответ без LLM: OpenAI недоступен
+
+
+class BatchAnswerResponse(BaseModel):
+    answers: List[AnswerResponse]
+    cached: int
+    response_time: float
 
 
 class HealthResponse(BaseModel):
@@ -30,6 +41,23 @@ class HealthResponse(BaseModel):
 
 
 class DocumentUploadResponse(BaseModel):
+    job_id: str
     filename: str
-    chunks_created: int
-    status: str
\ No newline at end of file
+    status: str
+
+
+class IngestionJobStatus(BaseModel):
+    job_id: str
+    filename: str
+    status: str
+    chunks_done: int
+    chunks_total: Optional[int] = None
+    chunks_reused: int = 0
+    chunks_embedded: int = 0
+    progress: float = 0.0
+    chunks_per_second: float = 0.0
+    attempts: int = 0
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
\ No newline at end of file
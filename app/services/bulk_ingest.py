@@ -0,0 +1,253 @@
+"""
+Bulk corpus loader: chunk files in a process pool, embed with bounded concurrency and
+COPY the rows into `documents`, building the ANN index once at the end.
+
+    python -m app.services.bulk_ingest documents/
+    python -m app.services.bulk_ingest "corpus/**/*.md" --workers 8 --concurrency 8 --source upload
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import asyncpg
+from pgvector.asyncpg import register_vector
+
+from app.config import get_settings
+from app.database import close_db, engine, ensure_vector_index, get_db_context, init_db, vector_index_name
+from app.services.vector_service import StreamingChunker, VectorService
+from app.utils.logger import logger
+from app.utils.tokens import count_tokens
+
+settings = get_settings()
+
+SUPPORTED_SUFFIXES = (".txt", ".md")
+COPY_COLUMNS = ["filename", "content", "chunk_index", "embedding", "file_hash", "source", "token_count"]
+
+
+@dataclass
+class BulkReport:
+    documents: int
+    chunks: int
+    reused: int
+    embedded: int
+    failed: int
+    seconds: float
+    
+    @property
+    def documents_per_second(self) -> float:
+        return self.documents / self.seconds if self.seconds else 0.0
+    
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+
+def collect_files(target: str) -> List[Path]:
+    """A directory (searched recursively) or a glob pattern -> supported files, sorted"""
+    path = Path(target)
+    if path.is_dir():
+        candidates = (p for p in path.rglob("*") if p.is_file())
+    else:
+        candidates = (Path(p) for p in glob.glob(target, recursive=True))
+    return sorted(p for p in candidates if p.suffix in SUPPORTED_SUFFIXES)
+
+
+def corpus_root(target: str) -> Path:
+    """Directory that stored filenames are relative to: the target itself or the glob's fixed prefix"""
+    path = Path(target)
+    if path.is_dir():
+        return path
+    prefix = []
+    for part in path.parts:
+        if glob.has_magic(part):
+            break
+        prefix.append(part)
+    root = Path(*prefix) if prefix else Path(".")
+    return root if root.is_dir() else root.parent
+
+
+def chunk_file(
+    path: str, chunk_size: int, overlap: int, root: Optional[str] = None
+) -> Tuple[str, str, List[str], List[int]]:
+    """Runs in a pool process: read, hash, chunk and count tokens -> (filename, sha256, chunks, token counts)"""
+    data = Path(path).read_bytes()
+    chunker = StreamingChunker(chunk_size, overlap)
+    chunks = chunker.feed(data.decode("utf-8")) + chunker.finish()
+    # Путь относительно корня корпуса: a/README.md и b/README.md не затирают чанки друг друга
+    filename = Path(path).relative_to(root).as_posix() if root else Path(path).name
+    return filename, hashlib.sha256(data).hexdigest(), chunks, [count_tokens(c) for c in chunks]
+
+
+class BulkLoader:
+    """
+    Embeds chunk rows window by window and COPYs them over one raw asyncpg connection;
+    every window is a short transaction of its own, embedding happens outside it
+    """
+    
+    def __init__(self, conn: asyncpg.Connection, source: str, concurrency: int):
+        self.conn = conn
+        self.source = source
+        self.concurrency = concurrency
+        self.window_size = settings.embedding_batch_size * concurrency
+        self.rows: List[Tuple[str, str, int, Optional[str], int]] = []
+        self.chunks = 0
+        self.embedded = 0
+    
+    async def add_file(self, filename: str, file_hash: str, chunks: List[str], token_counts: List[int]):
+        self.rows.extend(
+            (filename, chunk, i, file_hash, tokens)
+            for i, (chunk, tokens) in enumerate(zip(chunks, token_counts))
+        )
+        while len(self.rows) >= self.window_size:
+            await self.flush(self.window_size)
+    
+    async def flush(self, limit: Optional[int] = None):
+        window = self.rows[:limit] if limit else self.rows
+        self.rows = self.rows[len(window):]
+        if not window:
+            return
+        
+        # Общий с загрузкой через API content-addressed store: повторяющийся текст не эмбеддим
+        async with get_db_context() as db:
+            vectors, embedded = await VectorService(db).embed_chunks_with_store(
+                [row[1] for row in window], self.concurrency
+            )
+            await db.commit()
+        
+        # Повторная загрузка файла заменяет его чанки: старые удаляем вместе с COPY первого чанка
+        replaced = [filename for filename, _, index, _, _ in window if index == 0]
+        async with self.conn.transaction():
+            if replaced:
+                await self.conn.execute(
+                    "DELETE FROM documents WHERE filename = ANY($1::text[]) AND source = $2",
+                    replaced, self.source
+                )
+            await self.conn.copy_records_to_table(
+                "documents",
+                records=[
+                    (filename, content, index, vector, file_hash, self.source, tokens)
+                    for (filename, content, index, file_hash, tokens), vector in zip(window, vectors)
+                ],
+                columns=COPY_COLUMNS
+            )
+        self.chunks += len(window)
+        self.embedded += embedded
+        logger.info(f"Loaded {self.chunks} chunks ({self.embedded} embedded via API)")
+
+
+async def bulk_ingest(
+    target: str,
+    workers: int = 4,
+    concurrency: Optional[int] = None,
+    source: str = "upload",
+    keep_index: bool = False
+) -> BulkReport:
+    """
+    Load every file under target, committing window by window. Unless keep_index is set
+    the ANN index is dropped for the load (inserts stay cheap) and built once afterwards,
+    also when the load fails; searches keep working meanwhile, without the index.
+    """
+    files = collect_files(target)
+    if not files:
+        raise SystemExit(f"No {'/'.join(SUPPORTED_SUFFIXES)} files found for {target}")
+    root = str(corpus_root(target))
+    
+    start_time = time.time()
+    await init_db()
+    
+    conn = await asyncpg.connect(settings.database_url)
+    await register_vector(conn)
+    loader = BulkLoader(conn, source, concurrency or settings.embedding_concurrency)
+    documents = 0
+    failed = 0
+    
+    try:
+        # Отдельной короткой транзакцией: ACCESS EXCLUSIVE не держится на время загрузки
+        if not keep_index:
+            await conn.execute(f"DROP INDEX IF EXISTS {vector_index_name()}")
+        
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            queued = iter(files)
+            
+            def submit_next():
+                path = next(queued, None)
+                if path is not None:
+                    pending.append((path, loop.run_in_executor(
+                        pool, chunk_file, str(path), settings.chunk_size, settings.chunk_overlap, root
+                    )))
+            
+            # Чанкуем не больше чем на 2 * workers файлов вперёд, чтобы не держать весь корпус в памяти
+            for _ in range(workers * 2):
+                submit_next()
+            
+            while pending:
+                path, future = pending.popleft()
+                submit_next()
+                try:
+                    filename, file_hash, chunks, token_counts = await future
+                except Exception as e:
+                    logger.error(f"Skipping {path}: {e}")
+                    failed += 1
+                    continue
+                if not chunks:
+                    logger.warning(f"Skipping {path}: no text")
+                    continue
+                await loader.add_file(filename, file_hash, chunks, token_counts)
+                documents += 1
+        
+        await loader.flush()
+    finally:
+        await conn.close()
+        if not keep_index:
+            index_start = time.time()
+            async with engine.begin() as db_conn:
+                await ensure_vector_index(db_conn, rebuild=True)
+            logger.info(f"Vector index built in {time.time() - index_start:.1f}s")
+    
+    return BulkReport(
+        documents=documents,
+        chunks=loader.chunks,
+        reused=loader.chunks - loader.embedded,
+        embedded=loader.embedded,
+        failed=failed,
+        seconds=time.time() - start_time
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load a corpus into the documents table")
+    parser.add_argument("target", help="Directory (searched recursively) or glob pattern")
+    parser.add_argument("--workers", type=int, default=4, help="Processes used for chunking")
+    parser.add_argument("--concurrency", type=int, default=None, help="Embedding batches in flight")
+    parser.add_argument(
+        "--source", choices=["upload", "folder"], default="upload",
+        help="Use 'folder' when loading documents/ so startup sync treats the files as unchanged"
+    )
+    parser.add_argument("--keep-index", action="store_true", help="Insert through the existing ANN index")
+    args = parser.parse_args()
+    
+    async def run() -> BulkReport:
+        try:
+            return await bulk_ingest(args.target, args.workers, args.concurrency, args.source, args.keep_index)
+        finally:
+            await close_db()
+    
+    report = asyncio.run(run())
+    print(
+        f"{report.documents} documents ({report.failed} failed), {report.chunks} chunks "
+        f"({report.reused} reused, {report.embedded} embedded) in {report.seconds:.1f}s: "
+        f"{report.documents_per_second:.1f} docs/s, {report.chunks_per_second:.1f} chunks/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
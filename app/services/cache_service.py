@@ -1,35 +1,42 @@
 import redis.asyncio as redis
+import asyncio
 import json
 import hashlib
-from typing import Optional
+import time
+import uuid
+from typing import Dict, List, Optional
 from app.config import get_settings
+from app.redis_client import get_redis
 from app.utils.logger import logger
 
 settings = get_settings()
 
+# Удаляем lock только если он всё ещё наш
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase and collapse whitespace so trivially different phrasings share a key"""
+    return ' '.join(question.lower().strip().split())
+
 
 class CacheService:
-    def __init__(self):
-        self._redis = None
+    def __init__(self, redis_client: Optional[redis.Redis] = None):
+        self._redis = redis_client or get_redis()
     
-    async def _get_redis(self):
-        """Lazy initialization of Redis connection"""
-        if self._redis is None:
-            try:
-                self._redis = redis.Redis(
-                    host=settings.redis_host,
-                    port=settings.redis_port,
-                    decode_responses=True
-                )
-                await self._redis.ping()
-            except Exception as e:
-                logger.error(f"Failed to connect to Redis: {e}")
-                raise
+    @property
+    def client(self) -> redis.Redis:
+        """Underlying shared Redis client"""
         return self._redis
     
     def _make_key(self, question: str) -> str:
         """Create normalized cache key from question"""
-        normalized = ' '.join(question.lower().strip().split())
+        normalized = normalize_question(question)
         hash_key = hashlib.md5(normalized.encode()).hexdigest()
         return f"faq:{hash_key}"
     
@@ -37,8 +44,7 @@ class CacheService:
         """Get cached answer for question"""
         key = self._make_key(question)
         try:
-            redis_client = await self._get_redis()
-            cached = await redis_client.get(key)
+            cached = await self._redis.get(key)
             
             if cached:
                 logger.info(f"Cache HIT for question: {question[:50]}...")
@@ -51,15 +57,24 @@ class CacheService:
             logger.error(f"Cache get error: {e}")
             return None
     
+    async def get_many(self, questions: List[str]) -> List[Optional[dict]]:
+        """Get cached answers for several questions in one MGET round trip"""
+        if not questions:
+            return []
+        try:
+            values = await self._redis.mget([self._make_key(q) for q in questions])
+            return [json.loads(v) if v else None for v in values]
+        except Exception as e:
+            logger.error(f"Cache get_many error: {e}")
+            return [None] * len(questions)
+    
     async def set(self, question: str, answer_data: dict):
         """Cache answer for question with TTL"""
         key = self._make_key(question)
         try:
-            redis_client = await self._get_redis()
-            
             json_data = json.dumps(answer_data, ensure_ascii=False)
             
-            await redis_client.setex(
+            await self._redis.setex(
                 key,
                 settings.redis_ttl,
                 json_data
@@ -70,21 +85,83 @@ class CacheService:
         except Exception as e:
             logger.error(f"Cache set error: {e}")
     
+    async def set_many(self, answers: Dict[str, dict]):
+        """Cache several answers in one pipelined round trip"""
+        if not answers:
+            return
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for question, answer_data in answers.items():
+                    pipe.setex(
+                        self._make_key(question),
+                        settings.redis_ttl,
+                        json.dumps(answer_data, ensure_ascii=False)
+                    )
+                await pipe.execute()
+            
+            logger.info(f"Cached {len(answers)} answers for {settings.redis_ttl}s")
+            
+        except Exception as e:
+            logger.error(f"Cache set_many error: {e}")
+    
+    def _lock_key(self, question: str) -> str:
+        return f"lock:{self._make_key(question)}"
+    
+    async def acquire_lock(self, question: str) -> Optional[str]:
+        """Try to become the one worker computing this question; returns a token or None"""
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self._redis.set(
+                self._lock_key(question),
+                token,
+                nx=True,
+                px=int(settings.singleflight_lock_ttl * 1000)
+            )
+            return token if acquired else None
+        except Exception as e:
+            logger.error(f"Cache lock error: {e}")
+            return token  # Redis unavailable: compute locally rather than wait
+    
+    async def release_lock(self, question: str, token: str):
+        try:
+            await self._redis.eval(RELEASE_LOCK_SCRIPT, 1, self._lock_key(question), token)
+        except Exception as e:
+            logger.error(f"Cache unlock error: {e}")
+    
+    async def wait_for_answer(self, question: str, timeout: float) -> Optional[dict]:
+        """Poll for an answer another worker is computing, until it appears or the lock is gone"""
+        key = self._make_key(question)
+        lock_key = self._lock_key(question)
+        deadline = time.monotonic() + timeout
+        
+        while time.monotonic() < deadline:
+            await asyncio.sleep(settings.singleflight_poll_interval)
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    pipe.get(key)
+                    pipe.exists(lock_key)
+                    cached, locked = await pipe.execute()
+            except Exception as e:
+                logger.error(f"Cache wait error: {e}")
+                return None
+            
+            if cached:
+                return json.loads(cached)
+            if not locked:
+                return None
+        
+        return None
+    
     async def health_check(self) -> bool:
         """Check if Redis is accessible"""
         try:
-            redis_client = await self._get_redis()
-            await redis_client.ping()
+            await self._redis.ping()
             return True
         except Exception as e:
             logger.error(f"Redis health check failed: {e}")
             return False
-    
-    async def close(self):
-        """Close Redis connection"""
-        if self._redis:
-            try:
-                await self._redis.close()
-                logger.info("Redis connection closed")
-            except Exception as e:
-                logger.error(f"Error closing Redis connection: {e}")
\ No newline at end of file
+
+
+def get_cache() -> CacheService:
+    """Dependency для FastAPI endpoints: CacheService on the shared Redis pool"""
+    return CacheService(get_redis())
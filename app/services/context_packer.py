@@ -0,0 +1,119 @@
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional
+from app.services.vector_service import RetrievedChunk
+from app.utils.tokens import count_tokens
+
+# Чанкер режет по границам предложений, поэтому перекрытие соседей — не меньше пары слов
+MIN_OVERLAP_CHARS = 10
+
+
+@dataclass
+class Passage:
+    """Consecutive chunks of one file merged into a single piece of context"""
+    filename: str
+    text: str
+    tokens: int
+    similarity: float
+    last_index: Optional[int]
+    chunks: List[RetrievedChunk] = field(default_factory=list)
+
+
+@dataclass
+class PackedContext:
+    text: str
+    chunks: List[RetrievedChunk]  # chunks whose text made it into the prompt, best first
+    tokens: int                   # context tokens sent to the LLM
+    raw_tokens: int               # what joining every retrieved chunk as-is would have cost
+    
+    @property
+    def tokens_saved(self) -> int:
+        return max(self.raw_tokens - self.tokens, 0)
+
+
+def overlap_length(left: str, right: str, max_chars: int) -> int:
+    """Length of the longest suffix of left that is also a prefix of right"""
+    for size in range(min(len(left), len(right), max_chars), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _header(filename: str) -> str:
+    return f"[{filename}]\n"
+
+
+def _chunk_tokens(chunk: RetrievedChunk) -> int:
+    return chunk.token_count if chunk.token_count is not None else count_tokens(chunk.content)
+
+
+def merge_neighbours(chunks: Iterable[RetrievedChunk], max_overlap: int) -> List[Passage]:
+    """Merge chunks with consecutive chunk_index from the same file, dropping the overlapping text"""
+    passages: List[Passage] = []
+    ordered = sorted(
+        chunks,
+        key=lambda c: (c.filename, c.chunk_index is None, c.chunk_index or 0)
+    )
+    
+    for chunk in ordered:
+        tokens = _chunk_tokens(chunk)
+        previous = passages[-1] if passages else None
+        
+        if (
+            previous is not None
+            and previous.filename == chunk.filename
+            and chunk.chunk_index is not None
+            and previous.last_index is not None
+            and chunk.chunk_index == previous.last_index + 1
+        ):
+            overlap = overlap_length(previous.text, chunk.content, max_overlap)
+            previous.text += chunk.content[overlap:] if overlap else "\n" + chunk.content
+            previous.tokens += tokens - (count_tokens(chunk.content[:overlap]) if overlap else 0)
+            previous.similarity = max(previous.similarity, chunk.similarity)
+            previous.last_index = chunk.chunk_index
+            previous.chunks.append(chunk)
+            continue
+        
+        passages.append(Passage(
+            filename=chunk.filename,
+            text=chunk.content,
+            tokens=tokens,
+            similarity=chunk.similarity,
+            last_index=chunk.chunk_index,
+            chunks=[chunk]
+        ))
+    
+    return passages
+
+
+def pack_context(similar_docs: Iterable[tuple], token_budget: int, max_overlap: int) -> PackedContext:
+    """
+    Build the prompt context from search results: merge overlapping neighbours, then add
+    passages best-first while they fit into token_budget (0 = no limit). The best passage
+    is always included, cut to the budget if it is larger on its own.
+    """
+    chunks = [RetrievedChunk(*doc) for doc in similar_docs]
+    raw_tokens = sum(_chunk_tokens(c) + count_tokens(_header(c.filename)) for c in chunks)
+    
+    passages = sorted(merge_neighbours(chunks, max_overlap), key=lambda p: p.similarity, reverse=True)
+    
+    selected: List[Passage] = []
+    used = 0
+    for passage in passages:
+        cost = passage.tokens + count_tokens(_header(passage.filename))
+        if token_budget and used + cost > token_budget:
+            if selected:
+                continue
+            # Даже лучший фрагмент не помещается: обрезаем пропорционально бюджету
+            keep = max(int(len(passage.text) * token_budget / cost), 1)
+            passage.text = passage.text[:keep]
+            cost = count_tokens(passage.text) + count_tokens(_header(passage.filename))
+        selected.append(passage)
+        used += cost
+    
+    text = "\n\n".join(_header(p.filename) + p.text for p in selected)
+    used_chunks = sorted(
+        (chunk for passage in selected for chunk in passage.chunks),
+        key=lambda c: c.similarity,
+        reverse=True
+    )
+    return PackedContext(text=text, chunks=used_chunks, tokens=used, raw_tokens=raw_tokens)
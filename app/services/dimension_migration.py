@@ -0,0 +1,101 @@
+"""
+Shrink stored embeddings to EMBEDDING_DIMENSIONS without calling the embeddings API.
+
+    EMBEDDING_DIMENSIONS=512 python -m app.services.dimension_migration
+
+text-embedding-3 vectors are trained so that a prefix of the vector, re-normalized, is the
+same embedding the API returns for `dimensions=N`. Existing rows are therefore cut with
+subvector() + l2_normalize() in place, chunk_embeddings is re-keyed for the new size and
+the ANN indexes are rebuilt. Growing vectors is impossible: re-ingest the documents instead.
+"""
+import argparse
+import asyncio
+
+from sqlalchemy import text
+
+from app.config import get_settings
+from app.database import (
+    EMBEDDING_TABLES, VECTOR_STORAGE_OPS, VECTOR_TABLES, close_db, column_dimensions,
+    engine, ensure_vector_index, init_db, vector_index_name
+)
+from app.utils.logger import logger
+
+settings = get_settings()
+
+# Тот же адрес, что vector_service.chunk_content_hash: sha256(model key + \0 + текст чанка)
+REKEY_CHUNK_EMBEDDINGS = """
+    INSERT INTO chunk_embeddings (content_hash, model, embedding)
+    SELECT DISTINCT ON (content_hash) content_hash, cast(:model as text), embedding
+    FROM (
+        SELECT
+            encode(sha256(
+                convert_to(cast(:model as text), 'UTF8') || '\\x00'::bytea || convert_to(content, 'UTF8')
+            ), 'hex') AS content_hash,
+            embedding
+        FROM documents
+        WHERE embedding IS NOT NULL
+    ) chunks
+    ON CONFLICT (content_hash) DO NOTHING
+"""
+
+
+async def migrate_dimensions(force: bool = False) -> int:
+    """Returns the number of document chunks migrated (0 when already at the target size)"""
+    target = settings.embedding_dimensions
+    
+    async with engine.begin() as conn:
+        current = await column_dimensions(conn, "documents")
+        if current is None or current == target:
+            logger.info(f"documents.embedding is already vector({target}), nothing to migrate")
+            return 0
+        if target > current:
+            raise SystemExit(
+                f"Cannot grow vector({current}) to vector({target}): re-ingest the documents instead"
+            )
+        if not settings.embedding_model.startswith("text-embedding-3") and not force:
+            raise SystemExit(
+                f"{settings.embedding_model} is not a text-embedding-3 model, truncated vectors may be "
+                "meaningless; pass --force to migrate anyway"
+            )
+        
+        for table in EMBEDDING_TABLES:
+            for storage in VECTOR_STORAGE_OPS:
+                await conn.execute(text(f"DROP INDEX IF EXISTS {vector_index_name(table, storage=storage)}"))
+            await conn.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN embedding TYPE vector({target}) "
+                f"USING l2_normalize(subvector(embedding, 1, {target}))::vector({target})"
+            ))
+            logger.info(f"{table}.embedding: vector({current}) -> vector({target})")
+        
+        # Старые ключи содержат прежний размер: пересобираем store из уже обрезанных документов
+        await conn.execute(text("DELETE FROM chunk_embeddings"))
+        await conn.execute(text(REKEY_CHUNK_EMBEDDINGS), {"model": settings.embedding_model_key})
+        
+        migrated = await conn.scalar(text("SELECT count(*) FROM documents WHERE embedding IS NOT NULL"))
+        
+        for table in VECTOR_TABLES:
+            await ensure_vector_index(conn, table, rebuild=True)
+    
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--force", action="store_true", help="Migrate even if the model is not text-embedding-3")
+    args = parser.parse_args()
+    
+    async def run() -> int:
+        try:
+            migrated = await migrate_dimensions(args.force)
+            # Остальные миграции схемы и проверка размера
+            await init_db()
+            return migrated
+        finally:
+            await close_db()
+    
+    migrated = asyncio.run(run())
+    print(f"{migrated} chunks stored as vector({settings.embedding_dimensions})")
+
+
+if __name__ == "__main__":
+    main()
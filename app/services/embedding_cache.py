@@ -0,0 +1,135 @@
+import hashlib
+import numpy as np
+import redis.asyncio as redis
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from app.config import get_settings
+from app.redis_client import get_redis
+from app.services.cache_service import normalize_question
+from app.utils.logger import logger
+
+settings = get_settings()
+
+
+def pack_embedding(embedding) -> bytes:
+    """Little-endian float32 bytes (4 bytes per dimension instead of a JSON list)"""
+    return np.asarray(embedding, dtype="<f4").tobytes()
+
+
+def unpack_embedding(data: bytes) -> List[float]:
+    return np.frombuffer(data, dtype="<f4").tolist()
+
+
+class EmbeddingCache:
+    """
+    Two-level embedding cache: a bounded in-process LRU in front of Redis.
+    Keys are the embedding model plus the normalized text, values are packed float32.
+    """
+    
+    def __init__(self, max_size: int, ttl: int, redis_client: Optional[redis.Redis] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._redis = redis_client
+        self._local: "OrderedDict[str, bytes]" = OrderedDict()
+        self.hits_local = 0
+        self.hits_shared = 0
+        self.misses = 0
+    
+    @property
+    def redis(self) -> redis.Redis:
+        return self._redis or get_redis()
+    
+    @staticmethod
+    def make_key(text: str) -> str:
+        digest = hashlib.sha1(normalize_question(text).encode()).hexdigest()
+        return f"emb:{settings.embedding_model_key}:{digest}"
+    
+    def _remember(self, key: str, packed: bytes):
+        self._local[key] = packed
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+    
+    async def get(self, text: str) -> Optional[List[float]]:
+        key = self.make_key(text)
+        
+        packed = self._local.get(key)
+        if packed is not None:
+            self._local.move_to_end(key)
+            self.hits_local += 1
+            return unpack_embedding(packed)
+        
+        try:
+            packed = await self.redis.get(key)
+        except Exception as e:
+            logger.error(f"Embedding cache get error: {e}")
+            packed = None
+        
+        if packed is None:
+            self.misses += 1
+            return None
+        
+        self.hits_shared += 1
+        self._remember(key, packed)
+        return unpack_embedding(packed)
+    
+    async def set(self, text: str, embedding: List[float]):
+        key = self.make_key(text)
+        packed = pack_embedding(embedding)
+        self._remember(key, packed)
+        try:
+            await self.redis.setex(key, self.ttl, packed)
+        except Exception as e:
+            logger.error(f"Embedding cache set error: {e}")
+    
+    async def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """get for several texts: the local LRU first, the rest in one MGET"""
+        keys = [self.make_key(text) for text in texts]
+        found: List[Optional[bytes]] = []
+        for key in keys:
+            packed = self._local.get(key)
+            if packed is not None:
+                self._local.move_to_end(key)
+                self.hits_local += 1
+            found.append(packed)
+        
+        missing = [i for i, packed in enumerate(found) if packed is None]
+        if missing:
+            try:
+                values = await self.redis.mget([keys[i] for i in missing])
+            except Exception as e:
+                logger.error(f"Embedding cache get_many error: {e}")
+                values = [None] * len(missing)
+            for i, packed in zip(missing, values):
+                if packed is None:
+                    self.misses += 1
+                    continue
+                self.hits_shared += 1
+                self._remember(keys[i], packed)
+                found[i] = packed
+        
+        return [unpack_embedding(packed) if packed is not None else None for packed in found]
+    
+    async def set_many(self, items: List[Tuple[str, List[float]]]):
+        """set for several (text, embedding) pairs in one pipelined round trip"""
+        if not items:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for text, embedding in items:
+                    key = self.make_key(text)
+                    packed = pack_embedding(embedding)
+                    self._remember(key, packed)
+                    pipe.setex(key, self.ttl, packed)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Embedding cache set_many error: {e}")
+    
+    def clear(self):
+        self._local.clear()
+
+
+embedding_cache = EmbeddingCache(
+    max_size=settings.embedding_cache_size,
+    ttl=settings.embedding_cache_ttl
+)
@@ -1,10 +1,48 @@
 
-from typing import Dict
+from typing import Dict, List, Optional, Sequence
+from app.config import get_settings
+from app.services.llm_recorder import llm_recorder
 from app.services.rag_service import RAGService
+from app.services.vector_service import RetrievedChunk, VectorService
 from app.database import get_db_context
+from app.services.history_writer import history_writer
+from app.utils.metrics import latency_summary
+import argparse
 import asyncio
+import json
+import time
 from app.utils.logger import logger
 
+settings = get_settings()
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def is_relevant(chunk: RetrievedChunk, label: Dict) -> bool:
+    """Chunk of the labelled document that contains the labelled passage"""
+    return chunk.filename == label["filename"] and normalize_text(label["contains"]) in normalize_text(chunk.content)
+
+
+def ranking_metrics(chunks: Sequence[RetrievedChunk], labels: List[Dict], ks: Sequence[int]) -> Dict:
+    """
+    recall@k: share of labelled passages found in the top k chunks;
+    reciprocal_rank: 1 / rank of the first relevant chunk (0 if none is retrieved)
+    """
+    first_rank = {}
+    for rank, chunk in enumerate(chunks, start=1):
+        for i, label in enumerate(labels):
+            if i not in first_rank and is_relevant(chunk, label):
+                first_rank[i] = rank
+    
+    metrics = {
+        f"recall@{k}": sum(rank <= k for rank in first_rank.values()) / len(labels)
+        for k in ks
+    }
+    metrics["reciprocal_rank"] = 1 / min(first_rank.values()) if first_rank else 0.0
+    return metrics
+
 
 class RAGEvaluator:
     """Evaluate RAG system quality based on ACTUAL documents"""
@@ -14,54 +52,63 @@ class RAGEvaluator:
             {
                 "question": "Как создать задачу?",
                 "expected_keywords": ["задача", "нажмите", "+", "название"],
+                "relevant": [{"filename": "SmartTask_User_Manual.txt", "contains": "+ Задача"}],
                 "category": "task_management"
             },
             
             {
                 "question": "Где хранятся данные?",
                 "expected_keywords": ["aws", "франкфурт", "германия"],
+                "relevant": [{"filename": "SmartTask_Security.txt", "contains": "Франкфурт"}],
                 "category": "security"
             },
             
             {
                 "question": "Какие интеграции поддерживаются?",
                 "expected_keywords": ["slack", "github", "google"],
+                "relevant": [{"filename": "SmartTask_Overview.txt", "contains": "Интеграции (Slack"}],
                 "category": "integrations"
             },
             
             {
                 "question": "Как получить список задач через API?",
                 "expected_keywords": ["get", "/tasks", "api"],
+                "relevant": [{"filename": "SmartTask_API.txt", "contains": "GET /tasks"}],
                 "category": "api"
             },
             
             {
                 "question": "Как управлять проектом?",
                 "expected_keywords": ["kanban", "доска", "перетаскива"],
+                "relevant": [{"filename": "SmartTask_User_Manual.txt", "contains": "доску Kanban"}],
                 "category": "project_management"
             },
             
             {
                 "question": "Какое шифрование используется?",
                 "expected_keywords": ["aes", "256", "шифрован"],
+                "relevant": [{"filename": "SmartTask_Security.txt", "contains": "AES-256"}],
                 "category": "security"
             },
             
             {
                 "question": "Какие есть тарифные планы?",
                 "expected_keywords": ["free", "pro", "enterprise"],
+                "relevant": [{"filename": "SmartTask_Overview.txt", "contains": "Enterprise"}],
                 "category": "pricing"
             },
             
             {
                 "question": "Что делать если не приходят уведомления?",
                 "expected_keywords": ["email", "спам", "настройк", "уведомлен"],
+                "relevant": [{"filename": "SmartTask_Troubleshooting_Guide.txt", "contains": "Проверьте спам"}],
                 "category": "troubleshooting"
             },
             
             {
                 "question": "Какой максимальный размер файла?",
                 "expected_keywords": ["50", "мб", "файл"],
+                "relevant": [{"filename": "SmartTask_Troubleshooting_Guide.txt", "contains": "Максимальный размер — 50 МБ"}],
                 "category": "features"
             },
         ]
@@ -76,8 +123,9 @@ class RAGEvaluator:
             "details": []
         }
         
-        with get_db_context() as db:
-            rag = RAGService(db)
+        async with get_db_context() as db:
+            # С record/replay ответы не берутся из кэшей: иначе запись неполная, а воспроизведение недетерминировано
+            rag = RAGService(db, use_cache=llm_recorder.mode == "off")
             
             for test_case in self.test_questions:
                 question = test_case["question"]
@@ -137,12 +185,94 @@ class RAGEvaluator:
             stats["accuracy"] = stats["passed"] / stats["total"] if stats["total"] > 0 else 0
         
         return results
+    
+    async def evaluate_retrieval(
+        self,
+        ks: Sequence[int] = (3,),
+        concurrency: int = 8,
+        repeats: int = 1
+    ) -> Dict:
+        """
+        Score search only, without generating answers: recall@k and MRR of the retrieved
+        chunks against the labelled passages, plus embedding and search latency.
+        Questions run concurrently, each on its own session; repeats only add latency samples.
+        """
+        ks = sorted(set(ks))
+        depth = ks[-1]
+        semaphore = asyncio.Semaphore(concurrency)
+        embedding_times: List[float] = []
+        search_times: List[float] = []
+        
+        async def run_case(test_case: Dict) -> Dict:
+            question = test_case["question"]
+            detail = {"question": question, "category": test_case["category"]}
+            
+            async with semaphore:
+                try:
+                    async with get_db_context() as db:
+                        service = VectorService(db)
+                        for _ in range(max(repeats, 1)):
+                            # Те же шаги, что в search_similar, но с раздельным замером
+                            start = time.perf_counter()
+                            embedding = await service.llm.get_embedding(question)
+                            embedding_times.append(time.perf_counter() - start)
+                            
+                            start = time.perf_counter()
+                            chunks = await service.search_by_embedding(embedding, depth, query_text=question)
+                            search_times.append(time.perf_counter() - start)
+                except Exception as e:
+                    logger.error(f"Error evaluating retrieval for '{question}': {e}")
+                    detail["error"] = str(e)
+                    return detail
+            
+            detail.update(ranking_metrics(chunks, test_case["relevant"], ks))
+            detail["retrieved"] = [f"{chunk.filename}#{chunk.chunk_index}" for chunk in chunks]
+            return detail
+        
+        start = time.perf_counter()
+        details = await asyncio.gather(*(run_case(test_case) for test_case in self.test_questions))
+        seconds = time.perf_counter() - start
+        
+        metric_names = [f"recall@{k}" for k in ks] + ["reciprocal_rank"]
+        scored = [detail for detail in details if "error" not in detail]
+        
+        def mean_metrics(rows: List[Dict]) -> Dict:
+            means = {
+                name: round(sum(row[name] for row in rows) / len(rows), 4) if rows else 0.0
+                for name in metric_names
+            }
+            means["mrr"] = means.pop("reciprocal_rank")
+            return means
+        
+        by_category = {}
+        for detail in scored:
+            by_category.setdefault(detail["category"], []).append(detail)
+        
+        return {
+            "mode": "retrieval",
+            "total": len(details),
+            "errors": len(details) - len(scored),
+            "k": ks,
+            "search_mode": settings.search_mode,
+            "concurrency": concurrency,
+            "repeats": repeats,
+            "seconds": round(seconds, 3),
+            **mean_metrics(scored),
+            "embedding_latency": latency_summary(embedding_times),
+            "search_latency": latency_summary(search_times),
+            "by_category": {category: mean_metrics(rows) for category, rows in by_category.items()},
+            "details": details
+        }
 
 
 async def run_eval():
     """Run and display evaluation results"""
     evaluator = RAGEvaluator()
-    results = await evaluator.evaluate()
+    await history_writer.start()
+    try:
+        results = await evaluator.evaluate()
+    finally:
+        await history_writer.stop()
     
     print("\n" + "="*70)
     print("📊 RAG System Evaluation Results")
@@ -198,5 +328,68 @@ async def run_eval():
     return results
 
 
+async def run_retrieval_eval(ks: Sequence[int], concurrency: int, repeats: int) -> Dict:
+    """Run and display the retrieval-only evaluation"""
+    results = await RAGEvaluator().evaluate_retrieval(ks, concurrency, repeats)
+    recalls = "  ".join(f"recall@{k}: {results[f'recall@{k}']:.3f}" for k in results["k"])
+    
+    print("\n" + "="*70)
+    print("🔎 Retrieval Evaluation Results")
+    print("="*70)
+    print(f"Questions: {results['total']} | errors: {results['errors']} | "
+          f"search mode: {results['search_mode']} | concurrency: {results['concurrency']}")
+    print(f"{recalls}  MRR: {results['mrr']:.3f}")
+    for name in ("embedding_latency", "search_latency"):
+        latency = results[name]
+        print(f"{name:<18} p50: {latency['p50_ms']:>8.2f}ms  p95: {latency['p95_ms']:>8.2f}ms  "
+              f"p99: {latency['p99_ms']:>8.2f}ms")
+    print("="*70)
+    
+    print("\n📝 Per Question:")
+    for detail in results["details"]:
+        if "error" in detail:
+            print(f"  ❌ {detail['question']}  Error: {detail['error']}")
+            continue
+        emoji = "✅" if detail["reciprocal_rank"] else "❌"
+        print(f"  {emoji} {detail['question']}  RR: {detail['reciprocal_rank']:.2f}  "
+              f"retrieved: {', '.join(detail['retrieved'])}")
+    print("="*70 + "\n")
+    
+    return results
+
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="RAG quality evaluation")
+    parser.add_argument("--retrieval", action="store_true",
+                        help="Score search only (recall@k, MRR, latency) without generating answers")
+    parser.add_argument("--k", type=int, nargs="+", default=[settings.top_k], help="Cutoffs for recall@k")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=1, help="Searches per question, for latency samples")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument("--record", metavar="PATH", help="Save every OpenAI call to this SQLite file")
+    recording.add_argument("--replay", metavar="PATH", help="Answer OpenAI calls from this file, no network")
+    args = parser.parse_args(argv)
+    
+    if args.record or args.replay:
+        llm_recorder.configure("record" if args.record else "replay", args.record or args.replay)
+    
+    try:
+        if args.retrieval:
+            results = await run_retrieval_eval(args.k, args.concurrency, args.repeats)
+        else:
+            results = await run_eval()
+    finally:
+        llm_recorder.close()
+    
+    if llm_recorder.mode != "off":
+        results["llm_calls"] = llm_recorder.stats()
+        print(f"LLM {llm_recorder.mode}: {results['llm_calls']}")
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
 if __name__ == "__main__":
-    asyncio.run(run_eval())
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
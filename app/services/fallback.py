@@ -0,0 +1,33 @@
+from typing import Optional, Sequence
+from app.utils.text import SENTENCE_RE, word_stems
+
+UNAVAILABLE_ANSWER = "Сервис генерации ответов временно недоступен, попробуйте повторить вопрос позже."
+EXTRACTIVE_PREFIX = "Сервис генерации ответов временно недоступен. Вот что нашлось в документации:"
+
+MIN_SENTENCE_LENGTH = 20
+MIN_WORD_LENGTH = 3
+
+
+def extractive_answer(question: str, chunks: Sequence, max_sentences: int = 3) -> Optional[str]:
+    """
+    Answer without the LLM: the sentences of the retrieved chunks that share the most words
+    with the question, in document order; None when no sentence matches
+    """
+    wanted = set(word_stems(question, MIN_WORD_LENGTH))
+    scored = {}
+    for rank, chunk in enumerate(chunks):
+        for position, sentence in enumerate(SENTENCE_RE.split(chunk[1])):
+            sentence = " ".join(sentence.split())
+            # Соседние чанки перекрываются: одно предложение учитываем один раз
+            if len(sentence) < MIN_SENTENCE_LENGTH or sentence in scored:
+                continue
+            score = len(wanted & set(word_stems(sentence, MIN_WORD_LENGTH)))
+            if score:
+                scored[sentence] = (score, rank, position)
+    
+    if not scored:
+        return None
+    
+    best = sorted(scored, key=lambda s: (-scored[s][0], scored[s][1], scored[s][2]))[:max_sentences]
+    best.sort(key=lambda s: scored[s][1:])
+    return EXTRACTIVE_PREFIX + "\n" + "\n".join(f"— {sentence}" for sentence in best)
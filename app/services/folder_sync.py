@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.database import get_db_context
+from app.models import Document
+from app.services.vector_service import VectorService
+from app.utils.logger import logger
+
+settings = get_settings()
+
+FOLDER_SOURCE = "folder"
+
+
+def file_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _owned_by_folder(filename: str):
+    """Rows of a folder file: tagged as folder, or legacy rows loaded before hashes existed"""
+    return (Document.filename == filename) & or_(
+        Document.source == FOLDER_SOURCE,
+        Document.file_hash.is_(None)
+    )
+
+
+async def _stored_hashes(db: AsyncSession, on_disk) -> Dict[str, Optional[str]]:
+    """filename -> file_hash for everything previously loaded from the folder"""
+    result = await db.execute(
+        select(Document.filename, Document.file_hash, Document.source)
+        .where(or_(
+            Document.source == FOLDER_SOURCE,
+            Document.file_hash.is_(None) & Document.filename.in_(list(on_disk))
+        ))
+        .distinct()
+    )
+    stored: Dict[str, Optional[str]] = {}
+    for filename, file_hash, source in result:
+        # Любая legacy-строка без хэша означает, что файл нужно проверить
+        if filename not in stored or file_hash is None:
+            stored[filename] = file_hash
+    return stored
+
+
+async def _adopt_legacy(db: AsyncSession, filename: str, content: str, file_hash: str) -> bool:
+    """Tag legacy rows with the file hash when they still match the file chunk for chunk"""
+    result = await db.execute(
+        select(Document.content)
+        .where(_owned_by_folder(filename))
+        .order_by(Document.chunk_index)
+    )
+    stored_chunks = [row.content for row in result]
+    
+    if stored_chunks != VectorService(db).chunk_text(content, settings.chunk_size, settings.chunk_overlap):
+        return False
+    
+    await db.execute(
+        update(Document)
+        .where(_owned_by_folder(filename))
+        .values(file_hash=file_hash, source=FOLDER_SOURCE)
+    )
+    await db.commit()
+    return True
+
+
+async def _sync_file(path: Path, stored_hash: Optional[str], known: bool) -> str:
+    data = path.read_bytes()
+    file_hash = file_sha256(data)
+    
+    if known and stored_hash == file_hash:
+        return "unchanged"
+    
+    content = data.decode("utf-8")
+    
+    async with get_db_context() as db:
+        if known and stored_hash is None and await _adopt_legacy(db, path.name, content, file_hash):
+            return "unchanged"
+        
+        # Старые чанки удаляются в той же транзакции, что и вставка новых
+        await db.execute(delete(Document).where(_owned_by_folder(path.name)))
+        report = await VectorService(db).add_document(
+            path.name,
+            content,
+            file_hash=file_hash,
+            source=FOLDER_SOURCE
+        )
+    
+    logger.info(f"{'Updated' if known else 'Loaded'} {path.name}: {report.chunks} chunks")
+    return "updated" if known else "added"
+
+
+async def sync_documents_folder(docs_path: Path) -> Dict[str, int]:
+    """
+    Bring the documents table in line with the folder: embed only added or changed
+    files (by content hash), delete chunks of removed files, process files concurrently
+    """
+    on_disk = {path.name: path for path in sorted(docs_path.glob("*.txt"))}
+    
+    async with get_db_context() as db:
+        stored = await _stored_hashes(db, on_disk)
+        
+        removed = [name for name in stored if name not in on_disk]
+        if removed:
+            await db.execute(delete(Document).where(
+                Document.filename.in_(removed),
+                Document.source == FOLDER_SOURCE
+            ))
+            await db.commit()
+            for name in removed:
+                logger.info(f"Removed chunks of deleted file {name}")
+    
+    semaphore = asyncio.Semaphore(settings.startup_ingest_concurrency)
+    
+    async def run(name: str, path: Path) -> str:
+        async with semaphore:
+            try:
+                return await _sync_file(path, stored.get(name), name in stored)
+            except Exception as e:
+                logger.error(f"Error loading {name}: {e}")
+                return "failed"
+    
+    outcomes = await asyncio.gather(*(run(name, path) for name, path in on_disk.items()))
+    
+    summary = {"added": 0, "updated": 0, "unchanged": 0, "failed": 0, "removed": len(removed)}
+    for outcome in outcomes:
+        summary[outcome] += 1
+    return summary
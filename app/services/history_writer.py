@@ -0,0 +1,131 @@
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from typing import Callable, Deque, Dict, List, Optional
+from sqlalchemy import insert
+from app.config import get_settings
+from app.database import AsyncSessionLocal
+from app.models import QueryHistory
+from app.utils.logger import logger
+from app.utils.metrics import stage_timer
+
+settings = get_settings()
+
+
+class HistoryWriter:
+    """
+    Write-behind buffer for QueryHistory rows.
+    Records are queued in memory (bounded) and inserted in batches by a background
+    task when batch_size records are pending or every flush_interval seconds.
+    """
+    
+    def __init__(
+        self,
+        max_queue: int,
+        batch_size: int,
+        flush_interval: float,
+        session_factory: Callable = AsyncSessionLocal
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.session_factory = session_factory
+        
+        self._pending: Deque[Dict] = deque()
+        self._retry: List[Dict] = []  # failed batch, retried once on the next flush
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+    
+    def enqueue(self, **record):
+        """Queue one history row; never blocks, drops the record when the buffer is full"""
+        if len(self._pending) + len(self._retry) >= self.max_queue:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"History buffer full, dropped {self.dropped} records so far")
+            return
+        
+        record.setdefault("timestamp", datetime.now(timezone.utc))
+        self._pending.append(record)
+        
+        if self._wake is not None and len(self._pending) >= self.batch_size:
+            self._wake.set()
+    
+    async def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            f"History writer started (batch={self.batch_size}, "
+            f"interval={self.flush_interval}s, max_queue={self.max_queue})"
+        )
+    
+    async def stop(self):
+        """Stop the background task and drain everything still queued"""
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush(drain=True)
+        logger.info(f"History writer stopped (written={self.written}, dropped={self.dropped})")
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+    
+    async def flush(self, drain: bool = False):
+        """
+        Insert pending records in batches of batch_size. A failed batch is retried once on
+        the next flush; if it fails again it is counted as failed and dropped, so a batch
+        that can never be written does not block the ones behind it
+        """
+        while self._retry or self._pending:
+            retrying = bool(self._retry)
+            if retrying:
+                batch, self._retry = self._retry, []
+            else:
+                batch = [
+                    self._pending.popleft()
+                    for _ in range(min(self.batch_size, len(self._pending)))
+                ]
+            try:
+                with stage_timer("history_write"):
+                    async with self.session_factory() as db:
+                        await db.execute(insert(QueryHistory), batch)
+                        await db.commit()
+                self.written += len(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} history records: {e}")
+                if drain or retrying:
+                    self.failed += len(batch)
+                    continue
+                # Попробуем ещё раз на следующем цикле
+                self._retry = batch
+                return
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": len(self._pending) + len(self._retry),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+history_writer = HistoryWriter(
+    max_queue=settings.history_queue_size,
+    batch_size=settings.history_batch_size,
+    flush_interval=settings.history_flush_interval
+)
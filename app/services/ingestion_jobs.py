@@ -0,0 +1,388 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+import aiofiles
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.database import get_db_context
+from app.models import Document, IngestionJob
+from app.schemas import IngestionJobStatus
+from app.services.memory_index import memory_index
+from app.services.vector_service import (
+    VectorService, DocumentRejected, iter_upload_chunks, iter_upload_text
+)
+from app.utils.logger import logger
+
+settings = get_settings()
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+
+def new_job_id() -> str:
+    return str(uuid.uuid4())
+
+
+async def spool_upload(stream, job_id: str, suffix: str) -> Path:
+    """
+    Copy an upload to UPLOAD_DIR while validating it (size, UTF-8, minimum length),
+    so the request only pays for the disk write and a rejected file never becomes a job
+    """
+    path = Path(settings.upload_dir) / f"{job_id}{suffix}"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    
+    try:
+        async with aiofiles.open(path, "wb") as out:
+            async for data, _text in iter_upload_text(
+                stream, max_bytes=settings.max_upload_size_mb * 1024 * 1024
+            ):
+                if data:
+                    await out.write(data)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    
+    return path
+
+
+async def file_chunks(path: Path, skip: int = 0) -> AsyncIterator[str]:
+    """Chunks of a spooled upload, streamed from disk; the first `skip` are dropped"""
+    async with aiofiles.open(path, "rb") as f:
+        index = 0
+        async for chunk in iter_upload_chunks(
+            f,
+            max_bytes=settings.max_upload_size_mb * 1024 * 1024,
+            chunk_size=settings.chunk_size,
+            overlap=settings.chunk_overlap
+        ):
+            if index >= skip:
+                yield chunk
+            index += 1
+
+
+async def create_job(db: AsyncSession, job_id: str, filename: str, path: Path) -> IngestionJob:
+    job = IngestionJob(id=job_id, filename=filename, path=str(path), status=JOB_QUEUED)
+    db.add(job)
+    await db.commit()
+    return job
+
+
+async def claim_next_job(db: AsyncSession) -> Optional[str]:
+    """
+    Atomically take the oldest queued job, or a running one whose worker stopped
+    heartbeating (process restart); SKIP LOCKED keeps concurrent workers apart.
+    The claim increments attempts, which is the token run_job writes under
+    """
+    stale_before = func.now() - timedelta(seconds=settings.ingestion_stale_after)
+    is_stale = (IngestionJob.status == JOB_RUNNING) & (IngestionJob.updated_at < stale_before)
+    
+    # Задачи, которые падали слишком много раз, больше не перезапускаем
+    abandoned = await db.execute(
+        update(IngestionJob)
+        .where(is_stale, IngestionJob.attempts >= settings.ingestion_max_attempts)
+        .values(
+            status=JOB_FAILED,
+            error="Interrupted too many times",
+            finished_at=func.now(),
+            updated_at=func.now()
+        )
+        .returning(IngestionJob.id, IngestionJob.path)
+        .execution_options(synchronize_session=False)
+    )
+    abandoned = abandoned.all()
+    if abandoned:
+        await db.execute(delete(Document).where(Document.job_id.in_([row.id for row in abandoned])))
+    
+    candidate = (
+        select(IngestionJob.id)
+        .where(
+            or_(IngestionJob.status == JOB_QUEUED, is_stale),
+            IngestionJob.attempts < settings.ingestion_max_attempts
+        )
+        .order_by(IngestionJob.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        update(IngestionJob)
+        .where(IngestionJob.id == candidate)
+        .values(
+            status=JOB_RUNNING,
+            attempts=IngestionJob.attempts + 1,
+            started_at=func.coalesce(IngestionJob.started_at, func.now()),
+            updated_at=func.now()
+        )
+        .returning(IngestionJob.id)
+        .execution_options(synchronize_session=False)
+    )
+    job_id = result.scalar_one_or_none()
+    await db.commit()
+    
+    for row in abandoned:
+        Path(row.path).unlink(missing_ok=True)
+    
+    return job_id
+
+
+class ClaimLost(RuntimeError):
+    """The job was reclaimed by another worker; this one must stop writing to it"""
+
+
+async def _set_job(db: AsyncSession, job_id: str, attempt: int, **values):
+    """
+    Update and commit a job held under claim `attempt` (its attempts counter at claim time);
+    raises ClaimLost, before committing, once another worker has reclaimed it
+    """
+    result = await db.execute(
+        update(IngestionJob)
+        .where(IngestionJob.id == job_id, IngestionJob.attempts == attempt)
+        .values(updated_at=func.now(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        raise ClaimLost(f"ingestion job {job_id} was reclaimed by another worker")
+    await db.commit()
+
+
+async def _heartbeat(job_id: str, attempt: int):
+    """Touch updated_at every INGESTION_STALE_AFTER / 3 so a slow job is not reclaimed while it runs"""
+    while True:
+        await asyncio.sleep(settings.ingestion_stale_after / 3)
+        try:
+            # Своя сессия: сессию run_job в это время использует загрузка
+            async with get_db_context() as db:
+                await _set_job(db, job_id, attempt)
+        except ClaimLost:
+            logger.warning(f"Ingestion job {job_id} was reclaimed, heartbeat stopped")
+            return
+        except Exception as e:
+            logger.error(f"Ingestion job {job_id} heartbeat failed: {e}")
+
+
+async def run_job(job_id: str):
+    """
+    Ingest a claimed job. Chunks and progress are committed together window by window,
+    so a job interrupted by a restart resumes after its last committed chunk. A heartbeat
+    keeps the claim fresh; every write checks the claim, so a worker whose job was
+    reclaimed rolls back its current window and stops.
+    """
+    async with get_db_context() as db:
+        path: Optional[Path] = None
+        attempt: Optional[int] = None
+        heartbeat: Optional[asyncio.Task] = None
+        
+        try:
+            job = await db.get(IngestionJob, job_id)
+            if job is None:
+                raise LookupError(f"ingestion job {job_id} no longer exists")
+            filename, path = job.filename, Path(job.path)
+            done, attempt = job.chunks_done, job.attempts
+            heartbeat = asyncio.create_task(_heartbeat(job_id, attempt))
+            
+            if job.chunks_total is None:
+                total = 0
+                async for _ in file_chunks(path):
+                    total += 1
+                await _set_job(db, job_id, attempt, chunks_total=total)
+            
+            if done:
+                # Чанки после последнего зафиксированного окна (если есть) вставятся заново
+                await db.execute(delete(Document).where(
+                    Document.job_id == job_id,
+                    Document.chunk_index >= done
+                ))
+                logger.info(f"Resuming ingestion job {job_id} at chunk {done}")
+            
+            async def on_window(chunks: int, embedded: int):
+                await _set_job(
+                    db,
+                    job_id,
+                    attempt,
+                    chunks_done=IngestionJob.chunks_done + chunks,
+                    chunks_embedded=IngestionJob.chunks_embedded + embedded,
+                    chunks_reused=IngestionJob.chunks_reused + (chunks - embedded)
+                )
+            
+            report = await VectorService(db).add_document_stream(
+                filename,
+                file_chunks(path, skip=done),
+                job_id=job_id,
+                start_index=done,
+                on_window=on_window
+            )
+            await _set_job(db, job_id, attempt, status=JOB_COMPLETED, error=None, finished_at=func.now())
+            path.unlink(missing_ok=True)
+            memory_index.request_refresh()
+            logger.info(f"Ingestion job {job_id} ({filename}) completed: {done + report.chunks} chunks")
+        
+        except asyncio.CancelledError:
+            # Остановка воркера: возвращаем задачу в очередь, не расходуя попытку
+            async def requeue():
+                await db.rollback()
+                if attempt is not None:
+                    await _set_job(db, job_id, attempt, status=JOB_QUEUED, attempts=IngestionJob.attempts - 1)
+            
+            try:
+                await asyncio.shield(requeue())
+            except ClaimLost:
+                pass
+            raise
+        
+        except ClaimLost as e:
+            # Незафиксированное окно откатываем; задачу ведёт другой воркер
+            logger.warning(f"Stopping ingestion job {job_id}: {e}")
+            await db.rollback()
+        
+        except Exception as e:
+            logger.error(f"Ingestion job {job_id} failed: {e}", exc_info=True)
+            await db.rollback()
+            if attempt is None:
+                # Задача не загрузилась: если она ещё существует, её подхватят как зависшую
+                return
+            
+            try:
+                if isinstance(e, DocumentRejected) or attempt >= settings.ingestion_max_attempts:
+                    await db.execute(delete(Document).where(Document.job_id == job_id))
+                    await _set_job(db, job_id, attempt, status=JOB_FAILED, error=str(e), finished_at=func.now())
+                    path.unlink(missing_ok=True)
+                else:
+                    await _set_job(db, job_id, attempt, status=JOB_QUEUED, error=str(e))
+            except ClaimLost:
+                await db.rollback()
+        
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+
+
+def job_status(job: IngestionJob) -> IngestionJobStatus:
+    """API view of a job with progress and throughput"""
+    progress = 0.0
+    if job.status == JOB_COMPLETED:
+        progress = 1.0
+    elif job.chunks_total:
+        progress = job.chunks_done / job.chunks_total
+    
+    chunks_per_second = 0.0
+    if job.started_at and job.chunks_done:
+        end = job.finished_at or datetime.now(timezone.utc)
+        elapsed = (end - job.started_at).total_seconds()
+        if elapsed > 0:
+            chunks_per_second = job.chunks_done / elapsed
+    
+    return IngestionJobStatus(
+        job_id=job.id,
+        filename=job.filename,
+        status=job.status,
+        chunks_done=job.chunks_done,
+        chunks_total=job.chunks_total,
+        chunks_reused=job.chunks_reused,
+        chunks_embedded=job.chunks_embedded,
+        progress=round(progress, 4),
+        chunks_per_second=round(chunks_per_second, 2),
+        attempts=job.attempts,
+        error=job.error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
+    )
+
+
+class IngestionWorkerPool:
+    """
+    Background workers that claim and run ingestion jobs from the database.
+    notify() wakes them right after an upload; otherwise they poll every poll_interval.
+    """
+    
+    def __init__(self, workers: int, poll_interval: float):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wake: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+    
+    async def start(self):
+        if self._tasks or self.workers <= 0:
+            return
+        self._wake = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._run(), name=f"ingestion-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} ingestion workers")
+    
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _run(self):
+        while True:
+            try:
+                async with get_db_context() as db:
+                    job_id = await claim_next_job(db)
+            except Exception as e:
+                logger.error(f"Failed to claim ingestion job: {e}")
+                job_id = None
+            
+            if job_id is not None:
+                try:
+                    await run_job(job_id)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Например, БД недоступна и в обработчике ошибки: воркер не должен умереть молча
+                    logger.error(f"Ingestion worker failed on job {job_id}: {e}", exc_info=True)
+                continue
+            
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+
+worker_pool = IngestionWorkerPool(
+    workers=settings.ingestion_workers,
+    poll_interval=settings.ingestion_poll_interval
+)
+
+
+async def _run_standalone():
+    """Dedicated worker process: python -m app.services.ingestion_jobs"""
+    from app.database import init_db, close_db
+    from app.redis_client import init_redis, close_redis
+    from app.utils.tokens import load_encoding
+    
+    await init_db()
+    await init_redis()
+    await load_encoding()
+    
+    pool = IngestionWorkerPool(
+        workers=max(settings.ingestion_workers, 1),
+        poll_interval=settings.ingestion_poll_interval
+    )
+    await pool.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await pool.stop()
+        await close_redis()
+        await close_db()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_run_standalone())
+    except KeyboardInterrupt:
+        pass
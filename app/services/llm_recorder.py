@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from app.config import get_settings
+from app.services.embedding_cache import pack_embedding, unpack_embedding
+from app.utils.logger import logger
+
+settings = get_settings()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_calls (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    response BLOB NOT NULL,
+    tokens INTEGER NOT NULL,
+    latency_ms REAL NOT NULL,
+    recorded_at REAL NOT NULL
+)
+"""
+
+
+class ReplayMissError(LookupError):
+    """Replay mode got a request that was never recorded"""
+
+
+def request_key(kind: str, request: Dict) -> str:
+    """Hash of everything that changes the response: model, options, input or messages"""
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(f"{kind}:{canonical}".encode()).hexdigest()
+
+
+class LLMRecorder:
+    """
+    Record/replay of OpenAI calls made by LLMService.
+    record: calls go to the API and every request→response pair is saved to an SQLite file
+    (embeddings as packed float32, answers as text, with token usage and upstream latency).
+    replay: responses come from the file only, with no network; an unknown request raises
+    ReplayMissError. Streaming and plain generation share recordings.
+    SQLite reads and commits run in a worker thread, off the event loop.
+    """
+    
+    def __init__(self, mode: str = "off", path: str = "llm_recordings.sqlite3"):
+        self.mode = mode
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        # Одно соединение на все потоки to_thread: запросы к нему по очереди
+        self._lock = threading.Lock()
+        
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        # Сколько времени эти ответы занимали у OpenAI при записи
+        self.replayed_upstream_seconds = 0.0
+    
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+    
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    
+    def configure(self, mode: str, path: Optional[str] = None):
+        self.close()
+        self.mode = mode
+        self.path = path or self.path
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.replaying and not Path(self.path).exists():
+                raise ReplayMissError(f"No LLM recordings at {self.path}, run once with LLM_RECORD_MODE=record")
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(SCHEMA)
+            logger.info(f"LLM {self.mode}: {self.path}")
+        return self._conn
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def _save(self, kind: str, request: Dict, response: bytes, tokens: int, seconds: float):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_calls VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (request_key(kind, request), kind, request.get("model", ""), response,
+                 tokens or 0, round(seconds * 1000, 2), time.time())
+            )
+            self.conn.commit()
+            self.recorded += 1
+    
+    def _load(self, kind: str, request: Dict) -> Tuple[bytes, int]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT response, tokens, latency_ms FROM llm_calls WHERE key = ?",
+                (request_key(kind, request),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                raise ReplayMissError(
+                    f"No recorded {kind} response for this request in {self.path}; "
+                    f"record it with LLM_RECORD_MODE=record"
+                )
+            self.replayed += 1
+            self.replayed_upstream_seconds += row[2] / 1000
+        return row[0], row[1]
+    
+    async def record_embedding(self, request: Dict, embedding: List[float], tokens: int, seconds: float):
+        await asyncio.to_thread(self._save, "embedding", request, pack_embedding(embedding), tokens, seconds)
+    
+    async def replay_embedding(self, request: Dict) -> List[float]:
+        packed, _ = await asyncio.to_thread(self._load, "embedding", request)
+        return unpack_embedding(packed)
+    
+    async def record_answer(self, request: Dict, answer: str, tokens: int, seconds: float):
+        await asyncio.to_thread(self._save, "chat", request, answer.encode("utf-8"), tokens, seconds)
+    
+    async def replay_answer(self, request: Dict) -> Tuple[str, int]:
+        answer, tokens = await asyncio.to_thread(self._load, "chat", request)
+        return answer.decode("utf-8"), tokens
+    
+    def stats(self) -> Dict:
+        return {
+            "mode": self.mode,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses,
+            "replayed_upstream_seconds": round(self.replayed_upstream_seconds, 3),
+        }
+
+
+llm_recorder = LLMRecorder(settings.llm_record_mode, settings.llm_record_path)
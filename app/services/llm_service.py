@@ -1,34 +1,134 @@
+import time
 from openai import AsyncOpenAI
-from typing import List, Tuple
+from typing import AsyncIterator, List, Optional, Tuple
 from app.config import get_settings
+from app.services.embedding_cache import embedding_cache
+from app.services.llm_recorder import llm_recorder
+from app.services.upstream import embedding_breaker, embedding_latency, generation_breaker, guarded_call
 from app.utils.logger import logger
+from app.utils.metrics import record_openai_usage
 
 settings = get_settings()
-client = AsyncOpenAI(api_key=settings.openai_api_key)
+# Таймаут и повторы клиента — верхняя граница; ответы ограничены дедлайнами стадий (upstream.guarded_call)
+client = AsyncOpenAI(
+    api_key=settings.openai_api_key,
+    base_url=settings.openai_base_url,
+    timeout=settings.openai_timeout,
+    max_retries=settings.openai_max_retries
+)
+
+SYSTEM_PROMPT = """Ты - умный помощник по продукту SmartTask. 
+Отвечай на вопросы пользователей используя предоставленный контекст.
+Если информации нет в контексте, честно скажи об этом.
+Отвечай кратко и по делу на русском языке."""
+
+
+def embedding_options() -> dict:
+    """text-embedding-3 models can return shorter vectors (EMBEDDING_DIMENSIONS)"""
+    if settings.embedding_model.startswith("text-embedding-3"):
+        return {"dimensions": settings.embedding_dimensions}
+    return {}
+
+
+def embedding_request(text: str) -> dict:
+    return {"model": settings.embedding_model, **embedding_options(), "input": text}
+
+
+async def _failures_counted(stream, breaker) -> AsyncIterator:
+    """Chunks of a started stream; a stream broken midway counts as a failure of the circuit"""
+    try:
+        async for chunk in stream:
+            yield chunk
+    except Exception:
+        breaker.record_failure()
+        raise
 
 
 class LLMService:
     @staticmethod
     async def get_embedding(text: str) -> List[float]:
-        """Получаем embedding для текста"""
+        """Получаем embedding для текста (через LRU + Redis кэш)"""
+        # При записи кэш пропускаем, иначе попавшие в него тексты не попадут в запись
+        if not llm_recorder.recording:
+            cached = await embedding_cache.get(text)
+            if cached is not None:
+                return cached
+        
+        request = embedding_request(text)
         try:
-            response = await client.embeddings.create(
-                model=settings.embedding_model,
-                input=text
+            if llm_recorder.replaying:
+                embedding = await llm_recorder.replay_embedding(request)
+                await embedding_cache.set(text, embedding)
+                return embedding
+            
+            start = time.perf_counter()
+            response = await guarded_call(
+                embedding_breaker,
+                lambda: client.embeddings.create(**request),
+                settings.embedding_deadline,
+                latency=embedding_latency
             )
-            return response.data[0].embedding
+            record_openai_usage(settings.embedding_model, getattr(response, "usage", None), embedding=True)
+            embedding = response.data[0].embedding
+            if llm_recorder.recording:
+                tokens = response.usage.total_tokens if getattr(response, "usage", None) else 0
+                await llm_recorder.record_embedding(request, embedding, tokens, time.perf_counter() - start)
+            await embedding_cache.set(text, embedding)
+            return embedding
         except Exception as e:
             logger.error(f"Error getting embedding: {e}")
             raise
     
     @staticmethod
-    async def generate_answer(question: str, context: str) -> Tuple[str, int]:
-        """Генерируем ответ используя контекст из RAG"""
-        system_prompt = """Ты - умный помощник по продукту SmartTask. 
-Отвечай на вопросы пользователей используя предоставленный контекст.
-Если информации нет в контексте, честно скажи об этом.
-Отвечай кратко и по делу на русском языке."""
+    async def get_query_embeddings(texts: List[str]) -> List[List[float]]:
+        """Embeddings of several questions: cache lookups in one MGET, the misses in one API call"""
+        if llm_recorder.recording:
+            embeddings = [None] * len(texts)
+        else:
+            embeddings = await embedding_cache.get_many(texts)
         
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            batch = [texts[i] for i in missing]
+            if llm_recorder.replaying:
+                fresh = await LLMService.get_embeddings(batch)
+            else:
+                fresh = await guarded_call(
+                    embedding_breaker, lambda: LLMService.get_embeddings(batch), settings.embedding_deadline
+                )
+            for i, embedding in zip(missing, fresh):
+                embeddings[i] = embedding
+            await embedding_cache.set_many([(texts[i], embeddings[i]) for i in missing])
+        return embeddings
+    
+    @staticmethod
+    async def get_embeddings(texts: List[str]) -> List[List[float]]:
+        """Получаем embeddings для пачки текстов одним запросом"""
+        try:
+            # Записи по одному тексту: пачки при воспроизведении могут быть нарезаны иначе
+            if llm_recorder.replaying:
+                return [await llm_recorder.replay_embedding(embedding_request(text)) for text in texts]
+            
+            start = time.perf_counter()
+            response = await client.embeddings.create(
+                model=settings.embedding_model,
+                **embedding_options(),
+                input=texts
+            )
+            record_openai_usage(settings.embedding_model, getattr(response, "usage", None), embedding=True)
+            embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            if llm_recorder.recording:
+                seconds = (time.perf_counter() - start) / max(len(texts), 1)
+                for text, embedding in zip(texts, embeddings):
+                    await llm_recorder.record_embedding(embedding_request(text), embedding, 0, seconds)
+            return embeddings
+        except Exception as e:
+            logger.error(f"Error getting batch embeddings ({len(texts)} texts): {e}")
+            raise
+    
+    @staticmethod
+    def _build_messages(question: str, context: str) -> List[dict]:
+        """Системный промпт + контекст из RAG + вопрос пользователя"""
         user_prompt = f"""Контекст из документации:
 {context}
 
@@ -36,19 +136,41 @@ class LLMService:
 
 Ответ:"""
         
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ]
+    
+    @staticmethod
+    def _chat_request(question: str, context: str) -> dict:
+        """Параметры генерации; они же — ключ записи для record/replay"""
+        return {
+            "model": settings.openai_model,
+            "messages": LLMService._build_messages(question, context),
+            "temperature": 0.3,
+            "max_tokens": 500
+        }
+    
+    @staticmethod
+    async def generate_answer(question: str, context: str) -> Tuple[str, int]:
+        """Генерируем ответ используя контекст из RAG"""
+        request = LLMService._chat_request(question, context)
         try:
-            response = await client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=500
+            if llm_recorder.replaying:
+                return await llm_recorder.replay_answer(request)
+            
+            start = time.perf_counter()
+            response = await guarded_call(
+                generation_breaker,
+                lambda: client.chat.completions.create(**request),
+                settings.generation_deadline
             )
             
             answer = response.choices[0].message.content
             tokens = response.usage.total_tokens
+            record_openai_usage(settings.openai_model, response.usage)
+            if llm_recorder.recording:
+                await llm_recorder.record_answer(request, answer, tokens, time.perf_counter() - start)
             
             logger.info(f"LLM response: {tokens} tokens")
             return answer, tokens
@@ -56,3 +178,47 @@ class LLMService:
         except Exception as e:
             logger.error(f"Error generating answer: {e}")
             raise
+    
+    @staticmethod
+    async def stream_answer(question: str, context: str) -> AsyncIterator[Tuple[str, Optional[int]]]:
+        """
+        Генерируем ответ потоком: (фрагмент текста, None) по мере генерации,
+        последним приходит ("", total_tokens)
+        """
+        request = LLMService._chat_request(question, context)
+        try:
+            if llm_recorder.replaying:
+                answer, tokens = await llm_recorder.replay_answer(request)
+                yield answer, None
+                yield "", tokens
+                return
+            
+            start = time.perf_counter()
+            # Дедлайн — до начала потока; дальше токены уже уходят клиенту
+            stream = await guarded_call(
+                generation_breaker,
+                lambda: client.chat.completions.create(
+                    **request,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                ),
+                settings.generation_deadline
+            )
+            
+            parts = []
+            async for chunk in _failures_counted(stream, generation_breaker):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content, None
+                if chunk.usage is not None:
+                    record_openai_usage(settings.openai_model, chunk.usage)
+                    logger.info(f"LLM streamed response: {chunk.usage.total_tokens} tokens")
+                    if llm_recorder.recording:
+                        await llm_recorder.record_answer(
+                            request, "".join(parts), chunk.usage.total_tokens, time.perf_counter() - start
+                        )
+                    yield "", chunk.usage.total_tokens
+                    
+        except Exception as e:
+            logger.error(f"Error streaming answer: {e}")
+            raise
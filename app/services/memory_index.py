@@ -0,0 +1,279 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.database import get_db_context
+from app.models import Document
+from app.utils.logger import logger
+
+settings = get_settings()
+
+LOAD_PARTITION = 5000
+META_COLUMNS = (Document.id, Document.filename, Document.content, Document.chunk_index, Document.token_count)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale rows to unit length in place (zero rows stay zero), so dot product == cosine"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+class MemoryIndex:
+    """
+    Exact top-k search over every chunk embedding held in RAM.
+    The bulk of the matrix is a float32 .npy snapshot opened with mmap, so API workers
+    on one host share the same page cache; rows inserted after the snapshot live in a
+    small in-memory delta. Chunk texts stay in process memory, so a search needs no
+    database round trip at all.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        
+        self._base = np.zeros((0, 0), dtype=np.float32)
+        self._delta = np.zeros((0, 0), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._meta: Dict[int, Tuple[str, str, int, Optional[int]]] = {}
+        self._max_id = 0
+        
+        self._refresh_lock = asyncio.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        
+        self.full_loads = 0
+        self.refreshes = 0
+        self.loaded_at: Optional[float] = None
+    
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at is not None
+    
+    def __len__(self) -> int:
+        return len(self._ids)
+    
+    def search(self, query_embedding: Sequence[float], top_k: int = 3) -> List[Tuple]:
+        """Top-k (filename, content, cosine similarity, chunk_index, token_count), as the pgvector search"""
+        n = len(self._ids)
+        k = min(top_k, n)
+        if k <= 0:
+            return []
+        
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        
+        parts = [m @ query for m in (self._base, self._delta) if len(m)]
+        scores = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        
+        # argpartition — O(n) выбор k лучших, сортируем только их
+        top = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        
+        results = []
+        for i in top:
+            filename, content, chunk_index, token_count = self._meta[int(self._ids[i])]
+            results.append((filename, content, float(scores[i]), chunk_index, token_count))
+        return results
+    
+    def append_rows(self, rows: Sequence) -> int:
+        """Add (id, filename, content, embedding, chunk_index, token_count) rows to the in-memory delta"""
+        if not rows:
+            return 0
+        
+        matrix = normalize_rows(np.asarray([row[3] for row in rows], dtype=np.float32))
+        self._delta = matrix if not len(self._delta) else np.vstack([self._delta, matrix])
+        self._ids = np.concatenate([self._ids, np.asarray([row[0] for row in rows], dtype=np.int64)])
+        for row in rows:
+            self._meta[int(row[0])] = (row[1], row[2], row[4], row[5])
+        self._max_id = max(self._max_id, int(rows[-1][0]))
+        if self.loaded_at is None:
+            self.loaded_at = time.time()
+        return len(rows)
+    
+    async def load(self, db: AsyncSession):
+        """Full (re)load: reuse the snapshot for the current table state or write a new one"""
+        count, max_id = (await db.execute(
+            select(func.count(Document.id), func.coalesce(func.max(Document.id), 0))
+            .where(Document.embedding.isnot(None))
+        )).one()
+        
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Размер векторов в сигнатуре: после смены EMBEDDING_DIMENSIONS старый снапшот не подойдёт
+        signature = f"{settings.embedding_dimensions}d-{max_id}-{count}"
+        matrix_path = self.directory / f"embeddings-{signature}.npy"
+        ids_path = self.directory / f"ids-{signature}.npy"
+        in_snapshot = Document.embedding.isnot(None) & (Document.id <= max_id)
+        
+        meta: Dict[int, Tuple[str, str, int, Optional[int]]] = {}
+        
+        if matrix_path.exists() and ids_path.exists():
+            # Снапшот уже записан другим воркером: читаем только тексты, без векторов
+            result = await db.stream(
+                select(*META_COLUMNS).where(in_snapshot)
+            )
+            async for partition in result.partitions(LOAD_PARTITION):
+                for row in partition:
+                    meta[row.id] = (row.filename, row.content, row.chunk_index, row.token_count)
+            
+            if not all(int(i) in meta for i in np.load(ids_path)):
+                meta = {}
+        
+        if not meta:
+            signature, meta = await self._write_snapshot(db, in_snapshot, max_id, count)
+            matrix_path = self.directory / f"embeddings-{signature}.npy"
+            ids_path = self.directory / f"ids-{signature}.npy"
+        
+        base = np.load(matrix_path, mmap_mode="r")
+        ids = np.load(ids_path)
+        
+        self._base = base[:len(ids)] if len(ids) else np.zeros((0, 0), dtype=np.float32)
+        self._delta = np.zeros((0, 0), dtype=np.float32)
+        self._ids = ids
+        self._meta = meta
+        self._max_id = int(max_id)
+        self.loaded_at = time.time()
+        self.full_loads += 1
+        logger.info(f"Memory index loaded: {len(ids)} chunks from {matrix_path.name}")
+    
+    async def _write_snapshot(self, db: AsyncSession, in_snapshot, max_id: int, count: int):
+        """Stream vectors from Postgres into a new normalized .npy snapshot; returns (signature, texts)"""
+        matrix_path = self.directory / f"embeddings-{settings.embedding_dimensions}d-{max_id}-{count}.npy"
+        suffix = f".{os.getpid()}.tmp.npy"
+        tmp_matrix = matrix_path.with_suffix(suffix)
+        tmp_ids = self.directory / f"ids{suffix}"
+        meta: Dict[int, Tuple[str, str, int, Optional[int]]] = {}
+        matrix = None
+        ids = np.zeros(count, dtype=np.int64)
+        n = 0
+        
+        result = await db.stream(
+            select(*META_COLUMNS, Document.embedding)
+            .where(in_snapshot)
+            .order_by(Document.id)
+        )
+        async for partition in result.partitions(LOAD_PARTITION):
+            for row in partition:
+                if n >= count:
+                    break
+                vector = np.asarray(row.embedding, dtype=np.float32)
+                if matrix is None:
+                    matrix = np.lib.format.open_memmap(
+                        tmp_matrix, mode="w+", dtype=np.float32, shape=(count, len(vector))
+                    )
+                matrix[n] = vector
+                ids[n] = row.id
+                meta[row.id] = (row.filename, row.content, row.chunk_index, row.token_count)
+                n += 1
+        
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(tmp_matrix, mode="w+", dtype=np.float32, shape=(0, 0))
+        normalize_rows(matrix[:n])
+        matrix.flush()
+        del matrix
+        np.save(tmp_ids, ids[:n])
+        
+        # Если строки удалили во время загрузки, сигнатура — по фактическому числу строк
+        signature = f"{settings.embedding_dimensions}d-{max_id}-{n}"
+        os.replace(tmp_ids, self.directory / f"ids-{signature}.npy")
+        os.replace(tmp_matrix, self.directory / f"embeddings-{signature}.npy")
+        self._remove_old_snapshots(signature)
+        return signature, meta
+    
+    def _remove_old_snapshots(self, keep: str):
+        # Файлы, которые ещё отображены другими воркерами, Linux удалит после их закрытия
+        for path in self.directory.glob("*.npy"):
+            if not path.name.endswith(f"-{keep}.npy") and ".tmp." not in path.name:
+                path.unlink(missing_ok=True)
+    
+    async def refresh(self, db: AsyncSession) -> int:
+        """
+        Pick up rows inserted since the last load; falls back to a full reload when rows
+        were deleted (or committed out of id order) and when the delta outgrows the snapshot
+        """
+        async with self._refresh_lock:
+            if not self.ready:
+                await self.load(db)
+                return len(self)
+            
+            # Одного count мало: DELETE + INSERT того же числа строк его не меняет, а max(id) растёт
+            count, max_id = (await db.execute(
+                select(func.count(Document.id), func.coalesce(func.max(Document.id), 0))
+                .where(Document.embedding.isnot(None))
+            )).one()
+            if count == len(self._ids) and max_id == self._max_id:
+                return 0
+            
+            result = await db.execute(
+                select(
+                    Document.id, Document.filename, Document.content, Document.embedding,
+                    Document.chunk_index, Document.token_count
+                )
+                .where(Document.embedding.isnot(None), Document.id > self._max_id)
+                .order_by(Document.id)
+            )
+            rows = result.all()
+            
+            if count != len(self._ids) + len(rows) or len(self._delta) + len(rows) > max(1000, len(self._base) // 4):
+                await self.load(db)
+                return len(self)
+            
+            added = self.append_rows(rows)
+            self.refreshes += 1
+            logger.info(f"Memory index refreshed: +{added} chunks")
+            return added
+    
+    def request_refresh(self):
+        """Wake the refresh loop now (e.g. right after an upload finished)"""
+        if self._wake is not None:
+            self._wake.set()
+    
+    async def start(self, refresh_interval: float):
+        if self._task is not None:
+            return
+        async with get_db_context() as db:
+            await self.load(db)
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(refresh_interval))
+    
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+    
+    async def _run(self, refresh_interval: float):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            
+            try:
+                async with get_db_context() as db:
+                    await self.refresh(db)
+            except Exception as e:
+                logger.error(f"Memory index refresh failed: {e}")
+    
+    def stats(self) -> Dict:
+        return {
+            "enabled": settings.memory_index_enabled,
+            "ready": self.ready,
+            "chunks": len(self._ids),
+            "mmapped_chunks": len(self._base),
+            "delta_chunks": len(self._delta),
+            "full_loads": self.full_loads,
+            "refreshes": self.refreshes,
+        }
+
+
+memory_index = MemoryIndex(settings.memory_index_dir)
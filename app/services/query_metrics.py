@@ -0,0 +1,294 @@
+import asyncio
+import math
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import redis.asyncio as redis
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.models import QueryHistory
+from app.redis_client import get_redis
+from app.utils.logger import logger
+from app.utils.metrics import REQUEST_SECONDS, LatencyHistogram
+
+settings = get_settings()
+
+METRICS_PREFIX = "faq:metrics"
+TOTAL_KEY = f"{METRICS_PREFIX}:total"
+# Поле TOTAL_KEY: время, когда итоги были засеяны из query_history (один раз)
+SEEDED_FIELD = "seeded_at"
+
+# Разрешение rollup -> (ширина бакета, TTL, сколько бакетов читает /api/metrics)
+ROLLUPS = {
+    "minute": (60, 3 * 3600, 60),
+    "hour": (3600, 8 * 86400, 24),
+}
+
+# Только для вычисления номера бакета при записи
+LATENCY_BUCKETS = LatencyHistogram()
+
+COUNTER_FIELDS = (
+    "queries", "cache_hits", "latency_ms", "generated", "tokens", "context_tokens", "context_saved"
+)
+
+
+def rollup_key(resolution: str, bucket_start: int) -> str:
+    return f"{METRICS_PREFIX}:{resolution}:{bucket_start}"
+
+
+def bucket_start(timestamp: float, width: int) -> int:
+    return int(timestamp // width) * width
+
+
+class QueryMetrics:
+    """
+    Query counters and latency histograms kept in time-bucketed Redis hashes.
+    Completed queries are aggregated in process memory and merged into the per-minute,
+    per-hour and total hashes with one pipelined HINCRBY batch every flush_interval,
+    so reading the metrics costs a fixed number of hashes however long the history is.
+    """
+    
+    def __init__(self, flush_interval: float, redis_client: Optional[redis.Redis] = None):
+        self.flush_interval = flush_interval
+        self._redis = redis_client
+        
+        # начало минуты -> поле hash -> приращение
+        self._pending: Dict[int, Dict[str, int]] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        
+        self.flushes = 0
+        self.failed = 0
+    
+    @property
+    def client(self) -> redis.Redis:
+        return self._redis or get_redis()
+    
+    def _add(self, now: Optional[float], **increments: int):
+        minute = bucket_start(time.time() if now is None else now, ROLLUPS["minute"][0])
+        fields = self._pending.setdefault(minute, {})
+        for name, value in increments.items():
+            if value:
+                fields[name] = fields.get(name, 0) + value
+    
+    def record_query(self, response_time: float, cached: bool, now: Optional[float] = None):
+        """Count one answered question (cached or generated) and its latency"""
+        REQUEST_SECONDS.labels(str(bool(cached)).lower()).observe(response_time)
+        latency_ms = response_time * 1000
+        self._add(
+            now,
+            queries=1,
+            cache_hits=int(cached),
+            latency_ms=int(round(latency_ms)),
+            **{f"h:{LATENCY_BUCKETS.bucket(latency_ms)}": 1}
+        )
+    
+    def record_generation(
+        self,
+        tokens: int,
+        context_tokens: Optional[int] = None,
+        context_saved: Optional[int] = None,
+        now: Optional[float] = None
+    ):
+        """Count one LLM-generated answer with its token usage"""
+        self._add(
+            now,
+            generated=1,
+            tokens=tokens or 0,
+            context_tokens=context_tokens or 0,
+            context_saved=context_saved or 0
+        )
+    
+    async def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+    
+    async def flush(self):
+        """Merge pending increments into the minute, hour and total rollups in one round trip"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for minute, fields in pending.items():
+                    for resolution, (width, ttl, _) in ROLLUPS.items():
+                        key = rollup_key(resolution, bucket_start(minute, width))
+                        for name, value in fields.items():
+                            pipe.hincrby(key, name, value)
+                        pipe.expire(key, ttl)
+                    for name, value in fields.items():
+                        pipe.hincrby(TOTAL_KEY, name, value)
+                await pipe.execute()
+            self.flushes += 1
+        except Exception as e:
+            # Счётчики аддитивны: вернём их и сольём со следующим flush
+            logger.error(f"Query metrics flush failed: {e}")
+            self.failed += 1
+            for minute, fields in pending.items():
+                self._add(minute, **fields)
+    
+    async def seed_from_history(self, db: AsyncSession) -> bool:
+        """
+        Add the answers already in query_history to the all-time totals, once: the worker
+        that claims SEEDED_FIELD with HSETNX runs one aggregate over rows older than the claim.
+        History holds generated answers only, so cache hits before the rollups stay uncounted.
+        """
+        seeded_at = time.time()
+        try:
+            if not await self.client.hsetnx(TOTAL_KEY, SEEDED_FIELD, int(seeded_at)):
+                return False
+        except Exception as e:
+            logger.error(f"Query metrics seed skipped: {e}")
+            return False
+        
+        latency_ms = QueryHistory.response_time * 1000
+        bucket = case(
+            (latency_ms < 1, 0),
+            else_=func.floor(func.ln(latency_ms) / math.log(LATENCY_BUCKETS.growth)) + 1
+        ).label("bucket")
+        try:
+            rows = (await db.execute(
+                select(
+                    bucket,
+                    func.count(QueryHistory.id).label("queries"),
+                    func.coalesce(func.sum(latency_ms), 0).label("latency_ms"),
+                    func.coalesce(func.sum(QueryHistory.tokens_used), 0).label("tokens"),
+                    func.coalesce(func.sum(QueryHistory.context_tokens), 0).label("context_tokens"),
+                    func.coalesce(func.sum(QueryHistory.context_tokens_saved), 0).label("context_saved"),
+                )
+                .where(QueryHistory.response_time.is_not(None))
+                .where(QueryHistory.timestamp < datetime.fromtimestamp(seeded_at, timezone.utc))
+                .group_by(bucket)
+            )).all()
+            
+            totals: Dict[str, int] = {}
+            for row in rows:
+                increments = {
+                    "queries": row.queries,
+                    "generated": row.queries,
+                    "latency_ms": row.latency_ms,
+                    "tokens": row.tokens,
+                    "context_tokens": row.context_tokens,
+                    "context_saved": row.context_saved,
+                    f"h:{int(row.bucket)}": row.queries,
+                }
+                for name, value in increments.items():
+                    totals[name] = totals.get(name, 0) + int(round(value))
+            
+            async with self.client.pipeline(transaction=False) as pipe:
+                for name, value in totals.items():
+                    if value:
+                        pipe.hincrby(TOTAL_KEY, name, value)
+                await pipe.execute()
+        except Exception as e:
+            # Не получилось — отдаём право засеять следующему запуску
+            logger.error(f"Query metrics seed failed: {e}")
+            try:
+                await self.client.hdel(TOTAL_KEY, SEEDED_FIELD)
+            except Exception:
+                pass
+            return False
+        
+        logger.info(f"Query metrics seeded with {totals.get('queries', 0)} queries from query_history")
+        return True
+    
+    async def summary(self, now: Optional[float] = None) -> Dict:
+        """All-time totals plus last-hour (minute rollups) and last-24h (hour rollups) windows"""
+        now = time.time() if now is None else now
+        windows = {
+            "last_hour": ("minute", self._window_keys("minute", now)),
+            "last_24h": ("hour", self._window_keys("hour", now)),
+        }
+        
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.hgetall(TOTAL_KEY)
+                for _, keys in windows.values():
+                    for key in keys:
+                        pipe.hgetall(key)
+                results = await pipe.execute()
+        except Exception as e:
+            # Redis недоступен: нули, остальная часть /api/metrics отдаётся как обычно
+            logger.error(f"Query metrics summary failed: {e}")
+            results = [{}] * (1 + sum(len(keys) for _, keys in windows.values()))
+        
+        total = self._merge(results[:1])
+        summary = self._describe(total)
+        offset = 1
+        for name, (_, keys) in windows.items():
+            summary[name] = self._describe(self._merge(results[offset:offset + len(keys)]))
+            offset += len(keys)
+        return summary
+    
+    @staticmethod
+    def _window_keys(resolution: str, now: float) -> List[str]:
+        width, _, buckets = ROLLUPS[resolution]
+        current = bucket_start(now, width)
+        return [rollup_key(resolution, current - i * width) for i in range(buckets)]
+    
+    @staticmethod
+    def _merge(hashes: List[Dict]) -> Dict:
+        counters = dict.fromkeys(COUNTER_FIELDS, 0)
+        histogram = LatencyHistogram()
+        for raw in hashes:
+            for name, value in (raw or {}).items():
+                name = name.decode() if isinstance(name, bytes) else name
+                if name == SEEDED_FIELD:
+                    continue
+                if name.startswith("h:"):
+                    bucket = int(name[2:])
+                    histogram.counts[bucket] = histogram.counts.get(bucket, 0) + int(value)
+                else:
+                    counters[name] = counters.get(name, 0) + int(value)
+        counters["histogram"] = histogram
+        return counters
+    
+    @staticmethod
+    def _describe(counters: Dict) -> Dict:
+        queries = counters["queries"]
+        generated = counters["generated"]
+        return {
+            "queries": queries,
+            "cache_hits": counters["cache_hits"],
+            "cache_hit_rate": round(counters["cache_hits"] / queries, 4) if queries else 0.0,
+            "avg_response_time_ms": round(counters["latency_ms"] / queries, 1) if queries else 0.0,
+            **counters["histogram"].summary(),
+            "generated": generated,
+            "tokens": counters["tokens"],
+            "avg_tokens_per_generated": round(counters["tokens"] / generated, 1) if generated else 0.0,
+            "context_tokens": counters["context_tokens"],
+            "context_tokens_saved": counters["context_saved"],
+        }
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending_minutes": len(self._pending),
+            "flushes": self.flushes,
+            "failed": self.failed,
+        }
+
+
+query_metrics = QueryMetrics(flush_interval=settings.metrics_flush_interval)
@@ -1,50 +1,409 @@
+import asyncio
 import time
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.services.llm_service import LLMService
 from app.services.vector_service import VectorService
+from app.services.context_packer import PackedContext, pack_context
+from app.services.fallback import UNAVAILABLE_ANSWER, extractive_answer
 from app.services.cache_service import CacheService
+from app.services.semantic_cache_service import SemanticCacheService
 from app.schemas import AnswerResponse, Source
-from app.models import QueryHistory
+from app.services.history_writer import history_writer
+from app.services.query_metrics import query_metrics
+from app.services.upstream import UpstreamUnavailable
 from app.config import get_settings
+from app.database import get_db_context
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from app.utils.logger import logger
+from app.utils.metrics import FALLBACK_ANSWERS, STAGE_SECONDS, stage_timer, track_time
+from app.utils.singleflight import SingleFlight
 
 settings = get_settings()
 
+NOT_FOUND_ANSWER = "К сожалению, я не нашёл информации по вашему вопросу."
+
+# Одинаковые (после нормализации) вопросы, пропущенные кэшем, выполняются одним pipeline на процесс
+inflight = SingleFlight()
+
 
 class RAGService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession, cache: Optional[CacheService] = None, use_cache: bool = True):
         self.db = db
+        # use_cache=False: ответы только из pipeline, без чтения и записи кэшей ответов (eval с record/replay)
+        self.use_cache = use_cache
         self.llm = LLMService()
         self.vector = VectorService(db)
-        self.cache = CacheService()
+        self.cache = cache or CacheService()
+        self.semantic_cache = SemanticCacheService(db, self.cache.client)
+    
+    @property
+    def semantic_cache_enabled(self) -> bool:
+        return settings.semantic_cache_enabled and self.use_cache
     
     async def answer_question(self, question: str) -> AnswerResponse:
         """Главный метод RAG pipeline"""
         start_time = time.time()
         
+        cached = await self._get_cached(question, start_time)
+        if cached:
+            query_metrics.record_query(cached.response_time, cached=True)
+            return cached
+        
+        # Вызовы без кэшей не должны получать кэшированный ответ чужого pipeline, и наоборот
+        key = self.cache._make_key(question)
+        response = await inflight.do(
+            key if self.use_cache else f"nocache:{key}",
+            lambda: self._answer_shared(question, start_time)
+        )
+        # Вопросы, присоединившиеся к чужому pipeline, считаются отдельными запросами
+        query_metrics.record_query(time.time() - start_time, cached=response.cached)
+        return response.model_copy()
+    
+    async def answer_many(self, questions: List[str]) -> List[AnswerResponse]:
+        """
+        Batch pipeline: one MGET for the exact cache, one embeddings call for the misses,
+        one semantic cache query and one vector search query for all of them; answers are
+        generated concurrently (BATCH_GENERATION_CONCURRENCY) and cached in one batch
+        """
+        start_time = time.time()
+        answers: List[Optional[AnswerResponse]] = [None] * len(questions)
+        
+        with stage_timer("cache_lookup"):
+            cached = await self.cache.get_many(questions) if self.use_cache else [None] * len(questions)
+        
+        # Одинаковые (после нормализации) вопросы пачки считаются один раз
+        pending: Dict[str, List[int]] = {}
+        for i, (question, answer_data) in enumerate(zip(questions, cached)):
+            if answer_data:
+                answer_data.update(cached=True, response_time=time.time() - start_time)
+                answers[i] = AnswerResponse(**answer_data)
+            else:
+                pending.setdefault(self.cache._make_key(question), []).append(i)
+        
+        unique = [questions[positions[0]] for positions in pending.values()]
+        for positions, response in zip(pending.values(), await self._answer_batch_uncached(unique, start_time)):
+            for i in positions:
+                answers[i] = response.model_copy()
+        
+        for answer in answers:
+            query_metrics.record_query(answer.response_time, cached=answer.cached)
+        return answers
+    
+    async def _answer_batch_uncached(self, questions: List[str], start_time: float) -> List[AnswerResponse]:
+        if not questions:
+            return []
+        answers: List[Optional[AnswerResponse]] = [None] * len(questions)
+        
+        try:
+            with stage_timer("embedding"):
+                embeddings = await self.llm.get_query_embeddings(questions)
+        except UpstreamUnavailable as e:
+            logger.warning(f"Embedding unavailable, answering the batch without the LLM: {e}")
+            return [await self._fallback_answer(question, start_time) for question in questions]
+        
+        semantic_hits = {}
+        if self.semantic_cache_enabled:
+            with stage_timer("semantic_cache_lookup"):
+                matches = await self.semantic_cache.lookup_many(embeddings)
+            for i, match in enumerate(matches):
+                if match:
+                    answer_data, _similarity = match
+                    semantic_hits[questions[i]] = dict(answer_data)
+                    answer_data.update(cached=True, response_time=time.time() - start_time)
+                    answers[i] = AnswerResponse(**answer_data)
+        
+        to_search = [i for i, answer in enumerate(answers) if answer is None]
+        with stage_timer("vector_search"):
+            found = await self.vector.search_many(
+                [embeddings[i] for i in to_search], settings.top_k, [questions[i] for i in to_search]
+            )
+        
+        semaphore = asyncio.Semaphore(settings.batch_generation_concurrency)
+        
+        async def generate(i: int, context: PackedContext) -> Tuple[int, PackedContext, Optional[str], int]:
+            async with semaphore:
+                try:
+                    with stage_timer("llm_generation"):
+                        answer, tokens = await self.llm.generate_answer(questions[i], context.text)
+                except UpstreamUnavailable as e:
+                    logger.warning(f"Generation unavailable for a batch question: {e}")
+                    return i, context, None, 0
+                except Exception as e:
+                    # Например, 400 от OpenAI или ReplayMissError: остальные ответы пачки не теряем
+                    logger.error(f"Generation failed for a batch question: {e}", exc_info=True)
+                    return i, context, None, 0
+            return i, context, answer, tokens
+        
+        tasks = []
+        retrieved = dict(zip(to_search, found))
+        for i, similar_docs in retrieved.items():
+            if similar_docs:
+                tasks.append(generate(i, self._build_context(similar_docs)))
+            else:
+                answers[i] = self._not_found(questions[i], start_time)
+        results = await asyncio.gather(*tasks)
+        
+        # Без LLM — по одному, после генерации: сессия БД одна на запрос
+        generated = []
+        for i, context, answer, tokens in results:
+            if answer is None:
+                answers[i] = await self._fallback_answer(questions[i], start_time, embeddings[i], retrieved[i])
+            else:
+                generated.append((i, context, answer, tokens))
+        
+        # Запись в кэши после генерации: сессия БД одна на запрос, параллельно её использовать нельзя
+        to_cache = dict(semantic_hits)
+        for i, context, answer, tokens in generated:
+            response_data = self._record_answer(
+                questions[i], answer, self._build_sources(context.chunks),
+                tokens, time.time() - start_time, context
+            )
+            to_cache[questions[i]] = response_data
+            answers[i] = AnswerResponse(**response_data)
+        
+        with stage_timer("cache_write"):
+            if self.semantic_cache_enabled and generated:
+                await self.semantic_cache.store_many([
+                    (questions[i], embeddings[i], to_cache[questions[i]]) for i, _, _, _ in generated
+                ])
+                await self.db.commit()
+            if self.use_cache:
+                await self.cache.set_many(to_cache)
+        
+        logger.info(f"RAG batch of {len(questions)} questions completed in {time.time() - start_time:.2f}s")
+        return answers
+    
+    async def _answer_shared(self, question: str, start_time: float) -> AnswerResponse:
+        """
+        Work shared by coalesced callers runs on its own DB session: the request-scoped
+        session of the caller that started it is closed when that caller disconnects
+        """
+        async with get_db_context() as db:
+            return await RAGService(db, self.cache, self.use_cache)._answer_uncached(question, start_time)
+    
+    async def _answer_uncached(self, question: str, start_time: float) -> AnswerResponse:
+        """Pipeline after an exact cache miss; optionally coordinated across workers by a Redis lock"""
+        if not settings.singleflight_redis_lock or not self.use_cache:
+            return await self._run_pipeline(question, start_time)
+        
+        token = await self.cache.acquire_lock(question)
+        if token is None:
+            answer_data = await self.cache.wait_for_answer(question, settings.singleflight_wait_timeout)
+            if answer_data:
+                answer_data['cached'] = True
+                answer_data['response_time'] = time.time() - start_time
+                return AnswerResponse(**answer_data)
+            token = await self.cache.acquire_lock(question)
+        
+        try:
+            return await self._run_pipeline(question, start_time)
+        finally:
+            if token is not None:
+                await self.cache.release_lock(question, token)
+    
+    async def _run_pipeline(self, question: str, start_time: float) -> AnswerResponse:
+        try:
+            cached, query_embedding = await self._check_semantic_cache(question, start_time)
+        except UpstreamUnavailable as e:
+            logger.warning(f"Embedding unavailable, answering without the LLM: {e}")
+            return await self._fallback_answer(question, start_time)
+        if cached:
+            return cached
+        
+        with stage_timer("vector_search"):
+            similar_docs = await self.vector.search_by_embedding(
+                query_embedding, settings.top_k, query_text=question
+            )
+        
+        if not similar_docs:
+            return self._not_found(question, start_time)
+        
+        context = self._build_context(similar_docs)
+        try:
+            with stage_timer("llm_generation"):
+                answer, tokens = await self.llm.generate_answer(question, context.text)
+        except UpstreamUnavailable as e:
+            logger.warning(f"Generation unavailable, answering without the LLM: {e}")
+            return await self._fallback_answer(question, start_time, query_embedding, similar_docs)
+        
+        response_data = await self._save_answer(
+            question, query_embedding, answer, self._build_sources(context.chunks),
+            tokens, time.time() - start_time, context
+        )
+        
+        return AnswerResponse(**response_data)
+    
+    async def stream_answer(self, question: str) -> AsyncIterator[Tuple[str, dict]]:
+        """
+        Streaming RAG pipeline: yields ("sources", ...), then ("token", ...) events
+        and finally ("done", ...) once the answer is saved to history and cache
+        """
+        start_time = time.time()
+        
+        cached = await self._get_cached(question, start_time)
+        query_embedding = None
+        if cached is None:
+            try:
+                cached, query_embedding = await self._check_semantic_cache(question, start_time)
+            except UpstreamUnavailable as e:
+                logger.warning(f"Embedding unavailable, answering without the LLM: {e}")
+                cached = await self._fallback_answer(question, start_time)
+        if cached is None:
+            with stage_timer("vector_search"):
+                similar_docs = await self.vector.search_by_embedding(
+                    query_embedding, settings.top_k, query_text=question
+                )
+            if not similar_docs:
+                cached = self._not_found(question, start_time)
+        
+        if cached is not None:
+            query_metrics.record_query(cached.response_time, cached=cached.cached)
+            yield "sources", {"sources": [s.model_dump() for s in cached.sources]}
+            yield "token", {"text": cached.answer}
+            yield "done", {
+                "tokens_used": cached.tokens_used,
+                "response_time": cached.response_time,
+                "cached": cached.cached,
+                "degraded": cached.degraded
+            }
+            return
+        
+        context = self._build_context(similar_docs)
+        sources = self._build_sources(context.chunks)
+        yield "sources", {"sources": [s.model_dump() for s in sources]}
+        
+        parts = []
+        tokens = 0
+        generation_start = time.perf_counter()
+        first_token = True
+        try:
+            async for delta, usage in self.llm.stream_answer(question, context.text):
+                if delta:
+                    if first_token:
+                        STAGE_SECONDS.labels("llm_first_token").observe(time.perf_counter() - generation_start)
+                        first_token = False
+                    parts.append(delta)
+                    yield "token", {"text": delta}
+                if usage is not None:
+                    tokens = usage
+        except UpstreamUnavailable as e:
+            # Поток так и не начался: отвечаем без LLM; оборванный на середине поток — ошибка
+            if parts:
+                raise
+            logger.warning(f"Generation unavailable, answering without the LLM: {e}")
+            fallback = await self._fallback_answer(question, start_time, query_embedding, similar_docs)
+            query_metrics.record_query(fallback.response_time, cached=fallback.cached)
+            yield "token", {"text": fallback.answer}
+            yield "done", {
+                "tokens_used": 0,
+                "response_time": fallback.response_time,
+                "cached": fallback.cached,
+                "degraded": True
+            }
+            return
+        # Включает время, пока клиент читал поток
+        STAGE_SECONDS.labels("llm_generation").observe(time.perf_counter() - generation_start)
+        
+        response_data = await self._save_answer(
+            question, query_embedding, "".join(parts), sources,
+            tokens, time.time() - start_time, context
+        )
+        
+        query_metrics.record_query(response_data["response_time"], cached=False)
+        yield "done", {
+            "tokens_used": tokens,
+            "response_time": response_data["response_time"],
+            "cached": False
+        }
+    
+    @track_time("cache_lookup")
+    async def _get_cached(self, question: str, start_time: float) -> Optional[AnswerResponse]:
+        """Exact (normalized question) cache"""
+        if not self.use_cache:
+            return None
         cached = await self.cache.get(question)
         if cached:
             cached['cached'] = True
             cached['response_time'] = time.time() - start_time
             return AnswerResponse(**cached)
+        return None
+    
+    async def _check_semantic_cache(
+        self, question: str, start_time: float
+    ) -> Tuple[Optional[AnswerResponse], List[float]]:
+        """Embed the question and look for a semantically close cached answer"""
+        with stage_timer("embedding"):
+            query_embedding = await self.llm.get_embedding(question)
         
-        similar_docs = await self.vector.search_similar(question, settings.top_k)
+        if self.semantic_cache_enabled:
+            with stage_timer("semantic_cache_lookup"):
+                match = await self.semantic_cache.lookup(query_embedding)
+            if match:
+                answer_data, _similarity = match
+                await self.cache.set(question, answer_data)
+                answer_data['cached'] = True
+                answer_data['response_time'] = time.time() - start_time
+                return AnswerResponse(**answer_data), query_embedding
         
-        if not similar_docs:
-            return AnswerResponse(
-                answer="К сожалению, я не нашёл информации по вашему вопросу.",
-                sources=[],
-                tokens_used=0,
-                response_time=time.time() - start_time
+        return None, query_embedding
+    
+    async def _fallback_answer(
+        self,
+        question: str,
+        start_time: float,
+        query_embedding: Optional[List[float]] = None,
+        similar_docs: Optional[list] = None
+    ) -> AnswerResponse:
+        """
+        Answer while OpenAI is unavailable (breaker open, deadline, error): the closest cached
+        answer above FALLBACK_CACHE_THRESHOLD, else the best matching sentences of the retrieved
+        chunks (full-text search when there is no embedding). Never written to the caches.
+        """
+        if query_embedding is not None and self.semantic_cache_enabled:
+            match = await self.semantic_cache.lookup(
+                query_embedding, threshold=settings.fallback_cache_threshold, record=False
             )
+            if match:
+                answer_data, _similarity = match
+                answer_data.update(cached=True, degraded=True, response_time=time.time() - start_time)
+                FALLBACK_ANSWERS.labels("cached").inc()
+                return AnswerResponse(**answer_data)
         
-        context = "\n\n".join([
-            f"[{doc[0]}]\n{doc[1]}" for doc in similar_docs
-        ])
+        if similar_docs is None:
+            try:
+                similar_docs = await self.vector.keyword_search(question, query_embedding, settings.top_k)
+            except Exception as e:
+                logger.error(f"Fallback keyword search failed: {e}")
+                await self.db.rollback()
+                similar_docs = []
         
-        answer, tokens = await self.llm.generate_answer(question, context)
-        
-        sources = [
+        answer = extractive_answer(question, similar_docs) if similar_docs else None
+        FALLBACK_ANSWERS.labels("extractive" if answer else "unavailable").inc()
+        return AnswerResponse(
+            answer=answer or UNAVAILABLE_ANSWER,
+            sources=self._build_sources(similar_docs) if answer else [],
+            tokens_used=0,
+            response_time=time.time() - start_time,
+            degraded=True
+        )
+    
+    def _not_found(self, question: str, start_time: float) -> AnswerResponse:
+        logger.warning(f"No similar documents found for query: {question[:50]}...")
+        return AnswerResponse(
+            answer=NOT_FOUND_ANSWER,
+            sources=[],
+            tokens_used=0,
+            response_time=time.time() - start_time
+        )
+    
+    @staticmethod
+    def _build_context(similar_docs) -> PackedContext:
+        """Merge overlapping neighbours and pack the best passages into the token budget"""
+        return pack_context(similar_docs, settings.context_token_budget, settings.chunk_overlap)
+    
+    @staticmethod
+    def _build_sources(similar_docs) -> List[Source]:
+        return [
             Source(
                 filename=doc[0],
                 content=doc[1][:200] + "...",
@@ -52,27 +411,60 @@ class RAGService:
             )
             for doc in similar_docs
         ]
+    
+    async def _save_answer(
+        self,
+        question: str,
+        query_embedding: List[float],
+        answer: str,
+        sources: List[Source],
+        tokens: int,
+        response_time: float,
+        context: Optional[PackedContext] = None
+    ) -> dict:
+        """Queue the history record and write semantic and exact cache entries for a generated answer"""
+        response_data = self._record_answer(question, answer, sources, tokens, response_time, context)
+        with stage_timer("cache_write"):
+            if self.semantic_cache_enabled:
+                await self.semantic_cache.store(question, query_embedding, response_data)
+                await self.db.commit()
+            
+            if self.use_cache:
+                await self.cache.set(question, response_data)
         
-        response_time = time.time() - start_time
-        
-        history = QueryHistory(
-            question=question,
-            answer=answer,
-            sources=str([s.filename for s in sources]),
-            tokens_used=tokens,
-            response_time=response_time
-        )
-        self.db.add(history)
-        self.db.commit()
+        logger.info(f"RAG pipeline completed in {response_time:.2f}s")
         
+        return response_data
+    
+    @staticmethod
+    def _record_answer(
+        question: str,
+        answer: str,
+        sources: List[Source],
+        tokens: int,
+        response_time: float,
+        context: Optional[PackedContext] = None
+    ) -> dict:
+        """Response payload of a generated answer; queues its history record and usage metrics"""
         response_data = {
             "answer": answer,
             "sources": [s.model_dump() for s in sources],
             "tokens_used": tokens,
             "response_time": response_time
         }
-        await self.cache.set(question, response_data)
-        
-        logger.info(f"RAG pipeline completed in {response_time:.2f}s")
         
-        return AnswerResponse(**response_data)
\ No newline at end of file
+        history_writer.enqueue(
+            question=question,
+            answer=answer,
+            sources=str([s.filename for s in sources]),
+            tokens_used=tokens,
+            response_time=response_time,
+            context_tokens=context.tokens if context else None,
+            context_tokens_saved=context.tokens_saved if context else None
+        )
+        query_metrics.record_generation(
+            tokens,
+            context.tokens if context else None,
+            context.tokens_saved if context else None
+        )
+        return response_data
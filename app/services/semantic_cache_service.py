@@ -0,0 +1,212 @@
+import json
+import hashlib
+import redis.asyncio as redis
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import bindparam, delete, func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import get_settings
+from app.models import SemanticCacheEntry
+from app.redis_client import get_redis
+from app.services.cache_service import normalize_question
+from app.services.vector_service import QUERY_BATCH_SQL, to_vector_literal
+from app.utils.logger import logger
+
+settings = get_settings()
+
+STATS_KEY = "faq:semantic:stats"
+
+
+class SemanticCacheService:
+    """
+    Answer cache keyed on question embeddings.
+    Entries live in the semantic_cache table behind an ANN index, so the nearest
+    previous question is found in roughly constant time as the cache grows.
+    Hit rate and the best-match similarity distribution are counted in Redis.
+    """
+    
+    def __init__(self, db: AsyncSession, redis_client: Optional[redis.Redis] = None):
+        self.db = db
+        self._redis = redis_client or get_redis()
+    
+    @staticmethod
+    def _question_key(question: str) -> str:
+        return hashlib.md5(normalize_question(question).encode()).hexdigest()
+    
+    async def lookup(
+        self,
+        embedding: List[float],
+        threshold: Optional[float] = None,
+        record: bool = True
+    ) -> Optional[Tuple[dict, float]]:
+        """
+        Return (answer_data, similarity) of the closest cached question above the threshold
+        (SEMANTIC_CACHE_THRESHOLD by default); record=False leaves the hit-rate stats alone
+        """
+        try:
+            sql = text("""
+                SELECT
+                    id,
+                    question,
+                    answer_data,
+                    1 - (embedding <=> cast(:embedding as vector)) as similarity
+                FROM semantic_cache
+                WHERE expires_at > now()
+                ORDER BY embedding <=> cast(:embedding as vector)
+                LIMIT 1
+            """).bindparams(bindparam("embedding", value=to_vector_literal(embedding)))
+            
+            row = (await self.db.execute(sql)).first()
+        except Exception as e:
+            logger.error(f"Semantic cache lookup error: {e}")
+            await self.db.rollback()
+            return None
+        
+        similarity, hit = self._match(row, threshold)
+        if record:
+            await self._record(similarity, hit)
+        
+        if not hit:
+            logger.info(
+                f"Semantic cache MISS (best similarity: "
+                f"{'-' if similarity is None else f'{similarity:.3f}'})"
+            )
+            return None
+        
+        logger.info(f"Semantic cache HIT ({similarity:.3f}) via: {row.question[:50]}...")
+        return json.loads(row.answer_data), similarity
+    
+    async def lookup_many(self, embeddings: List[List[float]]) -> List[Optional[Tuple[dict, float]]]:
+        """lookup for a batch of questions: one LATERAL query, stats in one pipeline"""
+        if not embeddings:
+            return []
+        try:
+            sql = text(f"""
+                WITH batch AS MATERIALIZED ({QUERY_BATCH_SQL})
+                SELECT batch.ord, best.*
+                FROM batch
+                LEFT JOIN LATERAL (
+                    SELECT
+                        question,
+                        answer_data,
+                        1 - (embedding <=> batch.embedding) as similarity
+                    FROM semantic_cache
+                    WHERE expires_at > now()
+                    ORDER BY embedding <=> batch.embedding
+                    LIMIT 1
+                ) best ON true
+                ORDER BY batch.ord
+            """).bindparams(
+                bindparam("embeddings", value=[to_vector_literal(e) for e in embeddings]),
+                bindparam("queries", value=[""] * len(embeddings))
+            )
+            rows = (await self.db.execute(sql)).all()
+        except Exception as e:
+            logger.error(f"Semantic cache batch lookup error: {e}")
+            await self.db.rollback()
+            return [None] * len(embeddings)
+        
+        matches = []
+        lookups = []
+        for row in rows:
+            similarity, hit = self._match(row if row.question is not None else None)
+            lookups.append((similarity, hit))
+            matches.append((json.loads(row.answer_data), similarity) if hit else None)
+        
+        await self._record_many(lookups)
+        hits = sum(hit for _, hit in lookups)
+        logger.info(f"Semantic cache batch: {hits}/{len(lookups)} hits")
+        return matches
+    
+    @staticmethod
+    def _match(row, threshold: Optional[float] = None) -> Tuple[Optional[float], bool]:
+        """(best similarity, hit) for the closest live cached question, None if there is none"""
+        similarity = float(row.similarity) if row is not None else None
+        hit = (
+            similarity is not None
+            and similarity >= (settings.semantic_cache_threshold if threshold is None else threshold)
+        )
+        return similarity, hit
+    
+    async def store(self, question: str, embedding: List[float], answer_data: dict):
+        """Add (or refresh) a cached answer; committed together with the caller's transaction"""
+        await self.store_many([(question, embedding, answer_data)])
+    
+    async def store_many(self, entries: List[Tuple[str, List[float], dict]]):
+        """store for several distinct questions in one INSERT ... ON CONFLICT statement"""
+        if not entries:
+            return
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=settings.semantic_cache_ttl)
+        stmt = insert(SemanticCacheEntry).values([
+            {
+                "question_key": self._question_key(question),
+                "question": question,
+                "embedding": embedding,
+                "answer_data": json.dumps(answer_data, ensure_ascii=False),
+                "expires_at": expires_at,
+            }
+            for question, embedding, answer_data in entries
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SemanticCacheEntry.question_key],
+            set_={
+                "embedding": stmt.excluded.embedding,
+                "answer_data": stmt.excluded.answer_data,
+                "expires_at": stmt.excluded.expires_at,
+            }
+        )
+        await self.db.execute(stmt)
+    
+    async def purge_expired(self) -> int:
+        """Delete expired entries so they stop occupying the ANN index"""
+        result = await self.db.execute(
+            delete(SemanticCacheEntry).where(SemanticCacheEntry.expires_at <= func.now())
+        )
+        await self.db.commit()
+        return result.rowcount or 0
+    
+    async def _record(self, similarity: Optional[float], hit: bool):
+        """Count the lookup, the hit and the best similarity (0.01 buckets) in one pipeline"""
+        await self._record_many([(similarity, hit)])
+    
+    async def _record_many(self, lookups: List[Tuple[Optional[float], bool]]):
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for similarity, hit in lookups:
+                    pipe.hincrby(STATS_KEY, "lookups", 1)
+                    if hit:
+                        pipe.hincrby(STATS_KEY, "hits", 1)
+                    if similarity is not None:
+                        bucket = max(int(round(similarity * 100, 6)), 0) / 100
+                        pipe.hincrby(STATS_KEY, f"sim:{bucket:.2f}", 1)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Semantic cache stats error: {e}")
+    
+    async def stats(self) -> Dict:
+        """Hit rate and best-match similarity histogram since the stats were last reset"""
+        try:
+            raw = await self._redis.hgetall(STATS_KEY)
+        except Exception as e:
+            # Redis недоступен: нули, а не 500 на весь /api/metrics
+            logger.error(f"Semantic cache stats error: {e}")
+            raw = {}
+        counters = {k.decode(): int(v) for k, v in raw.items()}
+        
+        lookups = counters.pop("lookups", 0)
+        hits = counters.pop("hits", 0)
+        histogram = {
+            name.split(":", 1)[1]: count
+            for name, count in sorted(counters.items())
+            if name.startswith("sim:")
+        }
+        
+        return {
+            "enabled": settings.semantic_cache_enabled,
+            "threshold": settings.semantic_cache_threshold,
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "similarity_histogram": histogram,
+        }
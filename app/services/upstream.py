@@ -0,0 +1,199 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+from openai import APIConnectionError, APIStatusError, APITimeoutError, InternalServerError, RateLimitError
+from app.config import get_settings
+from app.utils.logger import logger
+from app.utils.metrics import CIRCUIT_STATE, EMBEDDING_HEDGES, OPENAI_FAILURES, percentile
+
+settings = get_settings()
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+# Ошибки, говорящие о состоянии самого OpenAI; 4xx вроде BadRequestError — проблема запроса
+TRANSIENT_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+class UpstreamUnavailable(RuntimeError):
+    """OpenAI call rejected by the circuit breaker, past its deadline or failed"""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. After failure_threshold failures in a row the
+    circuit opens and calls fail immediately for reset_timeout seconds; then one trial
+    call is let through (half-open) and its outcome closes or reopens the circuit.
+    """
+    
+    def __init__(self, operation: str, failure_threshold: int, reset_timeout: float):
+        self.operation = operation
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self.rejected = 0
+        CIRCUIT_STATE.labels(operation).set(0)
+    
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit '{self.operation}': {self.state} -> {state}")
+        self.state = state
+        CIRCUIT_STATE.labels(self.operation).set(STATE_VALUES[state])
+    
+    def before_call(self, now: Optional[float] = None):
+        """Raise UpstreamUnavailable when the call must not go upstream"""
+        now = time.monotonic() if now is None else now
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        
+        # В half-open пропускаем ровно один пробный вызов
+        if self.state == OPEN or (self.state == HALF_OPEN and self._trial_running):
+            self.rejected += 1
+            OPENAI_FAILURES.labels(self.operation, "circuit_open").inc()
+            raise UpstreamUnavailable(f"OpenAI {self.operation} circuit is open")
+        if self.state == HALF_OPEN:
+            self._trial_running = True
+    
+    def release_trial(self):
+        self._trial_running = False
+    
+    def record_success(self):
+        self._trial_running = False
+        self.failures = 0
+        self._set_state(CLOSED)
+    
+    def record_failure(self, now: Optional[float] = None):
+        self._trial_running = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic() if now is None else now
+            self._set_state(OPEN)
+    
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class LatencyWindow:
+    """Latencies of the last `size` successful calls; the hedge delay is their percentile"""
+    
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+    
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+    
+    def hedge_delay(self) -> Optional[float]:
+        """EMBEDDING_HEDGE_PERCENTILE of recent latencies; None (no hedging) until warmed up"""
+        if not settings.embedding_hedge_enabled or len(self.samples) < settings.embedding_hedge_min_samples:
+            return None
+        return max(percentile(self.samples, settings.embedding_hedge_percentile), settings.embedding_hedge_min_delay)
+
+
+async def hedged(make_call: Callable[[], Awaitable[T]], delay: float) -> T:
+    """
+    Start make_call(); if it has not finished after `delay` seconds start a duplicate and
+    return whichever succeeds first, cancelling the other
+    """
+    first = asyncio.ensure_future(make_call())
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            EMBEDDING_HEDGES.labels("sent").inc()
+            tasks.append(asyncio.ensure_future(make_call()))
+        
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        EMBEDDING_HEDGES.labels("won").inc()
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # Также при отмене по дедлайну: запросы не должны продолжаться в фоне
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def guarded_call(
+    breaker: CircuitBreaker,
+    make_call: Callable[[], Awaitable[T]],
+    deadline: float,
+    latency: Optional[LatencyWindow] = None
+) -> T:
+    """
+    One OpenAI call behind the circuit breaker and a deadline; with a latency window the
+    call is hedged after its percentile delay. Timeouts, connection errors, rate limits and
+    5xx count against the breaker and become UpstreamUnavailable; any other error (a 4xx
+    such as a too-long prompt) leaves the breaker closed and is re-raised as is.
+    """
+    breaker.before_call()
+    operation = breaker.operation
+    delay = latency.hedge_delay() if latency is not None else None
+    
+    start = time.perf_counter()
+    try:
+        call = hedged(make_call, delay) if delay is not None else make_call()
+        result = await asyncio.wait_for(call, timeout=deadline)
+    except (asyncio.TimeoutError, APITimeoutError) as e:
+        breaker.record_failure()
+        OPENAI_FAILURES.labels(operation, "timeout").inc()
+        raise UpstreamUnavailable(f"OpenAI {operation} exceeded its {deadline}s deadline") from e
+    except asyncio.CancelledError:
+        # Запрос клиента отменён: пробный вызов half-open не должен заблокировать следующие
+        breaker.release_trial()
+        raise
+    except TRANSIENT_ERRORS as e:
+        breaker.record_failure()
+        OPENAI_FAILURES.labels(operation, "error").inc()
+        raise UpstreamUnavailable(f"OpenAI {operation} failed: {e}") from e
+    except APIStatusError:
+        # OpenAI ответил — значит, он доступен
+        breaker.record_success()
+        OPENAI_FAILURES.labels(operation, "client_error").inc()
+        raise
+    except Exception:
+        breaker.release_trial()
+        raise
+    
+    breaker.record_success()
+    if latency is not None:
+        latency.add(time.perf_counter() - start)
+    return result
+
+
+embedding_breaker = CircuitBreaker(
+    "embedding", settings.circuit_failure_threshold, settings.circuit_reset_timeout
+)
+generation_breaker = CircuitBreaker(
+    "generation", settings.circuit_failure_threshold, settings.circuit_reset_timeout
+)
+embedding_latency = LatencyWindow()
+
+
+def upstream_stats() -> Dict:
+    delay = embedding_latency.hedge_delay()
+    return {
+        "embedding": embedding_breaker.stats(),
+        "generation": generation_breaker.stats(),
+        "embedding_hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+    }
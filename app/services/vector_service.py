@@ -1,104 +1,503 @@
-from sqlalchemy import bindparam
-from sqlalchemy.orm import Session
+import asyncio
+import codecs
+import hashlib
+import time
+from dataclasses import dataclass
+from sqlalchemy import bindparam, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from typing import List, Tuple
-from app.models import Document
+from collections.abc import AsyncIterable
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+from app.models import ChunkEmbedding, Document, TEXT_SEARCH_CONFIG
 from app.services.llm_service import LLMService
+from app.services.memory_index import memory_index
+from app.config import get_settings
 from app.utils.logger import logger
+from app.utils.tokens import count_tokens
 
-class VectorService:
-    def __init__(self, db: Session):
-        self.db = db
-        self.llm = LLMService()
+settings = get_settings()
+
+
+def to_vector_literal(embedding) -> str:
+    """pgvector text literal for a list or numpy array of floats"""
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+
+def chunk_content_hash(chunk: str) -> str:
+    """Content address of a chunk embedding: embedding model + exact chunk text"""
+    return hashlib.sha256(f"{settings.embedding_model_key}\0{chunk}".encode()).hexdigest()
+
+
+def keyword_query_sql(query: str = ":query") -> str:
+    """Вопрос на естественном языке -> OR всех лексем: документ не обязан содержать каждое слово"""
+    return (
+        f"to_tsquery('{TEXT_SEARCH_CONFIG}', "
+        f"replace(plainto_tsquery('{TEXT_SEARCH_CONFIG}', {query})::text, ' & ', ' | '))"
+    )
+
+
+# Расстояние первого этапа: то же выражение, по которому построен ANN индекс (database.VECTOR_STORAGE_OPS)
+APPROXIMATE_DISTANCE = {
+    "vector": "embedding <=> cast({embedding} as vector)",
+    "halfvec": "embedding::halfvec({dims}) <=> cast({embedding} as halfvec({dims}))",
+    "binary": "binary_quantize(embedding)::bit({dims}) <~> binary_quantize(cast({embedding} as vector))",
+}
+
+# Запросы пачки: строка на вопрос, вектор приводится один раз (:embeddings, :queries — text[])
+QUERY_BATCH_SQL = """
+    SELECT ord, cast(embedding as vector) AS embedding, query
+    FROM unnest(cast(:embeddings as text[]), cast(:queries as text[])) WITH ORDINALITY AS q(embedding, query, ord)
+"""
+
+
+def nearest_chunks_sql(storage: str, dims: int, embedding: str = ":embedding") -> str:
+    """
+    Subquery of the :nearest_limit nearest chunks with their exact cosine distance. The inner
+    ORDER BY uses the (possibly quantized) index expression to pick :candidates rows,
+    which are then reranked at full precision. embedding may be a column of a LATERAL join.
+    """
+    return f"""
+        SELECT id, filename, content, chunk_index, token_count,
+            embedding <=> cast({embedding} as vector) AS distance
+        FROM (
+            SELECT id, filename, content, chunk_index, token_count, embedding
+            FROM documents
+            ORDER BY {APPROXIMATE_DISTANCE[storage].format(dims=dims, embedding=embedding)}
+            LIMIT :candidates
+        ) approximate
+        ORDER BY distance
+        LIMIT :nearest_limit
+    """
+
+
+def keyword_search_sql(embedding: Optional[str] = ":embedding", query: str = ":query") -> str:
+    """
+    Full-text matches ranked by ts_rank_cd (rank_score), :limit rows; similarity is still
+    the cosine one, or without an embedding the rank scaled to 0..1
+    """
+    if embedding is None:
+        similarity = "ts_rank_cd(content_tsv, query, 32)"
+    else:
+        similarity = f"1 - (embedding <=> cast({embedding} as vector))"
+    return f"""
+        SELECT
+            filename,
+            content,
+            {similarity} as similarity,
+            chunk_index,
+            token_count,
+            ts_rank_cd(content_tsv, query) AS rank_score
+        FROM documents, {keyword_query_sql(query)} AS query
+        WHERE content_tsv @@ query
+        ORDER BY rank_score DESC
+        LIMIT :limit
+    """
+
+
+def hybrid_search_sql(storage: str, dims: int, embedding: str = ":embedding", query: str = ":query") -> str:
+    """
+    Vector and full-text candidates (:nearest_limit each) fused with reciprocal rank fusion,
+    :limit rows. Derived tables rather than CTEs, so it can also run as a LATERAL subquery.
+    """
+    return f"""
+        SELECT
+            d.filename,
+            d.content,
+            1 - (d.embedding <=> cast({embedding} as vector)) AS similarity,
+            d.chunk_index,
+            d.token_count,
+            coalesce(1.0 / (:rrf_k + semantic.rank), 0)
+                + coalesce(1.0 / (:rrf_k + keyword.rank), 0) AS rrf_score
+        FROM (
+            SELECT id, row_number() OVER (ORDER BY distance) AS rank
+            FROM ({nearest_chunks_sql(storage, dims, embedding)}) nearest
+        ) semantic
+        FULL OUTER JOIN (
+            SELECT id, row_number() OVER (ORDER BY score DESC) AS rank
+            FROM (
+                SELECT id, ts_rank_cd(content_tsv, query) AS score
+                FROM documents, {keyword_query_sql(query)} AS query
+                WHERE content_tsv @@ query
+                ORDER BY score DESC
+                LIMIT :nearest_limit
+            ) matched
+        ) keyword ON keyword.id = semantic.id
+        JOIN documents d ON d.id = coalesce(semantic.id, keyword.id)
+        ORDER BY rrf_score DESC, similarity DESC
+        LIMIT :limit
+    """
+
+
+def rerank_candidates(limit: int, storage: Optional[str] = None) -> int:
+    """First-stage size: the full-precision index needs no extra rows to rerank"""
+    if (storage or settings.vector_storage) == "vector":
+        return limit
+    return max(settings.rerank_candidates, limit)
+
+
+class RetrievedChunk(NamedTuple):
+    """One search hit; plain (filename, content, similarity) tuples are accepted where these are"""
+    filename: str
+    content: str
+    similarity: float
+    chunk_index: Optional[int] = None
+    token_count: Optional[int] = None
+
+
+def reciprocal_rank_fusion(rankings: List[List[tuple]], k: int = 60) -> List[RetrievedChunk]:
+    """Merge ranked search results by sum of 1 / (k + rank)"""
+    scores: Dict[Tuple[str, str], float] = {}
+    chunks: Dict[Tuple[str, str], RetrievedChunk] = {}
     
-    def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-        """Split text into overlapping chunks for better context preservation"""
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            chunk = RetrievedChunk(*item)
+            key = (chunk.filename, chunk.content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            chunks.setdefault(key, chunk)
+    
+    ordered = sorted(scores, key=lambda key: (scores[key], chunks[key].similarity), reverse=True)
+    return [chunks[key] for key in ordered]
+
+
+def _retrieved(row) -> RetrievedChunk:
+    return RetrievedChunk(row.filename, row.content, float(row.similarity), row.chunk_index, row.token_count)
+
+
+class DocumentRejected(ValueError):
+    """Upload that cannot be ingested; status_code is the HTTP status to answer with"""
+    
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+class StreamingChunker:
+    """
+    Incremental version of VectorService.chunk_text: feed text piece by piece and get
+    the same chunks (same overlap and sentence-boundary rules) as soon as they are final.
+    Only the text from the current chunk start onward is kept in memory.
+    """
+    
+    def __init__(self, chunk_size: int = 1000, overlap: int = 200):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self._buffer = ""
+        self._offset = 0  # absolute position of _buffer[0]
+        self._start = 0   # absolute position of the next chunk
+    
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        return self._drain(final=False)
+    
+    def finish(self) -> List[str]:
+        return self._drain(final=True)
+    
+    def _drain(self, final: bool) -> List[str]:
         chunks = []
-        start = 0
-        text_length = len(text)
+        total = self._offset + len(self._buffer)
         
-        while start < text_length:
-            end = start + chunk_size
-            chunk = text[start:end]
+        while self._start < total:
+            end = self._start + self.chunk_size
+            # Пока поток не закончен, нельзя решить судьбу чанка, доходящего до конца буфера
+            if not final and end >= total:
+                break
+            
+            local = self._start - self._offset
+            chunk = self._buffer[local:local + self.chunk_size]
             
-            if end < text_length:
+            if end < total:
                 last_period = chunk.rfind('.')
                 last_newline = chunk.rfind('\n')
                 split_point = max(last_period, last_newline)
                 
-                if split_point > chunk_size * 0.5:
+                if split_point > self.chunk_size * 0.5:
                     chunk = chunk[:split_point + 1]
-                    end = start + split_point + 1
+                    end = self._start + split_point + 1
             
             chunk_stripped = chunk.strip()
-            if chunk_stripped:  
+            if chunk_stripped:
                 chunks.append(chunk_stripped)
             
-            start = end - overlap
+            self._start = end - self.overlap
+        
+        consumed = self._start - self._offset
+        if consumed > 0:
+            self._buffer = self._buffer[consumed:]
+            self._offset = self._start
         
         return chunks
+
+
+async def iter_upload_text(
+    stream,
+    max_bytes: int,
+    min_chars: int = 50,
+    read_size: int = 64 * 1024
+) -> AsyncIterator[Tuple[bytes, str]]:
+    """
+    Read an upload (anything with async read(n): UploadFile, aiofiles) in pieces and
+    yield (raw bytes, decoded text), decoding UTF-8 incrementally and enforcing the
+    size, encoding and minimum-length rules as the data streams in
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    total_bytes = 0
+    head = ""  # начало документа, пока не наберётся min_chars значимых символов
     
-    async def add_document(self, filename: str, content: str) -> int:
-        """Add document to vector database with embeddings"""
+    def decode(data: bytes, final: bool = False) -> str:
+        try:
+            return decoder.decode(data, final)
+        except UnicodeDecodeError:
+            raise DocumentRejected("File must be valid UTF-8 encoded text")
+    
+    while True:
+        data = await stream.read(read_size)
+        if not data:
+            break
         
-        chunks = self.chunk_text(content)
-        logger.info(f"Created {len(chunks)} chunks for {filename}")
+        total_bytes += len(data)
+        if total_bytes > max_bytes:
+            raise DocumentRejected(
+                f"File too large. Maximum size is {max_bytes // (1024 * 1024)}MB",
+                status_code=413
+            )
+        
+        text_piece = decode(data)
+        if len(head.strip()) < min_chars:
+            head += text_piece
+        
+        yield data, text_piece
+    
+    tail = decode(b"", final=True)
+    head += tail
+    if len(head.strip()) < min_chars:
+        raise DocumentRejected(f"Document content too short (minimum {min_chars} characters)")
+    
+    if tail:
+        yield b"", tail
+
+
+async def iter_upload_chunks(
+    stream,
+    max_bytes: int,
+    chunk_size: int = 1000,
+    overlap: int = 200,
+    min_chars: int = 50,
+    read_size: int = 64 * 1024
+) -> AsyncIterator[str]:
+    """Chunks of an upload, produced while it is still being read"""
+    chunker = StreamingChunker(chunk_size, overlap)
+    
+    async for _data, text_piece in iter_upload_text(stream, max_bytes, min_chars, read_size):
+        for chunk in chunker.feed(text_piece):
+            yield chunk
+    
+    for chunk in chunker.finish():
+        yield chunk
+
+
+async def _as_async_iter(items: Iterable[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
+
+
+@dataclass
+class IngestReport:
+    """Per-document ingestion outcome"""
+    chunks: int
+    reused: int
+    embedded: int
+    seconds: float
+
+
+class VectorService:
+    # Ограничение на число параметров в одном IN (...) запросе
+    HASH_LOOKUP_BATCH = 1000
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.llm = LLMService()
+    
+    def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
+        """Split text into overlapping chunks for better context preservation"""
+        chunker = StreamingChunker(chunk_size, overlap)
+        return chunker.feed(text) + chunker.finish()
+    
+    async def embed_chunks(self, chunks: List[str], concurrency: Optional[int] = None) -> List[List[float]]:
+        """Embed chunks in multi-input batches, running a bounded number of batches at once"""
+        batch_size = settings.embedding_batch_size
+        embeddings: List[Optional[List[float]]] = [None] * len(chunks)
+        semaphore = asyncio.Semaphore(concurrency or settings.embedding_concurrency)
+        
+        async def run_batch(start: int):
+            batch = chunks[start:start + batch_size]
+            async with semaphore:
+                vectors = await self._embed_batch_with_retry(batch, start)
+            embeddings[start:start + len(batch)] = vectors
         
-        if not chunks:
-            raise ValueError("Document produced no valid chunks")
+        results = await asyncio.gather(
+            *(run_batch(start) for start in range(0, len(chunks), batch_size)),
+            return_exceptions=True
+        )
         
-        for i, chunk in enumerate(chunks):
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            raise errors[0]
+        
+        return embeddings
+    
+    async def _embed_batch_with_retry(self, batch: List[str], start: int) -> List[List[float]]:
+        """Embed one batch, retrying only this batch on failure"""
+        attempts = settings.embedding_max_retries + 1
+        
+        for attempt in range(attempts):
             try:
-                embedding = await self.llm.get_embedding(chunk)
-                
-                doc = Document(
-                    filename=filename,
-                    content=chunk,
-                    chunk_index=i,
-                    embedding=embedding  
-                )
-                self.db.add(doc)
-                
+                return await self.llm.get_embeddings(batch)
             except Exception as e:
-                logger.error(f"Error processing chunk {i} of {filename}: {e}")
-                raise
+                if attempt == attempts - 1:
+                    raise
+                delay = settings.embedding_retry_backoff * (2 ** attempt)
+                logger.warning(
+                    f"Embedding batch at chunk {start} failed "
+                    f"(attempt {attempt + 1}/{attempts}): {e}. Retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+    
+    async def embed_chunks_with_store(
+        self,
+        chunks: List[str],
+        concurrency: Optional[int] = None
+    ) -> Tuple[List, int]:
+        """
+        Reuse stored vectors for chunk texts already embedded with this model and
+        embed only the rest; returns (embeddings, number of chunks embedded via the API)
+        """
+        hashes = [chunk_content_hash(chunk) for chunk in chunks]
+        known: Dict[str, object] = {}
+        
+        unique_hashes = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique_hashes), self.HASH_LOOKUP_BATCH):
+            result = await self.db.execute(
+                select(ChunkEmbedding.content_hash, ChunkEmbedding.embedding)
+                .where(ChunkEmbedding.content_hash.in_(unique_hashes[i:i + self.HASH_LOOKUP_BATCH]))
+            )
+            known.update({row.content_hash: row.embedding for row in result})
+        
+        missing: Dict[str, str] = {}
+        for content_hash, chunk in zip(hashes, chunks):
+            if content_hash not in known:
+                missing.setdefault(content_hash, chunk)
+        
+        if missing:
+            vectors = await self.embed_chunks(list(missing.values()), concurrency)
+            new_rows = [
+                {"content_hash": content_hash, "model": settings.embedding_model_key, "embedding": vector}
+                for content_hash, vector in zip(missing, vectors)
+            ]
+            await self.db.execute(
+                insert(ChunkEmbedding).on_conflict_do_nothing(index_elements=["content_hash"]),
+                new_rows
+            )
+            known.update({row["content_hash"]: row["embedding"] for row in new_rows})
+        
+        return [known[content_hash] for content_hash in hashes], len(missing)
+    
+    async def add_document(
+        self,
+        filename: str,
+        content: str,
+        file_hash: Optional[str] = None,
+        source: str = "upload"
+    ) -> IngestReport:
+        """Add document to vector database with embeddings"""
+        chunks = self.chunk_text(content, settings.chunk_size, settings.chunk_overlap)
+        logger.info(f"Created {len(chunks)} chunks for {filename}")
+        
+        return await self.add_document_stream(filename, chunks, file_hash=file_hash, source=source)
+    
+    async def add_document_stream(
+        self,
+        filename: str,
+        chunks: Union[Iterable[str], AsyncIterable[str]],
+        file_hash: Optional[str] = None,
+        source: str = "upload",
+        job_id: Optional[str] = None,
+        start_index: int = 0,
+        on_window: Optional[Callable[[int, int], Awaitable[None]]] = None
+    ) -> IngestReport:
+        """
+        Embed and insert chunks window by window as they are produced, so only one
+        window of chunks and vectors is held in memory; committed once at the end.
+        on_window(chunks, embedded) runs after each window is inserted, in the same
+        transaction, e.g. to record and commit job progress.
+        """
+        start_time = time.time()
+        window_size = settings.embedding_batch_size * settings.embedding_concurrency
+        total = 0
+        embedded = 0
+        window: List[str] = []
+        
+        async def flush_window():
+            nonlocal total, embedded
+            vectors, window_embedded = await self.embed_chunks_with_store(window)
+            await self.db.execute(insert(Document), [
+                {
+                    "filename": filename,
+                    "content": chunk,
+                    "chunk_index": start_index + total + i,
+                    "embedding": vector,
+                    "file_hash": file_hash,
+                    "source": source,
+                    "job_id": job_id,
+                    "token_count": count_tokens(chunk),
+                }
+                for i, (chunk, vector) in enumerate(zip(window, vectors))
+            ])
+            total += len(window)
+            embedded += window_embedded
+            if on_window is not None:
+                await on_window(len(window), window_embedded)
+            window.clear()
+        
+        if not isinstance(chunks, AsyncIterable):
+            chunks = _as_async_iter(chunks)
         
         try:
-            self.db.commit()
+            async for chunk in chunks:
+                window.append(chunk)
+                if len(window) >= window_size:
+                    await flush_window()
+            if window:
+                await flush_window()
+            
+            if total == 0 and start_index == 0:
+                raise ValueError("Document produced no valid chunks")
+            
+            await self.db.commit()
         except Exception as e:
-            self.db.rollback()
-            logger.error(f"Failed to commit document {filename}: {e}")
+            await self.db.rollback()
+            logger.error(f"Failed to ingest document {filename}: {e}")
             raise
         
-        return len(chunks)
+        report = IngestReport(
+            chunks=total,
+            reused=total - embedded,
+            embedded=embedded,
+            seconds=round(time.time() - start_time, 3)
+        )
+        logger.info(
+            f"Ingested {filename}: {report.chunks} chunks "
+            f"({report.reused} reused, {report.embedded} embedded) in {report.seconds:.2f}s"
+        )
+        return report
     
-    async def search_similar(self, query: str, top_k: int = 3) -> List[Tuple[str, str, float]]:
+    async def search_similar(self, query: str, top_k: int = 3) -> List[RetrievedChunk]:
         """Search for similar document chunks using cosine similarity"""
         
         try:
             query_embedding = await self.llm.get_embedding(query)
-            
-
-            
-            sql = text("""
-                SELECT 
-                    filename, 
-                    content, 
-                    1 - (embedding <=> cast(:embedding as vector)) as similarity
-                FROM documents
-                ORDER BY embedding <=> cast(:embedding as vector)
-                LIMIT :limit
-            """).bindparams(
-                bindparam("embedding", value=str(query_embedding)),
-                bindparam("limit", value=top_k)
-            )
-            
-            result = self.db.execute(sql)
-            
-            similar_docs = [
-                (row.filename, row.content, float(row.similarity)) 
-                for row in result
-            ]
+            similar_docs = await self.search_by_embedding(query_embedding, top_k, query_text=query)
             
             if not similar_docs:
                 logger.warning(f"No similar documents found for query: {query[:50]}...")
@@ -110,4 +509,181 @@ class VectorService:
         except Exception as e:
             logger.error(f"Error in vector search: {e}", exc_info=True)
             raise
-            
\ No newline at end of file
+    
+    async def search_by_embedding(
+        self,
+        query_embedding: List[float],
+        top_k: int = 3,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        query_text: Optional[str] = None
+    ) -> List[RetrievedChunk]:
+        """
+        Nearest chunks for a precomputed embedding; ef_search/probes override the connection
+        defaults. With query_text and SEARCH_MODE=hybrid full-text matches are fused in (RRF).
+        """
+        hybrid = query_text is not None and settings.search_mode == "hybrid"
+        
+        # In-process индекс (если включён и загружен) отвечает без обращения к Postgres
+        if memory_index.ready and ef_search is None and probes is None:
+            if not hybrid:
+                return [RetrievedChunk(*row) for row in memory_index.search(query_embedding, top_k)]
+            candidates = max(settings.hybrid_candidates, top_k)
+            semantic = memory_index.search(query_embedding, candidates)
+            keyword = await self.keyword_search(query_text, query_embedding, candidates)
+            return reciprocal_rank_fusion([semantic, keyword], settings.hybrid_rrf_k)[:top_k]
+        
+        if ef_search is not None:
+            await self.db.execute(
+                text("SELECT set_config('hnsw.ef_search', :value, true)"),
+                {"value": str(ef_search)}
+            )
+        if probes is not None:
+            await self.db.execute(
+                text("SELECT set_config('ivfflat.probes', :value, true)"),
+                {"value": str(probes)}
+            )
+        
+        if hybrid:
+            return await self._hybrid_search(query_text, query_embedding, top_k)
+        
+        sql = text(f"""
+            SELECT 
+                filename, 
+                content, 
+                1 - distance as similarity,
+                chunk_index,
+                token_count
+            FROM ({nearest_chunks_sql(settings.vector_storage, settings.embedding_dimensions)}) nearest
+            ORDER BY distance
+        """).bindparams(
+            bindparam("embedding", value=to_vector_literal(query_embedding)),
+            bindparam("candidates", value=rerank_candidates(top_k)),
+            bindparam("nearest_limit", value=top_k)
+        )
+        
+        result = await self.db.execute(sql)
+        
+        return [_retrieved(row) for row in result]
+    
+    async def search_many(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int = 3,
+        query_texts: Optional[List[str]] = None
+    ) -> List[List[RetrievedChunk]]:
+        """
+        search_by_embedding for a batch of queries in one SQL round trip: the per-query
+        search runs as a LATERAL subquery over the array of query vectors
+        """
+        if not query_embeddings:
+            return []
+        hybrid = query_texts is not None and settings.search_mode == "hybrid"
+        texts = query_texts if query_texts is not None else [""] * len(query_embeddings)
+        
+        if memory_index.ready:
+            candidates = max(settings.hybrid_candidates, top_k) if hybrid else top_k
+            semantic = [memory_index.search(embedding, candidates) for embedding in query_embeddings]
+            if not hybrid:
+                return [[RetrievedChunk(*row) for row in rows] for rows in semantic]
+            keyword = await self._run_batch(
+                keyword_search_sql("batch.embedding", "batch.query"), "hit.rank_score DESC",
+                query_embeddings, texts,
+                limit=candidates
+            )
+            return [
+                reciprocal_rank_fusion([rows, matches], settings.hybrid_rrf_k)[:top_k]
+                for rows, matches in zip(semantic, keyword)
+            ]
+        
+        storage, dims = settings.vector_storage, settings.embedding_dimensions
+        if hybrid:
+            candidates = max(settings.hybrid_candidates, top_k)
+            return await self._run_batch(
+                hybrid_search_sql(storage, dims, "batch.embedding", "batch.query"),
+                "hit.rrf_score DESC, hit.similarity DESC",
+                query_embeddings, texts,
+                nearest_limit=candidates,
+                candidates=rerank_candidates(candidates),
+                rrf_k=settings.hybrid_rrf_k,
+                limit=top_k
+            )
+        
+        return await self._run_batch(
+            f"SELECT *, 1 - distance AS similarity FROM ({nearest_chunks_sql(storage, dims, 'batch.embedding')}) nearest",
+            "hit.distance",
+            query_embeddings, texts,
+            candidates=rerank_candidates(top_k),
+            nearest_limit=top_k
+        )
+    
+    async def _run_batch(
+        self,
+        per_query_sql: str,
+        order_by: str,
+        query_embeddings: List[List[float]],
+        query_texts: List[str],
+        **params
+    ) -> List[List[RetrievedChunk]]:
+        """
+        Run per_query_sql for every (batch.embedding, batch.query) row; results grouped per
+        query and ordered within it by order_by (over the hit.* columns)
+        """
+        # Порядок подзапроса через LATERAL не гарантирован: сортируем явно
+        sql = text(f"""
+            WITH batch AS MATERIALIZED ({QUERY_BATCH_SQL})
+            SELECT batch.ord, hit.*
+            FROM batch
+            CROSS JOIN LATERAL ({per_query_sql}) hit
+            ORDER BY batch.ord, {order_by}
+        """).bindparams(
+            bindparam("embeddings", value=[to_vector_literal(e) for e in query_embeddings]),
+            bindparam("queries", value=query_texts),
+            *(bindparam(name, value=value) for name, value in params.items())
+        )
+        
+        results: List[List[RetrievedChunk]] = [[] for _ in query_embeddings]
+        for row in await self.db.execute(sql):
+            results[row.ord - 1].append(_retrieved(row))
+        return results
+    
+    async def keyword_search(
+        self,
+        query_text: str,
+        query_embedding: Optional[List[float]],
+        limit: int
+    ) -> List[RetrievedChunk]:
+        """Full-text matches ranked by ts_rank_cd; works without an embedding (OpenAI unavailable)"""
+        if query_embedding is None:
+            sql = text(keyword_search_sql(embedding=None))
+        else:
+            sql = text(keyword_search_sql()).bindparams(
+                bindparam("embedding", value=to_vector_literal(query_embedding))
+            )
+        sql = sql.bindparams(
+            bindparam("query", value=query_text),
+            bindparam("limit", value=limit)
+        )
+        
+        result = await self.db.execute(sql)
+        return [_retrieved(row) for row in result]
+    
+    async def _hybrid_search(
+        self,
+        query_text: str,
+        query_embedding: List[float],
+        top_k: int
+    ) -> List[RetrievedChunk]:
+        """Vector and full-text candidates fused with reciprocal rank fusion in one query"""
+        candidates = max(settings.hybrid_candidates, top_k)
+        sql = text(hybrid_search_sql(settings.vector_storage, settings.embedding_dimensions)).bindparams(
+            bindparam("embedding", value=to_vector_literal(query_embedding)),
+            bindparam("query", value=query_text),
+            bindparam("nearest_limit", value=candidates),
+            bindparam("candidates", value=rerank_candidates(candidates)),
+            bindparam("rrf_k", value=settings.hybrid_rrf_k),
+            bindparam("limit", value=top_k)
+        )
+        
+        result = await self.db.execute(sql)
+        return [_retrieved(row) for row in result]
@@ -1,15 +1,171 @@
+import math
+import os
 import time
+from contextlib import contextmanager
 from functools import wraps
-from typing import Callable
-from app.utils.logger import logger
-
-
-def track_time(func: Callable):
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-        start = time.time()
-        result = await func(*args, **kwargs)
-        elapsed = time.time() - start
-        logger.info(f"{func.__name__} took {elapsed:.2f}s")
-        return result, elapsed
-    return wrapper
\ No newline at end of file
+from typing import Callable, Dict, Optional, Sequence
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+
+# Границы бакетов: от обращений к Redis (~1ms) до долгих ответов LLM
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_SECONDS = Histogram(
+    "smarttask_stage_duration_seconds",
+    "Duration of one RAG pipeline stage",
+    ["stage"],
+    buckets=STAGE_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "smarttask_request_duration_seconds",
+    "End-to-end latency of an answered question",
+    ["cached"],
+    buckets=STAGE_BUCKETS
+)
+OPENAI_TOKENS = Counter(
+    "smarttask_openai_tokens",
+    "Tokens billed by OpenAI",
+    ["model", "kind"]  # kind: embedding | prompt | completion
+)
+OPENAI_FAILURES = Counter(
+    "smarttask_openai_failures",
+    "OpenAI calls that did not produce a result",
+    ["operation", "reason"]  # reason: timeout | error | client_error | circuit_open
+)
+EMBEDDING_HEDGES = Counter(
+    "smarttask_embedding_hedges",
+    "Duplicate embedding requests sent after the hedge delay",
+    ["outcome"]  # sent | won (the duplicate answered first)
+)
+CIRCUIT_STATE = Gauge(
+    "smarttask_circuit_state",
+    "Circuit breaker state: 0 closed, 1 half-open, 2 open",
+    ["operation"],
+    multiprocess_mode="max"
+)
+FALLBACK_ANSWERS = Counter(
+    "smarttask_fallback_answers",
+    "Answers served without the LLM while it was unavailable",
+    ["kind"]  # cached | extractive | unavailable
+)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Observe the duration of the enclosed block (also when it raises) as a pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def track_time(stage: str):
+    """Decorator for async functions: every call is timed as `stage`, the result is returned as is"""
+    def decorator(func: Callable):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_openai_usage(model: str, usage, embedding: bool = False):
+    """Add the usage block of an OpenAI response to the token counters"""
+    if usage is None:
+        return
+    if embedding:
+        OPENAI_TOKENS.labels(model, "embedding").inc(getattr(usage, "prompt_tokens", 0) or 0)
+        return
+    OPENAI_TOKENS.labels(model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    OPENAI_TOKENS.labels(model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+
+def prometheus_exposition() -> bytes:
+    """Scrape body; with PROMETHEUS_MULTIPROC_DIR set the samples of all worker processes are merged"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """q-th percentile (0-100) with linear interpolation"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def latency_summary(values: Sequence[float]) -> Dict[str, float]:
+    """p50/p95/p99 and mean of latencies given in seconds, reported in milliseconds"""
+    if not values:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "mean_ms": 0.0}
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2),
+    }
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed latency histogram: bucket i > 0 holds values in [growth^(i-1), growth^i) ms,
+    bucket 0 everything below 1 ms. Histograms merge by adding bucket counts, so per-minute
+    rollups combine into hours and totals; quantiles are accurate to about growth / 2.
+    """
+    
+    def __init__(self, counts: Optional[Dict[int, int]] = None, growth: float = 1.08):
+        self.counts: Dict[int, int] = dict(counts or {})
+        self.growth = growth
+        self._log_growth = math.log(growth)
+    
+    def bucket(self, value_ms: float) -> int:
+        if value_ms < 1:
+            return 0
+        return int(math.log(value_ms) / self._log_growth) + 1
+    
+    def bucket_value(self, bucket: int) -> float:
+        """Representative value of a bucket: geometric middle of its bounds"""
+        if bucket <= 0:
+            return 0.5
+        return self.growth ** (bucket - 0.5)
+    
+    def add(self, value_ms: float, count: int = 1):
+        bucket = self.bucket(value_ms)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+    
+    def merge(self, other: "LatencyHistogram") -> "LatencyHistogram":
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        return self
+    
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+    
+    def quantile(self, q: float) -> float:
+        """q-th percentile (0-100) in milliseconds"""
+        total = self.count
+        if not total:
+            return 0.0
+        rank = max(math.ceil(total * q / 100), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self.bucket_value(bucket)
+        return self.bucket_value(max(self.counts))
+    
+    def summary(self) -> Dict[str, float]:
+        return {
+            "p50_ms": round(self.quantile(50), 1),
+            "p95_ms": round(self.quantile(95), 1),
+            "p99_ms": round(self.quantile(99), 1),
+        }
@@ -0,0 +1,11 @@
+import re
+from typing import List
+
+STEM_LENGTH = 5  # грубый стемминг: "задача" и "задачу" дают одну основу
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def word_stems(text: str, min_length: int = 1) -> List[str]:
+    """Lowercased word prefixes of STEM_LENGTH, in text order; words shorter than min_length are skipped"""
+    return [word[:STEM_LENGTH] for word in WORD_RE.findall(text.lower()) if len(word) >= min_length]
@@ -0,0 +1,44 @@
+import asyncio
+import math
+from functools import lru_cache
+from app.config import get_settings
+from app.utils.logger import logger
+
+settings = get_settings()
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """tiktoken encoding of the chat model; None when tiktoken or its BPE file is unavailable"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(settings.openai_model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable ({e}), token counts are estimated")
+        return None
+
+
+async def load_encoding():
+    """
+    Load the encoding once at startup, off the event loop: on a cold cache tiktoken downloads
+    the BPE file with a blocking request (the Docker image ships it in TIKTOKEN_CACHE_DIR)
+    """
+    await asyncio.to_thread(_encoding)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough count: ~4 characters per token for ASCII, ~2.5 for Cyrillic and other text"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2.5)
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
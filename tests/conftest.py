@@ -36,4 +36,121 @@ def client():
 def event_loop():
     loop = asyncio.get_event_loop_policy().new_event_loop()
     yield loop
-    loop.close()
\ No newline at end of file
+    loop.close()
+
+
+class FakeRedis:
+    """Minimal in-memory stand-in for redis.asyncio.Redis (bytes in, bytes out)"""
+    
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+    
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+    
+    async def ping(self):
+        self.round_trips += 1
+        return True
+    
+    async def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+    
+    async def mget(self, keys):
+        self.round_trips += 1
+        return [self.data.get(k) for k in keys]
+    
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        self.round_trips += 1
+        if nx and key in self.data:
+            return None
+        self.data[key] = self._encode(value)
+        return True
+    
+    async def setex(self, key, ttl, value):
+        return await self.set(key, value)
+    
+    async def delete(self, *keys):
+        self.round_trips += 1
+        return sum(self.data.pop(k, None) is not None for k in keys)
+    
+    async def hincrby(self, key, field, amount=1):
+        self.round_trips += 1
+        bucket = self.data.setdefault(key, {})
+        name = self._encode(field)
+        bucket[name] = self._encode(int(bucket.get(name, b"0")) + amount)
+        return int(bucket[name])
+    
+    async def hsetnx(self, key, field, value):
+        self.round_trips += 1
+        bucket = self.data.setdefault(key, {})
+        name = self._encode(field)
+        if name in bucket:
+            return 0
+        bucket[name] = self._encode(value)
+        return 1
+    
+    async def hdel(self, key, *fields):
+        self.round_trips += 1
+        bucket = self.data.get(key, {})
+        return sum(bucket.pop(self._encode(f), None) is not None for f in fields)
+    
+    async def hgetall(self, key):
+        self.round_trips += 1
+        return dict(self.data.get(key, {}))
+    
+    async def expire(self, key, ttl):
+        self.round_trips += 1
+        return key in self.data
+    
+    async def exists(self, *keys):
+        self.round_trips += 1
+        return sum(k in self.data for k in keys)
+    
+    async def eval(self, script, numkeys, *args):
+        # Only the compare-and-delete lock release script is supported
+        self.round_trips += 1
+        key, token = args[0], args[1]
+        if self.data.get(key) == self._encode(token):
+            del self.data[key]
+            return 1
+        return 0
+    
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        return False
+    
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+    
+    async def execute(self):
+        results = []
+        for name, args, kwargs in self.commands:
+            results.append(await getattr(self.redis, name)(*args, **kwargs))
+            self.redis.round_trips -= 1
+        self.redis.round_trips += 1
+        self.commands = []
+        return results
+
+
+@pytest.fixture
+def fake_redis():
+    return FakeRedis()
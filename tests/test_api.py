@@ -51,6 +51,15 @@ def test_ask_question_validation_valid():
     assert response.status_code in [200, 500]
 
 
+def test_ask_batch_validation():
+    """Test that an empty batch, a too short question and an oversized batch are rejected"""
+    assert client.post("/api/ask/batch", json={"questions": []}).status_code == 422
+    assert client.post("/api/ask/batch", json={"questions": ["What is SmartTask?", "Hi"]}).status_code == 422
+    
+    response = client.post("/api/ask/batch", json={"questions": ["What is SmartTask?"] * 500})
+    assert response.status_code == 400
+
+
 @patch('app.services.llm_service.LLMService.get_embedding')
 @patch('app.services.llm_service.LLMService.generate_answer')
 def test_ask_question_structure_with_mocks(mock_generate, mock_embed):
@@ -77,6 +86,29 @@ def test_ask_question_structure_with_mocks(mock_generate, mock_embed):
         assert isinstance(data["cached"], bool)
 
 
+def test_ask_stream_emits_server_sent_events():
+    """Test that /ask/stream sends sources first, then tokens, then done"""
+    
+    async def fake_stream(self, question):
+        yield "sources", {"sources": [{"filename": "a.txt", "content": "...", "similarity": 0.9}]}
+        yield "token", {"text": "Привет"}
+        yield "token", {"text": ", мир"}
+        yield "done", {"tokens_used": 10, "response_time": 0.1, "cached": False}
+    
+    with patch('app.api.endpoints.RAGService.stream_answer', fake_stream):
+        response = client.post("/api/ask/stream", json={"question": "What is SmartTask?"})
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    
+    events = [
+        block.split("\n")[0].removeprefix("event: ")
+        for block in response.text.strip().split("\n\n")
+    ]
+    assert events == ["sources", "token", "token", "done"]
+    assert "Привет" in response.text
+
+
 def test_document_upload_validation_wrong_extension():
     """Test that wrong file extension is rejected"""
     response = client.post(
@@ -96,6 +128,45 @@ def test_document_upload_validation_empty_file():
     assert response.status_code in [400, 500]
 
 
+def test_document_upload_validation_invalid_utf8():
+    """Test that non UTF-8 content is rejected while streaming"""
+    response = client.post(
+        "/api/documents",
+        files={"file": ("test.txt", b"\xff\xfe\x00" * 100, "text/plain")}
+    )
+    assert response.status_code == 400
+    assert "UTF-8" in response.json()["detail"]
+
+
+def test_document_upload_returns_job_immediately(tmp_path, monkeypatch):
+    """Test that a valid upload is spooled to disk and queued instead of embedded inline"""
+    from app.services import ingestion_jobs
+    
+    created = []
+    
+    async def fake_create_job(db, job_id, filename, path):
+        created.append((job_id, filename, path))
+    
+    monkeypatch.setattr(ingestion_jobs.settings, "upload_dir", str(tmp_path))
+    monkeypatch.setattr("app.api.endpoints.create_job", fake_create_job)
+    
+    content = "Руководство SmartTask. " * 20
+    response = client.post(
+        "/api/documents",
+        files={"file": ("guide.txt", content.encode("utf-8"), "text/plain")}
+    )
+    assert response.status_code == 202
+    
+    data = response.json()
+    assert data["status"] == "queued"
+    assert data["filename"] == "guide.txt"
+    
+    job_id, filename, path = created[0]
+    assert job_id == data["job_id"]
+    assert path == tmp_path / f"{job_id}.txt"
+    assert path.read_text(encoding="utf-8") == content
+
+
 def test_metrics_endpoint():
     """Test that metrics endpoint returns proper structure"""
     response = client.get("/api/metrics")
@@ -112,4 +183,20 @@ def test_metrics_endpoint():
     assert isinstance(data["avg_response_time_seconds"], (int, float))
     assert isinstance(data["avg_tokens_per_query"], (int, float))
     assert isinstance(data["total_tokens_used"], int)
-    assert isinstance(data["estimated_cost_usd"], (int, float))
\ No newline at end of file
+    assert isinstance(data["estimated_cost_usd"], (int, float))
+
+
+def test_prometheus_scrape_endpoint():
+    """Test that /metrics exposes stage histograms and token counters in Prometheus text format"""
+    from app.utils.metrics import STAGE_SECONDS
+    
+    STAGE_SECONDS.labels("cache_lookup").observe(0.003)
+    
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    
+    body = response.text
+    assert 'smarttask_stage_duration_seconds_bucket{le="0.005",stage="cache_lookup"}' in body
+    assert "# TYPE smarttask_request_duration_seconds histogram" in body
+    assert "# TYPE smarttask_openai_tokens_total counter" in body